@@ -27,6 +27,7 @@ from artistools.misc import (
     diskcache,
     dot,
     firstexisting,
+    get_bflist,
     flatten_list,
     gather_res_data,
     get_artis_constants,
@@ -34,17 +35,23 @@ from artistools.misc import (
     get_cellsofmpirank,
     get_composition_data,
     get_composition_data_from_outputfile,
+    get_dataframe_backend,
     get_deposition,
     get_escaped_arrivalrange,
+    get_executor,
     get_elsymbol,
     get_elsymbolslist,
     get_filterfunc,
     get_grid_mapping,
     get_model_name,
+    get_nprocs,
     get_inputparams,
     get_ionstring,
+    get_linelist,
     get_mpiranklist,
     get_mpirankofcell,
+    get_process_group_ids,
+    get_process_groups,
     get_runfolders,
     get_syn_dir,
     get_time_range,
@@ -61,11 +68,14 @@ from artistools.misc import (
     match_closest_time,
     namedtuple,
     parse_cdefines,
+    parse_res_data,
     parse_range,
     parse_range_list,
+    read_res_data,
     readnoncommentline,
     roman_numerals,
     showtimesteptimes,
+    shutdown_executor,
     stripallsuffixes,
     trim_or_pad,
     vec_len,
@@ -49,12 +49,16 @@ commandlist = {
     'plotartisnltepops': ('artistools.nltepops.plotnltepops', 'main'),
     'artistools-nltepops': ('artistools.nltepops', 'main'),
 
+    'artistools-convertpackets': ('artistools.packets.convertpackets', 'main'),
+
     'plotartisnonthermal': ('artistools.nonthermal', 'main'),
     'artistools-nonthermal': ('artistools.nonthermal', 'main'),
 
     'plotartisradfield': ('artistools.radfield', 'main'),
     'artistools-radfield': ('artistools.radfield', 'main'),
 
+    'artistools-recompress': ('artistools.recompress', 'main'),
+
     'plotartisspectrum': ('artistools.spectra.plotspectra', 'main'),
     'artistools-spectrum': ('artistools.spectra', 'main'),
 
@@ -20,6 +20,15 @@ except subprocess.CalledProcessError:
 config = {}
 config['enable_diskcache'] = True
 config['num_processes'] = num_processes
+# packets files are read in chunks of this many packets to limit memory usage (None to read whole files)
+config['packets_chunksize'] = None
+# large compressed files that are read sequentially are decompressed with xz, pigz, or zstd, if they are installed
+config['use_external_decompressors'] = True
+# number of threads for each external decompression program (0 to use all cores, shared between pool workers)
+config['decompression_threads'] = 0
+# 'pandas', or 'pyarrow' or 'polars' (if installed) to parse text packets files and aggregate packet queries
+# with a multithreaded engine. Functions still return pandas DataFrames
+config['dataframe_backend'] = 'pandas'
 config['figwidth'] = 5
 config['codecomparisondata1path'] = Path(
     '/Users/luke/Library/Mobile Documents/com~apple~CloudDocs/GitHub/sn-rad-trans/data1')
@@ -5,7 +5,6 @@ Examples are temperatures, populations, and heating/cooling rates.
 """
 # import math
 import math
-import multiprocessing
 import sys
 from collections import namedtuple
 from functools import lru_cache, partial, reduce
@@ -110,7 +109,7 @@ def parse_estimfile(estfilepath, modelpath, get_ion_values=True, get_heatingcool
     """Generate timestep, modelgridindex, dict from estimator file."""
     # itstep = at.get_inputparams(modelpath)['itstep']
 
-    with at.zopen(estfilepath, 'rt') as estimfile:
+    with at.zopen(estfilepath, 'rt', seekable=False) as estimfile:
         timestep = -1
         modelgridindex = -1
         estimblock = {}
@@ -231,9 +230,12 @@ def read_estimators_from_file(folderpath, modelpath, arr_velocity_outer, mpirank
         if not estfilepath.is_file():
             estfilepath = Path(folderpath, estimfilename + '.xz')
             if not estfilepath.is_file():
-                # not worth printing and error, because ranks with no cells to update do not produce an estimator file
-                # print(f'Warning: Could not find {estfilepath.relative_to(modelpath.parent)}')
-                return {}
+                estfilepath = Path(folderpath, estimfilename + '.zst')
+                if not estfilepath.is_file():
+                    # not worth printing and error, because ranks with no cells to update do not produce an estimator
+                    # file
+                    # print(f'Warning: Could not find {estfilepath.relative_to(modelpath.parent)}')
+                    return {}
 
     if printfilename:
         filesize = Path(estfilepath).stat().st_size / 1024 / 1024
@@ -298,14 +300,7 @@ def read_estimators(modelpath, modelgridindex=None, timestep=None, get_ion_value
                               get_ion_values=get_ion_values, get_heatingcooling=get_heatingcooling,
                               printfilename=printfilename)
 
-        if at.config['num_processes'] > 1:
-            with multiprocessing.Pool(processes=at.config['num_processes']) as pool:
-                arr_rankestimators = pool.map(processfile, mpiranklist)
-                pool.close()
-                pool.join()
-                pool.terminate()
-        else:
-            arr_rankestimators = [processfile(rank) for rank in mpiranklist]
+        arr_rankestimators = at.get_executor().map(processfile, mpiranklist)
 
         for mpirank, estimators_thisfile in zip(mpiranklist, arr_rankestimators):
             dupekeys = list(sorted([k for k in estimators_thisfile if k in estimators]))
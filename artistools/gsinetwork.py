@@ -9,7 +9,6 @@ import numpy as np
 # import io
 import pandas as pd
 # import math
-import multiprocessing
 from functools import partial
 from pathlib import Path
 import matplotlib.pyplot as plt
@@ -450,13 +449,7 @@ def do_modelcells(modelpath, mgiplotlist, arr_el_a):
 
     print(f'Reading trajectory data for {len(list_particleids_getabund)} particles with abundances')
 
-    if at.config['num_processes'] > 1:
-        with multiprocessing.Pool(processes=at.config['num_processes']) as pool:
-            list_particledata_withabund = pool.map(fworkerwithabund, list_particleids_getabund)
-            pool.close()
-            pool.join()
-    else:
-        list_particledata_withabund = [fworkerwithabund(particleid) for particleid in list_particleids_getabund]
+    list_particledata_withabund = at.get_executor().map(fworkerwithabund, list_particleids_getabund)
 
     list_particleids_noabund = [
         pid for pid in dfpartcontrib.particleid.unique() if pid not in list_particleids_getabund]
@@ -464,13 +457,7 @@ def do_modelcells(modelpath, mgiplotlist, arr_el_a):
     print(f'Reading trajectory data for {len(list_particleids_noabund)} '
           'particles for Qdot/thermal data (no abundances)')
 
-    if at.config['num_processes'] > 1:
-        with multiprocessing.Pool(processes=at.config['num_processes']) as pool:
-            list_particledata_noabund = pool.map(fworkernoabund, list_particleids_noabund)
-            pool.close()
-            pool.join()
-    else:
-        list_particledata_noabund = [fworkernoabund(particleid) for particleid in list_particleids_noabund]
+    list_particledata_noabund = at.get_executor().map(fworkernoabund, list_particleids_noabund)
 
     allparticledata = {
         particleid: data for particleid, data in (list_particledata_withabund + list_particledata_noabund)}
@@ -4,7 +4,6 @@
 import argcomplete
 import argparse
 import math
-import multiprocessing
 import tarfile
 import time
 from pathlib import Path
@@ -268,13 +267,7 @@ def add_abundancecontributions(dfgridcontributions, dfmodel, t_model_days, minpa
     timestart = time.perf_counter()
     trajnucabundworker = partial(get_trajectory_nuc_abund, t_model_s=t_model_s)
 
-    if at.config['num_processes'] > 1:
-        with multiprocessing.Pool(processes=at.config['num_processes']) as pool:
-            list_traj_nuc_abund = pool.map(trajnucabundworker, dfcontribs_particlegroups.groups)
-            pool.close()
-            pool.join()
-    else:
-        list_traj_nuc_abund = [trajnucabundworker(particleid) for particleid in dfcontribs_particlegroups.groups]
+    list_traj_nuc_abund = at.get_executor().map(trajnucabundworker, dfcontribs_particlegroups.groups)
 
     n_missing_particles = len([d for d in list_traj_nuc_abund if d is None])
     print(f'  {n_missing_particles} particles are missing network abundance data')
@@ -289,14 +282,10 @@ def add_abundancecontributions(dfgridcontributions, dfmodel, t_model_days, minpa
     dfcontribs_cellgroups = dfcontribs.groupby('cellindex')
     cellabundworker = partial(get_modelcellabundance, dict_traj_nuc_abund, minparticlespercell)
 
-    if at.config['num_processes'] > 1:
-        chunksize = math.ceil(len(dfcontribs_cellgroups) / at.config['num_processes'])
-        with multiprocessing.Pool(processes=at.config['num_processes']) as pool:
-            listcellnucabundances = pool.map(cellabundworker, dfcontribs_cellgroups, chunksize=chunksize)
-            pool.close()
-            pool.join()
-    else:
-        listcellnucabundances = [cellabundworker(cellgroup) for cellgroup in dfcontribs_cellgroups]
+    # one chunk per process, since the particle abundances dict is sent with each chunk
+    executor = at.get_executor()
+    listcellnucabundances = executor.map(
+        cellabundworker, dfcontribs_cellgroups, chunksize=math.ceil(len(dfcontribs_cellgroups) / executor.processes))
 
     listcellnucabundances = [x for x in listcellnucabundances if x is not None]
     print(f'  took {time.perf_counter() - timestart:.1f} seconds')
@@ -8,10 +8,14 @@ from artistools.lightcurve.lightcurve import (
     get_band_lightcurve,
     get_colour_delta_mag,
     get_filter_data,
+    get_from_accumulated,
     get_from_packets,
+    get_lum_from_accumulated,
+    get_packets_lightcurve_accumulators,
     get_phillips_relation_data,
     get_sn_sample_bol,
     get_spectrum_in_filter_range,
+    get_viewing_angle_lum_from_packets,
     plot_phillips_relation_data,
     read_3d_gammalightcurve,
     read_bol_reflightcurve_data,
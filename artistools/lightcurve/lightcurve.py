@@ -18,16 +18,16 @@ import artistools.spectra
 
 
 def readfile(filepath_or_buffer, modelpath=None, args=None):
-    lcdata = pd.read_csv(filepath_or_buffer, delim_whitespace=True, header=None, names=['time', 'lum', 'lum_cmf'])
-
     if args is not None and args.gamma and modelpath is not None and at.get_inputparams(modelpath)['n_dimensions'] == 3:
         lcdata = read_3d_gammalightcurve(filepath_or_buffer)
 
     elif args is not None and args.plotviewingangle is not None:
         # get a list of dfs with light curves at each viewing angle
-        lcdata = at.gather_res_data(lcdata, index_of_repeated_value=0)
+        lcdata = [pd.DataFrame(lcarray, columns=['time', 'lum', 'lum_cmf'])
+                  for lcarray in at.read_res_data(filepath_or_buffer, index_of_repeated_value=0)]
 
     else:
+        lcdata = pd.read_csv(filepath_or_buffer, delim_whitespace=True, header=None, names=['time', 'lum', 'lum_cmf'])
         # the light_curve.dat file repeats x values, so keep the first half only
         lcdata = lcdata.iloc[:len(lcdata) // 2]
         lcdata.index.name = 'timestep'
@@ -35,28 +35,22 @@ def readfile(filepath_or_buffer, modelpath=None, args=None):
 
 
 def read_3d_gammalightcurve(filepath_or_buffer):
-    columns = ['time']
-    columns.extend(np.arange(0, 100))
-    lcdata = pd.read_csv(filepath_or_buffer, delim_whitespace=True, header=None)
-    lcdata.columns = columns
-    # lcdata = lcdata.rename(columns={0: 'time', 1: 'lum', 2: 'lum_cmf'})
-
-    res_data = []
-    for angle in np.arange(0, 100):
-        res_data.append(lcdata[['time', angle]].copy())
-        res_data[angle] = res_data[angle].rename(columns={angle: 'lum'})
+    # the columns are the time and the luminosity of each of the 100 angle bins
+    lcarray = at.read_res_data(filepath_or_buffer, index_of_repeated_value=0)
+    lcarray = lcarray.reshape(-1, lcarray.shape[2])
+
+    res_data = [pd.DataFrame({'time': lcarray[:, 0], 'lum': lcarray[:, 1 + angle]})
+                for angle in range(lcarray.shape[1] - 1)]
     print(res_data)
 
     return res_data
 
 
-def get_from_packets(modelpath, lcpath, packet_type='TYPE_ESCAPE', escape_type='TYPE_RPKT', maxpacketfiles=None):
-    import artistools.packets
-
-    packetsfiles = at.packets.get_packetsfilepaths(modelpath, maxpacketfiles=maxpacketfiles)
-    nprocs_read = len(packetsfiles)
-    assert nprocs_read > 0
+def get_packets_lightcurve_accumulators(modelpath, packet_type='TYPE_ESCAPE', escape_type='TYPE_RPKT', nabins=None):
+    """Return the packets accumulators for the bolometric light curve, which can be filled along with other products
+    in one pass with at.packets.accumulate_packets(). The results are converted with get_from_accumulated().
 
+    With nabins, the packets are also binned by viewing angle, giving (angle bin, time bin) histograms."""
     timearray = at.get_timestep_times_float(modelpath=modelpath, loc='mid')
     arr_timedelta = at.get_timestep_times_float(modelpath=modelpath, loc='delta')
     # timearray = np.arange(250, 350, 0.1)
@@ -65,31 +59,82 @@ def get_from_packets(modelpath, lcpath, packet_type='TYPE_ESCAPE', escape_type='
     betafactor = math.sqrt(1 - (vmax / const.c).decompose().value ** 2)
 
     timearrayplusend = np.concatenate([timearray, [timearray[-1] + arr_timedelta[-1]]])
+    anglebins = [] if nabins is None else [('angle_bin', nabins)]
+
+    return {
+        'lightcurve_lum': at.packets.make_accumulator(
+            bins=[*anglebins, ('t_arrive_d', timearrayplusend)], weightcolumn='e_rf', type=packet_type,
+            escape_type=escape_type),
+        # the comoving frame arrival time in days is escape_time * betafactor / DAY
+        'lightcurve_lum_cmf': at.packets.make_accumulator(
+            bins=[*anglebins, ('escape_time', timearrayplusend / betafactor / u.s.to('day'))], weightcolumn='e_cmf',
+            type=packet_type, escape_type=escape_type),
+    }
+
+
+def get_lum_from_accumulated(modelpath, results, nprocs_read):
+    """Return the time bin midpoints and the rest frame and comoving frame luminosities [Lsun] from the histograms of
+    get_packets_lightcurve_accumulators(). The luminosities have time as the last axis."""
+    timearray = at.get_timestep_times_float(modelpath=modelpath, loc='mid')
+    arr_timedelta = at.get_timestep_times_float(modelpath=modelpath, loc='delta')
+    model, _, _ = at.inputmodel.get_modeldata(modelpath)
+    vmax = model.iloc[-1].velocity_outer * u.km / u.s
+    betafactor = math.sqrt(1 - (vmax / const.c).decompose().value ** 2)
 
-    lcdata = pd.DataFrame({'time': timearray,
-                           'lum': np.zeros_like(timearray, dtype=float),
-                           'lum_cmf': np.zeros_like(timearray, dtype=float)})
+    lum = results['lightcurve_lum'] / nprocs_read * (u.erg / u.day).to('solLum') / arr_timedelta
+    lum_cmf = results['lightcurve_lum_cmf'] / nprocs_read / betafactor * (u.erg / u.day).to('solLum') / arr_timedelta
 
-    for packetsfile in packetsfiles:
-        dfpackets = at.packets.readfile(packetsfile, type=packet_type, escape_type=escape_type)
+    return timearray, lum, lum_cmf
 
-        if not (dfpackets.empty):
-            print(f"sum of e_cmf {dfpackets['e_cmf'].sum()} e_rf {dfpackets['e_rf'].sum()}")
 
-            binned = pd.cut(dfpackets['t_arrive_d'], timearrayplusend, labels=False, include_lowest=True)
-            for binindex, e_rf_sum in dfpackets.groupby(binned)['e_rf'].sum().iteritems():
-                lcdata['lum'][binindex] += e_rf_sum
+def get_from_accumulated(modelpath, results, nprocs_read):
+    """Convert the histograms of get_packets_lightcurve_accumulators() into a light curve DataFrame."""
+    timearray, lum, lum_cmf = get_lum_from_accumulated(modelpath, results, nprocs_read)
 
-            dfpackets['t_arrive_cmf_d'] = dfpackets['escape_time'] * betafactor * u.s.to('day')
+    return pd.DataFrame({'time': timearray, 'lum': lum, 'lum_cmf': lum_cmf})
 
-            binned_cmf = pd.cut(dfpackets['t_arrive_cmf_d'], timearrayplusend, labels=False, include_lowest=True)
-            for binindex, e_cmf_sum in dfpackets.groupby(binned_cmf)['e_cmf'].sum().iteritems():
-                lcdata['lum_cmf'][binindex] += e_cmf_sum
 
-    lcdata['lum'] = np.divide(lcdata['lum'] / nprocs_read * (u.erg / u.day).to('solLum'), arr_timedelta)
-    lcdata['lum_cmf'] = np.divide(lcdata['lum_cmf'] / nprocs_read / betafactor * (u.erg / u.day).to('solLum'),
-                                  arr_timedelta)
-    return lcdata
+def get_viewing_angle_lum_from_packets(modelpath, nabins=100, packet_type='TYPE_ESCAPE', escape_type='TYPE_RPKT',
+                                       maxpacketfiles=None, packetfraction=None):
+    """Return the time bin midpoints and the rest frame and comoving frame luminosities [Lsun] as
+    (angle bin, time bin) arrays, binning the packets by viewing angle and arrival time in one pass.
+
+    As in light_curve_res.out, the luminosity of each angle bin is the isotropic-equivalent luminosity,
+    i.e., the luminosity of the packets escaping into the bin multiplied by nabins.
+    """
+    accumulators = get_packets_lightcurve_accumulators(
+        modelpath, packet_type=packet_type, escape_type=escape_type, nabins=nabins)
+
+    # the timestep bins are the same for every light curve of the model, so the histograms are worth caching
+    results, nprocs_read = at.packets.accumulate_packets(
+        modelpath, accumulators, maxpacketfiles=maxpacketfiles, packetfraction=packetfraction, cache=True)
+    assert nprocs_read > 0
+
+    timearray, lum, lum_cmf = get_lum_from_accumulated(modelpath, results, nprocs_read)
+
+    return timearray, lum * nabins, lum_cmf * nabins
+
+
+def get_from_packets(modelpath, lcpath, packet_type='TYPE_ESCAPE', escape_type='TYPE_RPKT', maxpacketfiles=None,
+                     packetfraction=None, nabins=None):
+    """Return the light curve DataFrame from the packets files, or with nabins, a list of light curve
+    DataFrames for each viewing angle bin (as readfile() does for light_curve_res.out)."""
+    if nabins is not None:
+        timearray, lum, lum_cmf = get_viewing_angle_lum_from_packets(
+            modelpath, nabins=nabins, packet_type=packet_type, escape_type=escape_type, maxpacketfiles=maxpacketfiles,
+            packetfraction=packetfraction)
+
+        return [pd.DataFrame({'time': timearray, 'lum': lum[angle], 'lum_cmf': lum_cmf[angle]})
+                for angle in range(nabins)]
+
+    accumulators = get_packets_lightcurve_accumulators(modelpath, packet_type=packet_type, escape_type=escape_type)
+
+    # the timestep bins are the same for every light curve of the model, so the histograms are worth caching
+    results, nprocs_read = at.packets.accumulate_packets(
+        modelpath, accumulators, maxpacketfiles=maxpacketfiles, packetfraction=packetfraction, cache=True)
+    assert nprocs_read > 0
+
+    return get_from_accumulated(modelpath, results, nprocs_read)
 
 
 def generate_band_lightcurve_data(modelpath, args, angle=None, modelnumber=None):
@@ -102,9 +147,7 @@ def generate_band_lightcurve_data(modelpath, args, angle=None, modelnumber=None)
         vspecdata = stokes_params['I']
         timearray = vspecdata.keys()[1:]
     elif args and args.plotviewingangle and os.path.isfile(modelpath / 'specpol_res.out'):
-        specfilename = os.path.join(modelpath, "specpol_res.out")
-        specdataresdata = pd.read_csv(specfilename, delim_whitespace=True)
-        timearray = [i for i in specdataresdata.columns.values[1:] if i[-2] != '.']
+        _, timearray, _ = at.spectra.read_specpol_res_arrays(modelpath)
     # elif Path(modelpath, 'specpol.out').is_file():
     #     specfilename = os.path.join(modelpath, "specpol.out")
     #     specdata = pd.read_csv(specfilename, delim_whitespace=True)
@@ -124,18 +167,9 @@ def generate_band_lightcurve_data(modelpath, args, angle=None, modelnumber=None)
 
     filters_list = args.filter
 
-    if angle is not None and os.path.isfile(modelpath / 'specpol_res.out'):
-        res_specdata = at.spectra.read_specpol_res(modelpath)
-        if args and args.average_every_tenth_viewing_angle:
-            at.spectra.average_angle_bins(res_specdata, angle, args)
-
-    else:
-        res_specdata = None
-
     for filter_name in filters_list:
         if filter_name == 'bol':
-            times, bol_magnitudes = bolometric_magnitude(modelpath, timearray, args, angle=angle,
-                                                         res_specdata=res_specdata)
+            times, bol_magnitudes = bolometric_magnitude(modelpath, timearray, args, angle=angle)
             filters_dict['bol'] = [
                 (time, bol_magnitude) for time, bol_magnitude in
                 zip(times, bol_magnitudes)
@@ -156,7 +190,7 @@ def generate_band_lightcurve_data(modelpath, args, angle=None, modelnumber=None)
             if args.timemin < time < args.timemax:
                 wavelength_from_spectrum, flux = \
                     get_spectrum_in_filter_range(modelpath, timestep, time, wavefilter_min, wavefilter_max, angle,
-                                                 res_specdata=res_specdata, modelnumber=modelnumber, args=args)
+                                                 modelnumber=modelnumber, args=args)
 
                 if len(wavelength_from_spectrum) > len(wavefilter):
                     interpolate_fn = interp1d(wavefilter, transmission, bounds_error=False, fill_value=0.)
@@ -193,12 +227,8 @@ def bolometric_magnitude(modelpath, timearray, args, angle=None, res_specdata=No
                 if args.plotvspecpol:
                     spectrum = at.spectra.get_vspecpol_spectrum(modelpath, time, angle, args)
                 else:
-                    if res_specdata is None:
-                        res_specdata = at.spectra.read_specpol_res(modelpath)
-                        if args and args.average_every_tenth_viewing_angle:
-                            at.spectra.average_angle_bins(res_specdata, angle, args)
                     spectrum = at.spectra.get_res_spectrum(modelpath, timestep, timestep, angle=angle,
-                                                           res_specdata=res_specdata)
+                                                           res_specdata=res_specdata, args=args)
             else:
                 spectrum = at.spectra.get_spectrum(modelpath, timestep, timestep)
 
@@ -90,7 +90,8 @@ def make_lightcurve_plot_from_lightcurve_out_files(modelpaths, filenameout, from
             continue
         elif frompackets:
             lcdata = at.lightcurve.get_from_packets(
-                modelpath, lcpath, packet_type=args.packet_type, escape_type=escape_type, maxpacketfiles=maxpacketfiles)
+                modelpath, lcpath, packet_type=args.packet_type, escape_type=escape_type, maxpacketfiles=maxpacketfiles,
+                packetfraction=args.packetfraction, nabins=100 if args.plotviewingangle is not None else None)
         else:
             lcdata = at.lightcurve.readfile(lcpath, modelpath, args)
 
@@ -993,6 +994,9 @@ def addargs(parser):
     parser.add_argument('-maxpacketfiles', type=int, default=None,
                         help='Limit the number of packet files read')
 
+    parser.add_argument('-packetfraction', type=float, default=None,
+                        help='Use a random fraction of the packets in every file for a quick preview (e.g. 0.01)')
+
     parser.add_argument('--gamma', action='store_true',
                         help='Make light curve from gamma rays instead of R-packets')
 
@@ -10,19 +10,16 @@ from astropy import units as u
 
 
 def get_bol_lc_from_spec(modelpath):
-    res_specdata = at.spectra.read_specpol_res(modelpath)
-    # print(res_specdata)
-    timearray = res_specdata[0].columns.values[1:]
+    _, timearray, stokes_params = at.spectra.read_specpol_res_arrays(modelpath)
     times = [time for time in timearray if 5 < float(time) < 80]
     lightcurvedata = {'time': times}
 
-    for angle in range(len(res_specdata)):
+    for angle in range(len(stokes_params['I'])):
         bol_luminosity = []
         for timestep, time in enumerate(timearray):
             time = float(time)
             if 5 < time < 80:
-                spectrum = at.spectra.get_res_spectrum(modelpath, timestep, timestep, angle=angle,
-                                                       res_specdata=res_specdata)
+                spectrum = at.spectra.get_res_spectrum(modelpath, timestep, timestep, angle=angle)
                 integrated_flux = np.trapz(spectrum['f_lambda'], spectrum['lambda_angstroms'])
                 integrated_luminosity = integrated_flux * 4 * np.pi * np.power(u.Mpc.to('cm'), 2)
                 bol_luminosity.append(integrated_luminosity)
@@ -41,8 +38,8 @@ def get_bol_lc_from_lightcurveout(modelpath, res=False):
         lcfilename = "light_curve_res.out"
     else:
         lcfilename = "light_curve.out"
-    lcdata = pd.read_csv(modelpath / lcfilename, delim_whitespace=True, header=None, names=['time', 'lum', 'lum_cmf'])
-    lcdataframes = at.gather_res_data(lcdata, index_of_repeated_value=0)
+    lcdataframes = [pd.DataFrame(lcarray, columns=['time', 'lum', 'lum_cmf'])
+                    for lcarray in at.read_res_data(modelpath / lcfilename, index_of_repeated_value=0)]
 
     times = lcdataframes[0]['time']
     lightcurvedata = {'time': times}
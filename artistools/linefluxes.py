@@ -6,7 +6,6 @@ import math
 import multiprocessing
 from collections import namedtuple
 # from functools import lru_cache
-from functools import partial
 from pathlib import Path
 
 import matplotlib as mpl
@@ -21,52 +20,28 @@ import artistools as at
 import artistools.packets
 
 
-def get_packets_with_emtype_onefile(emtypecolumn, lineindices, packetsfile):
-    import gzip
-    try:
-        dfpackets = at.packets.readfile(packetsfile, type='TYPE_ESCAPE', escape_type='TYPE_RPKT')
-    except gzip.BadGzipFile:
-        print(f'Bad file: {packetsfile}')
-        raise gzip.BadGzipFile
-
-    return dfpackets.query(f'{emtypecolumn} in @lineindices', inplace=False).copy()
-
-
 @at.diskcache(savezipped=True)
-def get_packets_with_emtype(modelpath, emtypecolumn, lineindices, maxpacketfiles=None):
-    packetsfiles = at.packets.get_packetsfilepaths(modelpath, maxpacketfiles=maxpacketfiles)
-    nprocs_read = len(packetsfiles)
+def get_packets_with_emtype(modelpath, emtypecolumn, lineindices, maxpacketfiles=None, filters=None):
+    """Return the escaped r-packets with emtypecolumn in lineindices (and matching any other filters)."""
+    packetsscan = at.packets.scan(modelpath, type='TYPE_ESCAPE', escape_type='TYPE_RPKT', maxpacketfiles=maxpacketfiles)
+    nprocs_read = len(packetsscan.packetsfiles)
     assert nprocs_read > 0
 
-    model, _, _ = at.inputmodel.get_modeldata(modelpath)
-    # vmax = model.iloc[-1].velocity_outer * u.km / u.s
-    processfile = partial(get_packets_with_emtype_onefile, emtypecolumn, lineindices)
-    if at.config['num_processes'] > 1:
-        print(f"Reading packets files with {at.config['num_processes']} processes")
-        with multiprocessing.Pool(processes=at.config['num_processes']) as pool:
-            arr_dfmatchingpackets = pool.map(processfile, packetsfiles)
-            pool.close()
-            pool.join()
-            # pool.terminate()
+    # only the columns needed for the emission time and cell of each packet are read
+    if emtypecolumn == 'emissiontype':
+        emcolumns = ['em_posx', 'em_posy', 'em_posz', 'em_time']
     else:
-        arr_dfmatchingpackets = [processfile(f) for f in packetsfiles]
+        emcolumns = ['em_time', 'true_emission_velocity']
 
-    dfmatchingpackets = pd.concat(arr_dfmatchingpackets)
+    # vmax = model.iloc[-1].velocity_outer * u.km / u.s
+    dfmatchingpackets = packetsscan.filter((emtypecolumn, 'in', lineindices), *at.makelist(filters)).select(
+        emtypecolumn, 't_arrive_d', 'e_rf', *emcolumns).collect()
 
     return dfmatchingpackets, nprocs_read
 
 
-def calculate_timebinned_packet_sum(dfpackets, timearrayplusend):
-    binned = pd.cut(dfpackets['t_arrive_d'], timearrayplusend, labels=False, include_lowest=True)
-
-    binnedenergysums = np.zeros_like(timearrayplusend[:-1], dtype=float)
-    for binindex, e_rf_sum in dfpackets.groupby(binned)['e_rf'].sum().iteritems():
-        binnedenergysums[int(binindex)] = e_rf_sum
-
-    return binnedenergysums
-
-
-def get_line_fluxes_from_packets(emtypecolumn, emfeatures, modelpath, maxpacketfiles=None, arr_tstart=None, arr_tend=None):
+def get_line_fluxes_from_packets(emtypecolumn, emfeatures, modelpath, maxpacketfiles=None, arr_tstart=None,
+                                 arr_tend=None, packetfraction=None):
     if arr_tstart is None:
         arr_tstart = at.get_timestep_times_float(modelpath, loc='start')
     if arr_tend is None:
@@ -75,7 +50,6 @@ def get_line_fluxes_from_packets(emtypecolumn, emfeatures, modelpath, maxpacketf
     arr_timedelta = np.array(arr_tend) - np.array(arr_tstart)
     arr_tmid = arr_tend = (np.array(arr_tstart) + np.array(arr_tend)) / 2.
 
-    model, _, _ = at.inputmodel.get_modeldata(modelpath)
     # vmax = model.iloc[-1].velocity_outer * u.km / u.s
     # betafactor = math.sqrt(1 - (vmax / const.c).decompose().value ** 2)
 
@@ -85,19 +59,28 @@ def get_line_fluxes_from_packets(emtypecolumn, emfeatures, modelpath, maxpacketf
 
     linelistindices_allfeatures = tuple([l for feature in emfeatures for l in feature.linelistindices])
 
-    dfpackets, nprocs_read = get_packets_with_emtype(
-            modelpath, emtypecolumn, linelistindices_allfeatures, maxpacketfiles=maxpacketfiles)
+    # the packets file workers return only the binned energy sums of each line, instead of the packets
+    accumulators = {'line_energysums': at.packets.make_accumulator(
+        bins=[('t_arrive_d', timearrayplusend)], groupbycolumn=emtypecolumn,
+        filters=[(emtypecolumn, 'in', linelistindices_allfeatures)])}
+
+    results, nprocs_read = at.packets.accumulate_packets(
+        modelpath, accumulators, maxpacketfiles=maxpacketfiles, packetfraction=packetfraction)
+    assert nprocs_read > 0
+    dict_line_energysums = results['line_energysums']
 
     for feature in emfeatures:
         # dictlcdata[feature.colname] = np.zeros_like(arr_tstart, dtype=float)
 
-        dfpackets_selected = dfpackets.query(f'{emtypecolumn} in @feature.linelistindices', inplace=False)
-
         normfactor = 1. / nprocs_read
         # mpc_to_cm = 3.085677581491367e+24  # 1 megaparsec in cm
         # normfactor = 1. / 4 / math.pi / (mpc_to_cm ** 2) / nprocs_read
 
-        energysumsreduced = calculate_timebinned_packet_sum(dfpackets_selected, timearrayplusend)
+        energysumsreduced = np.zeros_like(timearrayplusend[:-1], dtype=float)
+        for lineindex in set(feature.linelistindices):
+            if lineindex in dict_line_energysums:
+                energysumsreduced += dict_line_energysums[lineindex]
+
         # print(energysumsreduced, arr_timedelta)
         fluxdata = np.divide(energysumsreduced * normfactor, arr_timedelta * u.day.to('s'))
         dictlcdata[feature.colname] = fluxdata
@@ -264,7 +247,8 @@ def make_flux_ratio_plot(args):
             dflcdata = get_line_fluxes_from_packets(args.emtypecolumn, emfeatures, modelpath,
                                                     maxpacketfiles=args.maxpacketfiles,
                                                     arr_tstart=args.timebins_tstart,
-                                                    arr_tend=args.timebins_tend)
+                                                    arr_tend=args.timebins_tend,
+                                                    packetfraction=args.packetfraction)
 
         dflcdata.eval(f'fratio = {emfeatures[1].colname} / {emfeatures[0].colname}', inplace=True)
         axis.set_ylabel(r'F$_{\mathrm{' + emfeatures[1].featurelabel + r'}}$ / F$_{\mathrm{' +
@@ -377,27 +361,21 @@ def get_packets_with_emission_conditions(modelpath, emtypecolumn, lineindices, t
 
     em_mgicolumn = 'em_modelgridindex' if emtypecolumn == 'emissiontype' else 'emtrue_modelgridindex'
 
+    # the arrival time range is applied by the packets file workers, so that only the selected packets are returned
     dfpackets_selected, _ = get_packets_with_emtype(
-        modelpath, emtypecolumn, lineindices, maxpacketfiles=maxpacketfiles)
-
-    dfpackets_selected = dfpackets_selected.query(
-        't_arrive_d >= @tstart and t_arrive_d <= @tend', inplace=False).copy()
+        modelpath, emtypecolumn, lineindices, maxpacketfiles=maxpacketfiles,
+        filters=[('t_arrive_d', '>=', tstart), ('t_arrive_d', '<=', tend)])
 
     dfpackets_selected = at.packets.add_derived_columns(dfpackets_selected, modelpath, ['em_timestep', em_mgicolumn],
                                                         allnonemptymgilist=allnonemptymgilist)
 
     if not dfpackets_selected.empty:
-        def em_lognne(packet):
-            # return interp_log10nne[packet.em_timestep](packet.true_emission_velocity)
-            return math.log10(estimators[(int(packet['em_timestep']), int(packet[em_mgicolumn]))]['nne'])
+        # the (timestep, modelgridindex) estimator keys at the emission time and place of each packet
+        em_keys = list(zip(dfpackets_selected['em_timestep'].astype(int), dfpackets_selected[em_mgicolumn].astype(int)))
 
-        dfpackets_selected['em_log10nne'] = dfpackets_selected.apply(em_lognne, axis=1)
+        dfpackets_selected['em_log10nne'] = [math.log10(estimators[key]['nne']) for key in em_keys]
 
-        def em_Te(packet):
-            # return interp_te[packet.em_timestep](packet.true_emission_velocity)
-            return estimators[(int(packet['em_timestep']), int(packet[em_mgicolumn]))]['Te']
-
-        dfpackets_selected['em_Te'] = dfpackets_selected.apply(em_Te, axis=1)
+        dfpackets_selected['em_Te'] = [estimators[key]['Te'] for key in em_keys]
 
     return dfpackets_selected
 
@@ -672,6 +650,9 @@ def addargs(parser):
     parser.add_argument('-maxpacketfiles', type=int, default=None,
                         help='Limit the number of packet files read')
 
+    parser.add_argument('-packetfraction', type=float, default=None,
+                        help='Use a random fraction of the packets in every file for a quick preview (e.g. 0.01)')
+
     parser.add_argument('-emfeaturesearch', default=[], nargs='*',
                         help='List of tuples (TODO explain)')
 
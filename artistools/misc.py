@@ -1,18 +1,23 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
 from functools import lru_cache
 import gzip
 # import inspect
+import io
 import lzma
 import math
+import multiprocessing
 import os.path
+import shutil
+import subprocess
 import sys
 import time
 from collections import namedtuple
 from itertools import chain
 from functools import wraps
-# from functools import partial
+from functools import partial
 import matplotlib.pyplot as plt
 from pathlib import Path
 from typing import Iterable
@@ -195,6 +200,91 @@ def diskcache(ignoreargs=[], ignorekwargs=[], saveonly=False, quiet=False, savez
     return diskcacheinner
 
 
+def run_with_config(config, func, *args):
+    """Call func in a worker process after copying the parent's at.config (which may have changed since the
+    worker started)."""
+    at.config.update(config)
+    return func(*args)
+
+
+class SerialExecutor:
+    """Stand-in for the process pool that runs tasks one at a time in the current process."""
+
+    processes = 1
+
+    def map(self, func, iterable, chunksize=None):
+        return [func(item) for item in iterable]
+
+
+class PoolExecutor:
+    """Process pool that is kept alive between calls, so that the worker start-up cost is only paid once."""
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.pool = multiprocessing.Pool(processes=processes)
+
+    def map(self, func, iterable, chunksize=None):
+        """Like Pool.map(), but passes the current at.config to the workers.
+
+        The default chunksize gives each process about four chunks, to balance the load of unequal tasks
+        against the overhead of sending many small ones."""
+        items = list(iterable)
+        if chunksize is None:
+            chunksize = max(1, math.ceil(len(items) / (4 * self.processes)))
+
+        return self.pool.map(partial(run_with_config, dict(at.config), func), items, chunksize=chunksize)
+
+    def shutdown(self):
+        self.pool.close()
+        self.pool.join()
+
+
+_executor = None
+
+
+def get_executor():
+    """Return the process pool shared by all parallel artistools functions, creating it on first use.
+
+    Tasks are run serially if at.config['num_processes'] is one, or if this is already a pool worker
+    (which cannot start its own processes). The pool is recreated if num_processes is changed.
+    """
+    global _executor
+
+    if at.config['num_processes'] <= 1 or multiprocessing.current_process().daemon:
+        return SerialExecutor()
+
+    if _executor is None or _executor.processes != at.config['num_processes']:
+        shutdown_executor()
+        _executor = PoolExecutor(processes=at.config['num_processes'])
+
+    return _executor
+
+
+def shutdown_executor():
+    """Close the shared process pool (if started) after its tasks are finished."""
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+
+
+atexit.register(shutdown_executor)
+
+
+# the engines that can parse text files and aggregate packets (the results are always pandas DataFrames)
+dataframe_backends = ('pandas', 'pyarrow', 'polars')
+
+
+def get_dataframe_backend():
+    """Return at.config['dataframe_backend'], checking that it is one of dataframe_backends."""
+    backend = at.config['dataframe_backend']
+    if backend not in dataframe_backends:
+        raise ValueError(f"Unknown dataframe_backend '{backend}'. Use one of {dataframe_backends}")
+
+    return backend
+
+
 class CustomArgHelpFormatter(argparse.ArgumentDefaultsHelpFormatter):
     def add_arguments(self, actions):
         def my_sort(arg):
@@ -319,6 +409,61 @@ def gather_res_data(res_df, index_of_repeated_value=1):
     return res_data
 
 
+def get_res_data_cache_path(filepath):
+    filepath = Path(filepath)
+    return Path(filepath.parent, '__artistoolscache__.nosync', f'{filepath.name}.resdata.npz')
+
+
+def parse_res_data(filepath, index_of_repeated_value=1):
+    """Return the numbers in a res file (e.g. specpol_res.out or light_curve_res.out) as a (block, row, column) array.
+    As for gather_res_data, each block (viewing angle) starts at a row that repeats the value of the first row in
+    column index_of_repeated_value. The file can also be a buffer or file-like object."""
+    if isinstance(filepath, (str, os.PathLike)):
+        with zopen(filepath, 'rt', seekable=False) as fres:
+            arrdata = pd.read_csv(fres, delim_whitespace=True, header=None, dtype=float).to_numpy()
+    else:
+        arrdata = pd.read_csv(filepath, delim_whitespace=True, header=None, dtype=float).to_numpy()
+
+    blockstarts = np.flatnonzero(arrdata[:, index_of_repeated_value] == arrdata[0, index_of_repeated_value])
+    blocklength = len(arrdata) // len(blockstarts)
+    if (len(arrdata) % len(blockstarts) != 0 or
+            not np.array_equal(blockstarts, np.arange(len(blockstarts)) * blocklength)):
+        raise ValueError(f'{filepath} does not consist of blocks of equal length')
+
+    return arrdata.reshape(len(blockstarts), blocklength, arrdata.shape[1])
+
+
+def read_res_data(filepath, index_of_repeated_value=1):
+    """Return the (block, row, column) array of a res file (see parse_res_data).
+
+    With the disk cache enabled, the array is saved next to the disk cache and regenerated if the res file size
+    or modification time change. Buffers and file-like objects are always parsed without the cache.
+    """
+    if not at.config['enable_diskcache'] or not isinstance(filepath, (str, os.PathLike)):
+        return parse_res_data(filepath, index_of_repeated_value=index_of_repeated_value)
+
+    filepath = Path(filepath)
+
+    cachepath = get_res_data_cache_path(filepath)
+    if cachepath.is_file():
+        with np.load(cachepath) as cachedata:
+            if (cachedata['filesize'] == filepath.stat().st_size and
+                    cachedata['mtime'] == filepath.stat().st_mtime and
+                    cachedata['index_of_repeated_value'] == index_of_repeated_value):
+                return cachedata['resdata']
+
+    print(f'Reading {filepath}')
+    resdata = parse_res_data(filepath, index_of_repeated_value=index_of_repeated_value)
+
+    cachepath.parent.mkdir(exist_ok=True)
+    cachepathtmp = cachepath.with_suffix('.tmp.npz')
+    np.savez(cachepathtmp, filesize=filepath.stat().st_size, mtime=filepath.stat().st_mtime,
+             index_of_repeated_value=index_of_repeated_value, resdata=resdata)
+    os.replace(cachepathtmp, cachepath)
+
+    return resdata
+
+
 def match_closest_time(reftime, searchtimes):
     """Get time closest to reftime in list of times (searchtimes)"""
     return str("{}".format(min([float(x) for x in searchtimes], key=lambda x: abs(x - reftime))))
@@ -787,21 +932,108 @@ def flatten_list(listin):
     return listout
 
 
-def zopen(filename, mode):
-    """Open filename.xz, filename.gz or filename."""
-    filenamexz = str(filename) if str(filename).endswith(".xz") else str(filename) + '.xz'
-    filenamegz = str(filename) if str(filename).endswith(".gz") else str(filename) + '.gz'
-    if os.path.exists(filenamexz):
-        return lzma.open(filenamexz, mode)
-    elif os.path.exists(filenamegz):
-        return gzip.open(filenamegz, mode)
+# compressed files are looked for with these suffixes (in order of preference) when opening uncompressed file names.
+# Zstandard needs an optional package, so it comes after the formats that Python can always read
+compression_suffixes = ('.xz', '.gz', '.zst')
+
+
+class DecompressionPipe(io.RawIOBase):
+    """Read-only binary stream of the output of an external decompression program, which is stopped when closed."""
+
+    def __init__(self, command):
+        super().__init__()
+        self.command = command
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        nbytes = self.process.stdout.readinto(b)
+        if nbytes == 0 and self.process.wait() != 0:
+            raise OSError(f"{' '.join(self.command)} failed: {self.process.stderr.read().decode().strip()}")
+        return nbytes
+
+    def close(self):
+        if not self.closed:
+            self.process.stdout.close()
+            if self.process.poll() is None:
+                self.process.terminate()
+            self.process.wait()
+            self.process.stderr.close()
+        super().close()
+
+
+def get_decompression_threads():
+    """Return the number of threads for an external decompression program (see config['decompression_threads']).
+
+    The default of 0 uses all cores, except in pool workers, where each worker gets an equal share of the cores so
+    that the workers together do not start more threads than there are cores.
+    """
+    threads = at.config['decompression_threads']
+    if threads == 0 and multiprocessing.current_process().daemon:
+        threads = max(1, (os.cpu_count() or 1) // at.config['num_processes'])
+
+    return threads or os.cpu_count() or 1
+
+
+def get_decompression_command(filename):
+    """Return the command for a multithreaded external program that decompresses filename to stdout, or None if
+    no suitable program is installed."""
+    threads = get_decompression_threads()
+    suffix = Path(filename).suffix
+    if suffix == '.xz' and shutil.which('xz'):
+        # multithreaded decompression needs xz >= 5.4 and files compressed in multiple blocks (see recompress.py)
+        return ['xz', '--decompress', '--stdout', f'--threads={threads}', str(filename)]
+    elif suffix == '.gz' and shutil.which('pigz'):
+        return ['pigz', '--decompress', '--stdout', f'--processes={threads}', str(filename)]
+    elif suffix == '.zst' and shutil.which('zstd'):
+        return ['zstd', '--decompress', '--stdout', '--quiet', str(filename)]
+
+    return None
+
+
+def zopen(filename, mode, seekable=True):
+    """Open filename.xz, filename.gz, filename.zst or filename.
+
+    Reading .zst files needs the optional zstandard package, or the zstd program for sequential reads.
+
+    If seekable is False, a compressed file that is being read is decompressed by a multithreaded external
+    program (xz, pigz, or zstd) if one is available and config['use_external_decompressors'] is True. The file can
+    then only be read sequentially, without seek() or tell().
+    """
+    filename = str(filename)
+    for suffix in compression_suffixes:
+        filenamecompressed = filename if filename.endswith(suffix) else filename + suffix
+        if os.path.exists(filenamecompressed):
+            break
     else:
         return open(filename, mode)
 
+    if not seekable and 'r' in mode and at.config['use_external_decompressors']:
+        command = get_decompression_command(filenamecompressed)
+        if command is not None:
+            fpipe = io.BufferedReader(DecompressionPipe(command), buffer_size=1024 * 1024)
+            return io.TextIOWrapper(fpipe) if 't' in mode else fpipe
+
+    if suffix == '.zst':
+        try:
+            import zstandard
+        except ImportError as ex:
+            raise ImportError(f'Reading {filenamecompressed} needs the zstandard package '
+                              '(or the zstd program for sequential reads)') from ex
+        return zstandard.open(filenamecompressed, mode)
+    elif suffix == '.xz':
+        return lzma.open(filenamecompressed, mode)
+
+    return gzip.open(filenamecompressed, mode)
+
 
 def firstexisting(filelist, path=Path('.')):
-    """Return the first existing file in file list."""
+    """Return the first existing file in file list, or a .zst compressed version of an uncompressed file in the
+    list."""
     fullpaths = [Path(path) / filename for filename in filelist]
+    fullpaths += [Path(str(fullpath) + '.zst') for fullpath in fullpaths if fullpath.suffix not in compression_suffixes]
     for fullpath in fullpaths:
         if fullpath.exists():
             return fullpath
@@ -964,6 +1196,115 @@ def get_linelist(modelpath, returntype='dict'):
         return dflinelist
 
 
+# the emission type code of free-free emission in packets files
+EMTYPE_FREEFREE = -9999999
+
+processgroupstuple = namedtuple('processgroups', 'labels groupids codeoffset absorption')
+
+
+@lru_cache(maxsize=16)
+def get_process_groups(modelpath, groupby='ion', absorption=False):
+    """Return the labels of the process groups (e.g. 'Fe II bound-bound') for grouping packets by their emission
+    (or absorption) type, and a dense array of the group index of every type code (see get_process_group_ids).
+
+    groupby is 'ion' (or None), 'line', 'upperterm', or 'terms'. Emission types are a linelist index, -1 - bfindex
+    for bound-free, or EMTYPE_FREEFREE. Absorption types are a linelist index, -1 for free-free, or -2 for
+    bound-free, and are grouped by ion unless groupby is 'line'. Level term names are found once for each ion.
+    """
+    assert groupby in [None, 'ion', 'line', 'upperterm', 'terms']
+    if absorption and groupby != 'line':
+        groupby = 'ion'
+
+    dflinelist = get_linelist(modelpath, returntype='dataframe')
+    ionstrings = {(Z, ionstage): get_ionstring(Z, ionstage) for Z, ionstage in
+                  dflinelist[['atomic_number', 'ionstage']].drop_duplicates().itertuples(index=False)}
+    arr_ionstring = [ionstrings[(Z, ionstage)] for Z, ionstage in
+                     zip(dflinelist['atomic_number'].values, dflinelist['ionstage'].values)]
+
+    if groupby == 'line':
+        linelabels = [
+            f'{ionstring} λ{lambda_angstroms:.0f} ({upperlevelindex}-{lowerlevelindex})'
+            for ionstring, lambda_angstroms, upperlevelindex, lowerlevelindex in zip(
+                arr_ionstring, dflinelist['lambda_angstroms'].values, dflinelist['upperlevelindex'].values,
+                dflinelist['lowerlevelindex'].values)]
+    elif groupby in ['terms', 'upperterm']:
+        from artistools import atomic
+
+        adata = atomic.get_levels(modelpath, ionlist=tuple(sorted(ionstrings.keys())), quiet=True)
+        arr_upperterm = np.empty(len(dflinelist), dtype=object)
+        arr_lowerterm = np.empty(len(dflinelist), dtype=object)
+        for (Z, ionstage), dflinesofion in dflinelist.groupby(['atomic_number', 'ionstage']):
+            # the term of each level without the J value, e.g. '3d6_4s_a6D[9/2]' -> 'a6D'
+            levels = adata.query('Z == @Z and ion_stage == @ionstage', inplace=False).iloc[0].levels
+            terms = np.array([levelname.split('_')[-1].split('[')[0] for levelname in levels.levelname.values],
+                             dtype=object)
+            rowindices = dflinelist.index.get_indexer(dflinesofion.index)
+            arr_upperterm[rowindices] = terms[dflinesofion['upperlevelindex'].values]
+            arr_lowerterm[rowindices] = terms[dflinesofion['lowerlevelindex'].values]
+
+        if groupby == 'upperterm':
+            linelabels = [f'{ionstring} {upperterm}' for ionstring, upperterm in zip(arr_ionstring, arr_upperterm)]
+        else:
+            linelabels = [f'{ionstring} {upperterm}->{lowerterm}'
+                          for ionstring, upperterm, lowerterm in zip(arr_ionstring, arr_upperterm, arr_lowerterm)]
+    else:
+        linelabels = [f'{ionstring} bound-bound' for ionstring in arr_ionstring]
+
+    if absorption:
+        # codes -2 and -1
+        negativecodelabels = ['bound-free', 'free-free']
+    else:
+        bflist = get_bflist(modelpath)
+        bflabels = []
+        for bfindex in range(max(bflist.keys(), default=-1) + 1):
+            if bfindex in bflist:
+                (atomic_number, ionstage, level) = bflist[bfindex][:3]
+                bflabels.append(f'{get_ionstring(atomic_number, ionstage)} bound-free' +
+                                (f' {level}' if groupby == 'line' else ''))
+            else:
+                bflabels.append(f'? bound-free (bfindex={bfindex})')
+
+        # codes -1 - bfindex from -len(bflabels) to -1, and then free-free
+        negativecodelabels = bflabels[::-1]
+
+    # free-free emission is not in the table, but is given a label
+    labels, groupids = np.unique(
+        [*negativecodelabels, *linelabels, *([] if absorption else ['free-free'])], return_inverse=True)
+
+    return processgroupstuple(labels=list(labels), groupids=groupids[:len(negativecodelabels) + len(linelabels)],
+                              codeoffset=len(negativecodelabels), absorption=absorption)
+
+
+def get_process_group_ids(codes, processgroups):
+    """Return the process group labels and the group index of each emission (or absorption) type code, using
+    the lookup table of get_process_groups(). Codes are mapped to groups with a single fancy-index."""
+    labels = list(processgroups.labels)
+    codes = np.asarray(codes, dtype=int)
+
+    tableindices = codes + processgroups.codeoffset
+    intable = (tableindices >= 0) & (tableindices < len(processgroups.groupids))
+    codegroupids = np.zeros(len(codes), dtype=int)
+    codegroupids[intable] = processgroups.groupids[tableindices[intable]]
+
+    if not intable.all():
+        # free-free emission and unknown negative codes are not in the table
+        for code in np.unique(codes[~intable]):
+            if code >= 0:
+                raise IndexError(f'Process type {code} is not in the linelist')
+            elif processgroups.absorption:
+                label = '? other absorp.'
+            elif code == EMTYPE_FREEFREE:
+                label = 'free-free'
+            else:
+                label = f'? bound-free (bfindex={-code - 1})'
+
+            if label not in labels:
+                labels.append(label)
+            codegroupids[codes == code] = labels.index(label)
+
+    return labels, codegroupids
+
+
 @lru_cache(maxsize=8)
 def get_npts_model(modelpath):
     """Return the number of cell in the model.txt."""
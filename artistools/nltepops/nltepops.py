@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 """Artistools - NLTE population related functions."""
 import math
-import multiprocessing
 # import os
 import re
 # import sys
@@ -136,10 +135,13 @@ def read_file(nltefilepath):
     if not nltefilepath.is_file():
         nltefilepathgz = Path(str(nltefilepath) + '.gz')
         nltefilepathxz = Path(str(nltefilepath) + '.xz')
+        nltefilepathzst = Path(str(nltefilepath) + '.zst')
         if nltefilepathxz.is_file():
             nltefilepath = nltefilepathxz
         elif nltefilepathgz.is_file():
             nltefilepath = nltefilepathgz
+        elif nltefilepathzst.is_file():
+            nltefilepath = nltefilepathzst
         else:
             # print(f'Warning: Could not find {nltefilepath}')
             return pd.DataFrame()
@@ -148,7 +150,8 @@ def read_file(nltefilepath):
     print(f'Reading {nltefilepath} ({filesize:.2f} MiB)')
 
     try:
-        dfpop = pd.read_csv(nltefilepath, delim_whitespace=True)
+        with at.zopen(nltefilepath, 'rt', seekable=False) as fnltepops:
+            dfpop = pd.read_csv(fnltepops, delim_whitespace=True)
     except pd.errors.EmptyDataError:
         return pd.DataFrame()
 
@@ -193,15 +196,8 @@ def read_files(modelpath, timestep=-1, modelgridindex=-1, dfquery=None, dfqueryv
             dfquery_full = f'({dfquery_full}) and '
         dfquery_full += f'({dfquery})'
 
-    if at.config['num_processes'] > 1:
-        with multiprocessing.Pool(processes=at.config['num_processes']) as pool:
-            arr_dfnltepop = pool.map(partial(read_file_filtered, strquery=dfquery_full, dfqueryvars=dfqueryvars),
-                                     nltefilepaths)
-            pool.close()
-            pool.join()
-            pool.terminate()
-    else:
-        arr_dfnltepop = [read_file_filtered(f, strquery=dfquery_full, dfqueryvars=dfqueryvars) for f in nltefilepaths]
+    arr_dfnltepop = at.get_executor().map(
+        partial(read_file_filtered, strquery=dfquery_full, dfqueryvars=dfqueryvars), nltefilepaths)
 
     dfpop = pd.concat(arr_dfnltepop).copy()
 
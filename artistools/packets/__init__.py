@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 
+import json
 import math
 import gzip
-# import multiprocessing
+import os
 import sys
 from pathlib import Path
 
@@ -11,9 +12,15 @@ import numpy as np
 import pandas as pd
 
 # from collections import namedtuple
-from functools import lru_cache
+from functools import lru_cache, partial
 
 import artistools as at
+from artistools.packets.accumulate import (
+    accumulate_packets,
+    accumulate_packets_file,
+    make_accumulator,
+)
+from artistools.packets.query import PacketsScan, scan
 
 CLIGHT = 2.99792458e10
 DAY = 86400
@@ -27,6 +34,69 @@ types = {
 
 type_ids = dict((v, k) for k, v in types.items())
 
+# new artis added extra columns to the end of this list, but they may be absent in older versions
+columns_full = (
+    'number',
+    'where',
+    'type_id',
+    'posx', 'posy', 'posz',
+    'dirx', 'diry', 'dirz',
+    'last_cross',
+    'tdecay',
+    'e_cmf',
+    'e_rf',
+    'nu_cmf',
+    'nu_rf',
+    'escape_type_id',
+    'escape_time',
+    'scat_count',
+    'next_trans',
+    'interactions',
+    'last_event',
+    'emissiontype',
+    'trueemissiontype',
+    'em_posx', 'em_posy', 'em_posz',
+    'absorption_type',
+    'absorption_freq',
+    'nscatterings',
+    'em_time',
+    'absorptiondirx',
+    'absorptiondiry',
+    'absorptiondirz', 'stokes1', 'stokes2', 'stokes3', 'pol_dirx', 'pol_diry',
+    'pol_dirz',
+    'originated_from_positron',
+    'true_emission_velocity',
+    'trueem_time',
+    'pellet_nucindex',
+)
+
+# compact dtypes for the packet columns that do not need 64 bits. Columns that are not listed are float64
+packet_dtypes = {
+    'number': 'int32',
+    'where': 'int32',
+    'type_id': 'int8',
+    'dirx': 'float32', 'diry': 'float32', 'dirz': 'float32',
+    'last_cross': 'int32',
+    'escape_type_id': 'int8',
+    'scat_count': 'int32',
+    'next_trans': 'int32',
+    'interactions': 'int32',
+    'last_event': 'int16',
+    'emissiontype': 'int32',
+    'trueemissiontype': 'int32',
+    'absorption_type': 'int32',
+    'nscatterings': 'int32',
+    'absorptiondirx': 'float32', 'absorptiondiry': 'float32', 'absorptiondirz': 'float32',
+    'stokes1': 'float32', 'stokes2': 'float32', 'stokes3': 'float32',
+    'pol_dirx': 'float32', 'pol_diry': 'float32', 'pol_dirz': 'float32',
+    'originated_from_positron': 'int8',
+    'pellet_nucindex': 'int16',
+}
+
+# with precision='compact', positions are also stored as float32 (about seven significant figures).
+# Packet energies (~1e40 erg) would overflow float32, so they always remain float64
+columns_compact_precision = ('posx', 'posy', 'posz', 'em_posx', 'em_posy', 'em_posz')
+
 
 @lru_cache(maxsize=16)
 def get_column_names_artiscode(modelpath):
@@ -78,19 +148,38 @@ def add_derived_columns(dfpackets, modelpath, colnames, allnonemptymgilist=None)
 
     colnames = at.makelist(colnames)
 
-    def em_modelgridindex(packet):
-        return at.inputmodel.get_mgi_of_velocity_kms(modelpath, packet.emission_velocity * cm_to_km,
-                                                     mgilist=allnonemptymgilist)
+    def get_mgi_of_velocities_kms(velocities_kms):
+        # batched version of at.inputmodel.get_mgi_of_velocity_kms: the first cell (of allnonemptymgilist
+        # if given) with an outer velocity above the velocity, or the last cell if the velocity is higher than all
+        modeldata, _, _ = at.inputmodel.get_modeldata(modelpath)
+        if not allnonemptymgilist:
+            mgilist = modeldata.index.values
+        else:
+            mgilist = np.array(allnonemptymgilist)
+        arr_vouter = modeldata['velocity_outer'].values[mgilist]
+
+        velocities_kms = np.asarray(velocities_kms, dtype=float)
+        listindices = np.minimum(np.searchsorted(arr_vouter, velocities_kms, side='right'), len(mgilist) - 1)
+        mgis = mgilist[listindices]
+        if np.isnan(velocities_kms).any():
+            return np.where(np.isnan(velocities_kms), float('nan'), mgis)
 
-    def emtrue_modelgridindex(packet):
-        return at.inputmodel.get_mgi_of_velocity_kms(modelpath, packet.true_emission_velocity * cm_to_km,
-                                                     mgilist=allnonemptymgilist)
+        return mgis
 
-    def em_timestep(packet):
-        return at.get_timestep_of_timedays(modelpath, packet.em_time / day_in_s)
+    def get_timesteps_of_times_s(times_s):
+        # batched version of at.get_timestep_of_timedays
+        timedays = np.asarray(times_s, dtype=float) / day_in_s
+        arr_tstart = at.get_timestep_times_float(modelpath, loc='start')
+        arr_tend = at.get_timestep_times_float(modelpath, loc='end')
+        # to avoid roundoff errors, use the next timestep's tstart at each timestep's tend (t_width is not exact)
+        arr_tend[:-1] = arr_tstart[1:]
 
-    def emtrue_timestep(packet):
-        return at.get_timestep_of_timedays(modelpath, packet.trueem_time / day_in_s)
+        timesteps = np.searchsorted(arr_tstart, timedays, side='right') - 1
+        outofrange = (timesteps < 0) | ~(timedays < arr_tend[np.maximum(timesteps, 0)])
+        if outofrange.any():
+            raise ValueError(f"Could not find timestep bracketing time {timedays[outofrange][0]}")
+
+        return timesteps
 
     if 'emission_velocity' in colnames:
         dfpackets.eval(
@@ -111,40 +200,43 @@ def add_derived_columns(dfpackets, modelpath, colnames, allnonemptymgilist=None)
         if 'emission_velocity' not in dfpackets.columns:
             dfpackets = add_derived_columns(dfpackets, modelpath, ['emission_velocity'],
                                             allnonemptymgilist=allnonemptymgilist)
-        dfpackets['em_modelgridindex'] = dfpackets.apply(em_modelgridindex, axis=1)
+        dfpackets['em_modelgridindex'] = get_mgi_of_velocities_kms(dfpackets['emission_velocity'].values * cm_to_km)
 
     if 'emtrue_modelgridindex' in colnames:
-        dfpackets['emtrue_modelgridindex'] = dfpackets.apply(emtrue_modelgridindex, axis=1)
+        dfpackets['emtrue_modelgridindex'] = get_mgi_of_velocities_kms(
+            dfpackets['true_emission_velocity'].values * cm_to_km)
 
     if 'em_timestep' in colnames:
-        dfpackets['em_timestep'] = dfpackets.apply(em_timestep, axis=1)
+        dfpackets['em_timestep'] = get_timesteps_of_times_s(dfpackets['em_time'].values)
+
+    if 'emtrue_timestep' in colnames:
+        dfpackets['emtrue_timestep'] = get_timesteps_of_times_s(dfpackets['trueem_time'].values)
 
     return dfpackets
 
 
-def readfile_text(packetsfile, modelpath=Path('.')):
+def get_text_packetsfile_columns(packetsfile, modelpath=Path('.'), usecols=None):
+    """Return the column names in a text packets file, the subset of usecols that are in the file,
+    the usecols that have no data in the file, and whether the file has a header line."""
     column_names = None
     try:
-        fpackets = at.zopen(packetsfile, 'rt')
+        with at.zopen(packetsfile, 'rt', seekable=False) as fpacketsheader:
+            firstline = fpacketsheader.readline()
 
-        datastartpos = fpackets.tell()  # will be updated if this was actually the start of a header
-        firstline = fpackets.readline()
-
-        if firstline.lstrip().startswith('#'):
-            column_names = firstline.lstrip('#').split()
-            # get the column count from the first data line to check header matched
-            datastartpos = fpackets.tell()
-            dataline = fpackets.readline()
-            inputcolumncount = len(dataline.split())
-        else:
-            inputcolumncount = len(firstline.split())
-
-        fpackets.seek(datastartpos)  # go to first data line
+            if firstline.lstrip().startswith('#'):
+                column_names = firstline.lstrip('#').split()
+                # get the column count from the first data line to check header matched
+                dataline = fpacketsheader.readline()
+                inputcolumncount = len(dataline.split())
+            else:
+                inputcolumncount = len(firstline.split())
 
     except gzip.BadGzipFile:
         print(f"\nBad Gzip File: {packetsfile}")
         raise gzip.BadGzipFile
 
+    hasheader = column_names is not None
+
     if inputcolumncount < 3:
         print("\nWARNING: packets file has no columns!")
         print(open(packetsfile, "r").readlines())
@@ -157,50 +249,124 @@ def readfile_text(packetsfile, modelpath=Path('.')):
         if column_names:  # found them in the artis code files
             assert len(column_names) == inputcolumncount
         else:  # infer from positions
-            # new artis added extra columns to the end of this list, but they may be absent in older versions
             # the packets file may have a truncated set of columns, but we assume that they
             # are only truncated, i.e. the columns with the same index have the same meaning
-            columns_full = (
-                'number',
-                'where',
-                'type_id',
-                'posx', 'posy', 'posz',
-                'dirx', 'diry', 'dirz',
-                'last_cross',
-                'tdecay',
-                'e_cmf',
-                'e_rf',
-                'nu_cmf',
-                'nu_rf',
-                'escape_type_id',
-                'escape_time',
-                'scat_count',
-                'next_trans',
-                'interactions',
-                'last_event',
-                'emissiontype',
-                'trueemissiontype',
-                'em_posx', 'em_posy', 'em_posz',
-                'absorption_type',
-                'absorption_freq',
-                'nscatterings',
-                'em_time',
-                'absorptiondirx',
-                'absorptiondiry',
-                'absorptiondirz', 'stokes1', 'stokes2', 'stokes3', 'pol_dirx', 'pol_diry',
-                'pol_dirz',
-                'originated_from_positron',
-                'true_emission_velocity',
-                'trueem_time',
-                'pellet_nucindex',
-            )
-
             assert len(columns_full) >= inputcolumncount
             usecols_nodata = [n for n in columns_full if columns_full.index(n) >= inputcolumncount]
             column_names = columns_full[:inputcolumncount]
 
+    if usecols is not None:
+        if usecols_nodata:
+            usecols_nodata = [col for col in usecols_nodata if col in usecols]
+        usecols = [col for col in column_names if col in usecols]
+
+    if usecols_nodata:
+        print(f'WARNING: no data in packets file for columns: {usecols_nodata}')
+
+    return list(column_names), usecols, usecols_nodata, hasheader
+
+
+def open_text_packetsfile(packetsfile, modelpath=Path('.'), usecols=None):
+    """Open a text packets file and position it at the first data line.
+
+    Returns the open file, the column names in the file, the subset of usecols that are in the file,
+    and the usecols that have no data in the file.
+    """
+    column_names, usecols, usecols_nodata, hasheader = get_text_packetsfile_columns(packetsfile, modelpath, usecols)
+
+    # the file is opened again instead of seeking back, so that it can be decompressed through a (multithreaded) pipe
+    fpackets = at.zopen(packetsfile, 'rt', seekable=False)
+    if hasheader:
+        fpackets.readline()  # go to first data line
+
+    return fpackets, column_names, usecols, usecols_nodata
+
+
+def get_packet_dtypes(columns, precision='full'):
+    """Return a dict of the dtypes for the known packet columns in columns."""
+    assert precision in ['full', 'compact']
+    dtypes = {col: packet_dtypes[col] for col in columns if col in packet_dtypes}
+    if precision == 'compact':
+        dtypes.update({col: 'float32' for col in columns if col in columns_compact_precision})
+
+    return dtypes
+
+
+def apply_packet_dtypes(dfpackets, precision='full'):
+    """Cast the packet columns of a DataFrame to the compact packet dtypes."""
+    dtypes = {
+        col: dtype for col, dtype in get_packet_dtypes(dfpackets.columns, precision=precision).items()
+        if dfpackets[col].dtype != dtype and not dfpackets[col].isna().any()}
+
+    return dfpackets.astype(dtypes, copy=False) if dtypes else dfpackets
+
+
+def get_arrow_csv_options(column_names, usecols, hasheader, precision='full', block_size=None):
+    """Return the pyarrow.csv options to read the usecols (or all) columns of a text packets file."""
+    import pyarrow as pa
+    import pyarrow.csv
+
+    readcolumns = usecols or column_names
+    # ARTIS writes a space after every value, so lines can have an extra empty field. Columns are selected by position
+    colnames_auto = {col: f'f{column_names.index(col)}' for col in readcolumns}
+
+    read_options = pyarrow.csv.ReadOptions(
+        autogenerate_column_names=True, skip_rows=1 if hasheader else 0, use_threads=True,
+        **({} if block_size is None else {'block_size': block_size}))
+    parse_options = pyarrow.csv.ParseOptions(delimiter=' ')
+    convert_options = pyarrow.csv.ConvertOptions(
+        include_columns=list(colnames_auto.values()),
+        column_types={colnames_auto[col]: pa.from_numpy_dtype(np.dtype(dtype))
+                      for col, dtype in get_packet_dtypes(readcolumns, precision=precision).items()})
+
+    return read_options, parse_options, convert_options
+
+
+def readfile_text_arrow(fpackets, column_names, usecols, hasheader, precision='full'):
+    """Read an open (binary mode) text packets file with the multithreaded pyarrow CSV reader."""
+    import pyarrow.csv
+
+    read_options, parse_options, convert_options = get_arrow_csv_options(
+        column_names, usecols, hasheader, precision=precision)
+    table = pyarrow.csv.read_csv(fpackets, read_options=read_options, parse_options=parse_options,
+                                 convert_options=convert_options)
+
+    return table.rename_columns(usecols or column_names).to_pandas()
+
+
+def readfile_text_polars(fpackets, column_names, usecols, hasheader, precision='full'):
+    """Read an open (binary mode) text packets file with the multithreaded Polars CSV reader."""
+    import polars as pl
+
+    readcolumns = usecols or column_names
+    dfpackets = pl.read_csv(fpackets, has_header=False, separator=' ', skip_rows=1 if hasheader else 0,
+                            columns=[column_names.index(col) for col in readcolumns])
+    dfpackets.columns = readcolumns
+
+    return apply_packet_dtypes(dfpackets.to_pandas(), precision=precision)
+
+
+def readfile_text(packetsfile, modelpath=Path('.'), usecols=None, precision='full'):
+    """Read a text packets file. If usecols is specified, only these columns are parsed.
+
+    With at.config['dataframe_backend'] set to 'pyarrow' or 'polars', the text is parsed with a multithreaded reader.
+    """
+    backend = at.get_dataframe_backend()
+    if backend == 'pandas':
+        fpackets, column_names, usecols, usecols_nodata = open_text_packetsfile(packetsfile, modelpath, usecols)
+    else:
+        column_names, usecols, usecols_nodata, hasheader = get_text_packetsfile_columns(
+            packetsfile, modelpath, usecols)
+        fpackets = at.zopen(packetsfile, 'rb', seekable=False)
+
     try:
-        dfpackets = pd.read_csv(fpackets, delim_whitespace=True, names=column_names, header=None)
+        if backend == 'pandas':
+            dfpackets = pd.read_csv(fpackets, delim_whitespace=True, names=column_names, header=None,
+                                    usecols=usecols, dtype=get_packet_dtypes(usecols or column_names,
+                                                                             precision=precision))
+        else:
+            readfunc = readfile_text_polars if backend == 'polars' else readfile_text_arrow
+            dfpackets = readfunc(fpackets, column_names, usecols, hasheader, precision=precision)
 
     except Exception as ex:
         print(f'Problem with file {packetsfile}')
@@ -211,55 +377,700 @@ def readfile_text(packetsfile, modelpath=Path('.')):
     fpackets.close()
 
     if usecols_nodata:
-        print(f'WARNING: no data in packets file for columns: {usecols_nodata}')
         for col in usecols_nodata:
             dfpackets[col] = float('NaN')
 
     return dfpackets
 
 
-@at.diskcache(savezipped=True)
-def readfile(packetsfile, type=None, escape_type=None):
-    """Read a packet file into a pandas DataFrame."""
+def iter_chunks_text_arrow(packetsfile, modelpath=Path('.'), usecols=None, chunksize=1000000, precision='full'):
+    """Yield DataFrames of chunksize rows (except the last) from a text packets file with the pyarrow streaming
+    CSV reader, which parses blocks of the file with multiple threads."""
+    import pyarrow as pa
+    import pyarrow.csv
+
+    column_names, usecols, usecols_nodata, hasheader = get_text_packetsfile_columns(packetsfile, modelpath, usecols)
+    readcolumns = usecols or column_names
+
+    read_options, parse_options, convert_options = get_arrow_csv_options(
+        column_names, usecols, hasheader, precision=precision, block_size=16 * 1024 * 1024)
+
+    def to_dataframe(table):
+        dfchunk = table.rename_columns(readcolumns).to_pandas()
+        for col in usecols_nodata or []:
+            dfchunk[col] = float('NaN')
+        return dfchunk
+
+    with at.zopen(packetsfile, 'rb', seekable=False) as fpackets:
+        reader = pyarrow.csv.open_csv(fpackets, read_options=read_options, parse_options=parse_options,
+                                      convert_options=convert_options)
+        # the reader yields batches of a fixed number of bytes, which are regrouped into chunks of chunksize rows
+        batches = []
+        nrows_buffered = 0
+        for batch in reader:
+            batches.append(batch)
+            nrows_buffered += batch.num_rows
+            while nrows_buffered >= chunksize:
+                table = pa.Table.from_batches(batches)
+                yield to_dataframe(table.slice(0, chunksize))
+                batches = table.slice(chunksize).to_batches()
+                nrows_buffered -= chunksize
+
+        if nrows_buffered > 0:
+            yield to_dataframe(pa.Table.from_batches(batches))
+
+
+def iter_chunks_text(packetsfile, modelpath=Path('.'), usecols=None, chunksize=1000000, precision='full'):
+    """Yield DataFrames of up to chunksize rows from a text packets file."""
+    if at.get_dataframe_backend() != 'pandas':
+        yield from iter_chunks_text_arrow(packetsfile, modelpath=modelpath, usecols=usecols, chunksize=chunksize,
+                                          precision=precision)
+        return
+
+    fpackets, column_names, usecols, usecols_nodata = open_text_packetsfile(packetsfile, modelpath, usecols)
+
+    with fpackets:
+        for dfchunk in pd.read_csv(fpackets, delim_whitespace=True, names=column_names, header=None,
+                                   usecols=usecols, chunksize=chunksize,
+                                   dtype=get_packet_dtypes(usecols or column_names, precision=precision)):
+            if usecols_nodata:
+                for col in usecols_nodata:
+                    dfchunk[col] = float('NaN')
+
+            yield dfchunk
+
+
+# text packets files, which are optionally compressed
+textsuffixes = [['.out'], ['.out', '.gz'], ['.out', '.xz'], ['.out', '.zst']]
+
+# columns that are not in the packets files, but are calculated from other columns by readfile()
+derived_column_dependencies = {
+    't_arrive_d': ('escape_time', 'posx', 'posy', 'posz', 'dirx', 'diry', 'dirz'),
+}
+
+
+def get_type_filters(type=None, escape_type=None):
+    """Return a list of (column, op, value) filters that select packets by type and escape type."""
+    if escape_type is not None and escape_type != '' and escape_type != 'ALL':
+        assert type is None or type == 'TYPE_ESCAPE'
+        return [('type_id', '==', type_ids['TYPE_ESCAPE']), ('escape_type_id', '==', type_ids[escape_type])]
+    elif type is not None and type != 'ALL' and type != '':
+        return [('type_id', '==', type_ids[type])]
+
+    return []
+
+
+def get_columns_to_read(columns, filters=None):
+    """Return the columns that must be read from a packets file to provide columns and apply filters."""
+    if columns is None:
+        return None
+
+    readcolumns = []
+    for col in [*columns, *[f[0] for f in at.makelist(filters)]]:
+        for dependcol in derived_column_dependencies.get(col, [col]):
+            if dependcol not in readcolumns:
+                readcolumns.append(dependcol)
+
+    return readcolumns
+
+
+def get_filter_mask(packets, filters):
+    """Return a boolean array that is True for the packets that satisfy all of the (column, op, value) filters.
+
+    packets can be a DataFrame or a NumPy structured array (e.g. memory mapped from a .npy packets file).
+    """
+    mask = np.ones(len(packets), dtype=bool)
+    for col, op, value in filters:
+        arr = np.asarray(packets[col])
+        if op in ['==', '=']:
+            mask &= (arr == value)
+        elif op == '!=':
+            mask &= (arr != value)
+        elif op == '<':
+            mask &= (arr < value)
+        elif op == '<=':
+            mask &= (arr <= value)
+        elif op == '>':
+            mask &= (arr > value)
+        elif op == '>=':
+            mask &= (arr >= value)
+        elif op == 'in':
+            mask &= np.isin(arr, list(value))
+        elif op == 'not in':
+            mask &= ~np.isin(arr, list(value))
+        else:
+            raise ValueError(f"Unknown filter operation '{op}' in filter {(col, op, value)}")
+
+    return mask
+
+
+def apply_filters(dfpackets, filters):
+    """Return the rows of dfpackets that satisfy all of the (column, op, value) filters."""
+    if not filters or dfpackets.empty:
+        return dfpackets
+
+    return dfpackets[get_filter_mask(dfpackets, filters)].copy()
+
+
+def get_packetsfile_rank(packetsfile):
+    """Return the MPI rank of a packets file from its name, e.g. 12 for packets00_0012.out.xz."""
+    try:
+        return int(Path(packetsfile).name.split('.')[0].split('_')[-1])
+    except ValueError:
+        return 0
+
+
+def get_packet_subsample_mask(numbers, packetfraction, rank=0, seed=0):
+    """Return a boolean array selecting a deterministic pseudo-random fraction of the packets with these numbers.
+
+    The selection hashes the packet number, the rank, and the seed (with splitmix64), so that it does not depend on
+    the order in which packets were created (e.g. by cell) and differs between ranks.
+    """
+    def splitmix64(z):
+        z = z + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+    with np.errstate(over='ignore'):
+        keys = np.asarray(numbers).astype(np.uint64) + np.uint64(rank) * np.uint64(2 ** 32)
+        hashes = splitmix64(keys ^ splitmix64(np.array([seed], dtype=np.uint64)))
+
+    # the top 53 bits give a uniform random number in [0, 1)
+    return (hashes >> np.uint64(11)).astype(float) * 2. ** -53 < packetfraction
+
+
+def subsample_packets(dfpackets, packetsfile, packetfraction, seed=0):
+    """Return the deterministic random packetfraction of the packets from packetsfile. Energies must be divided by
+    packetfraction to give unbiased totals."""
+    if packetfraction is None or packetfraction >= 1.:
+        return dfpackets
+
+    return dfpackets[get_packet_subsample_mask(
+        dfpackets['number'].values, packetfraction, rank=get_packetsfile_rank(packetsfile), seed=seed)]
+
+
+def print_packetfraction_noise(packetfraction, packetcount, label=''):
+    """Print the expected relative Monte Carlo noise from using a packet subsample."""
+    if packetfraction is None or packetfraction >= 1.:
+        return
+
+    noise = 1. / math.sqrt(packetcount) if packetcount > 0 else float('inf')
+    print(f'Using {packetfraction:.2%} of packets{f" for {label}" if label else ""}: {packetcount:.2e} packets, '
+          f'expected relative Monte Carlo noise of the total {noise:.1%} '
+          f'(x{1. / math.sqrt(packetfraction):.1f} that of all packets)')
+
+
+def add_arrival_time_column(dfpackets):
+    """Add the column t_arrive_d, the observer arrival time in days, which includes the light travel time correction."""
+    # # neglect light travel time correction
+    # dfpackets.eval("t_arrive_d = escape_time / 86400", inplace=True)
+
+    dfpackets.eval(
+        "t_arrive_d = (escape_time - (posx * dirx + posy * diry + posz * dirz) / 29979245800) / 86400", inplace=True)
+
+    return dfpackets
+
+
+def get_arrow_filter_expression(filters):
+    """Convert a list of (column, op, value) filters into a pyarrow dataset expression (or None)."""
+    import pyarrow.dataset
+
+    expression = None
+    for col, op, value in filters:
+        field = pyarrow.dataset.field(col)
+        if op in ['==', '=']:
+            term = (field == value)
+        elif op == '!=':
+            term = (field != value)
+        elif op == '<':
+            term = (field < value)
+        elif op == '<=':
+            term = (field <= value)
+        elif op == '>':
+            term = (field > value)
+        elif op == '>=':
+            term = (field >= value)
+        elif op == 'in':
+            term = field.isin(list(value))
+        elif op == 'not in':
+            term = ~field.isin(list(value))
+        else:
+            raise ValueError(f"Unknown filter operation '{op}' in filter {(col, op, value)}")
+
+        expression = term if expression is None else (expression & term)
+
+    return expression
+
+
+def get_columnar_file_column_names(packetsfile):
+    """Return the column names stored in a Parquet, Feather, or NumPy binary packets file."""
+    import pyarrow
+
+    if Path(packetsfile).suffixes == ['.out', '.npy']:
+        return list(np.load(packetsfile, mmap_mode='r').dtype.names)
+
+    if Path(packetsfile).suffixes == ['.out', '.parquet']:
+        import pyarrow.parquet
+        return pyarrow.parquet.read_schema(packetsfile).names
+
+    with pyarrow.ipc.open_file(packetsfile) as reader:
+        return reader.schema.names
+
+
+def readfile_npy(packetsfile, columns=None, filters=None, precision='full', rowrange=None):
+    """Read a NumPy binary packets file (see convert_text_to_columnar) through a memory map.
+
+    The filters are evaluated on the mapped columns, and only the matching rows of the selected columns are copied
+    into the DataFrame. Processes that read the same file share its pages in the OS page cache. If rowrange is
+    (start, stop), only these records are read.
+    """
+    packets = np.load(packetsfile, mmap_mode='r')
+    if rowrange is not None:
+        packets = packets[rowrange[0]:rowrange[1]]
+
+    readcolumns = packets.dtype.names if columns is None else [col for col in columns if col in packets.dtype.names]
+
+    if filters:
+        rowindices = np.flatnonzero(get_filter_mask(packets, filters))
+        dfpackets = pd.DataFrame({col: packets[col][rowindices] for col in readcolumns})
+    else:
+        dfpackets = pd.DataFrame({col: np.array(packets[col]) for col in readcolumns})
+
+    return apply_packet_dtypes(dfpackets, precision=precision)
+
+
+def split_filters(type=None, escape_type=None, filters=None):
+    """Combine the type selection with the filters and split them into those on stored and derived columns."""
+    filters = [*get_type_filters(type, escape_type), *at.makelist(filters)]
+
+    # filters on derived columns are applied after reading, and the others can be pushed down to the reader
+    filters_derived = [f for f in filters if f[0] in derived_column_dependencies]
+    filters_stored = [f for f in filters if f[0] not in derived_column_dependencies]
+
+    return filters, filters_stored, filters_derived
+
+
+def finalise_packets_frame(dfpackets, columns, filters, filters_derived):
+    """Add derived columns, apply filters on them, and select the requested columns."""
+    # dfpackets['type'] = dfpackets['type_id'].map(lambda x: types.get(x, x))
+    # dfpackets['escape_type'] = dfpackets['escape_type_id'].map(lambda x: types.get(x, x))
+
+    if columns is None or 't_arrive_d' in columns or any(f[0] == 't_arrive_d' for f in filters):
+        dfpackets = add_arrival_time_column(dfpackets)
+
+    dfpackets = apply_filters(dfpackets, filters_derived)
+
+    if columns is not None and list(dfpackets.columns) != list(columns):
+        # columns that were missing from the file are returned as NaN
+        dfpackets = dfpackets.reindex(columns=list(columns))
+
+    return dfpackets
+
+
+def readfile(packetsfile, type=None, escape_type=None, columns=None, filters=None, precision='full'):
+    """Read a packet file into a pandas DataFrame.
+
+    Only the listed columns are read if columns is specified (and the derived column t_arrive_d is only
+    added if it is in this list). filters is a list of (column, op, value) tuples that must all be true
+    (op is one of ==, !=, <, <=, >, >=, in, not in). For Parquet files, the filters are pushed down
+    to the reader so that non-matching row groups are skipped.
+
+    Integer columns and direction cosines use the compact dtypes of packet_dtypes. precision='compact'
+    also stores positions as float32.
+
+    Only reads of all columns without filters are disk cached, since every different set of columns and
+    filters would be saved as another copy of the packets.
+    """
+    if columns is None and not filters:
+        return readfile_allcolumns(packetsfile, type=type, escape_type=escape_type, precision=precision)
+
+    return readfile_uncached(packetsfile, type=type, escape_type=escape_type, columns=columns, filters=filters,
+                             precision=precision)
+
+
+@at.diskcache(savezipped=True, funcversion="2026-10-17.0426")
+def readfile_allcolumns(packetsfile, type=None, escape_type=None, precision='full'):
+    """Read all columns of the packets of a type and escape_type from a packet file, as for readfile()."""
+    return readfile_uncached(packetsfile, type=type, escape_type=escape_type, precision=precision)
+
+
+def readfile_uncached(packetsfile, type=None, escape_type=None, columns=None, filters=None, precision='full'):
+    """Read a packet file as for readfile(), but without the disk cache."""
     packetsfile = Path(packetsfile)
 
+    filters, filters_stored, filters_derived = split_filters(type, escape_type, filters)
+
+    readcolumns = get_columns_to_read(columns, filters)
+
+    filesize = Path(packetsfile).stat().st_size / 1024 / 1024
+    print(f'Reading {packetsfile} ({filesize:.1f} MiB)', end='')
+
     if packetsfile.suffixes == ['.out', '.parquet']:
-        dfpackets = pd.read_parquet(packetsfile)
+        if readcolumns is not None:
+            filecolumns = get_columnar_file_column_names(packetsfile)
+            readcolumns = [col for col in readcolumns if col in filecolumns]
+        dfpackets = apply_packet_dtypes(
+            pd.read_parquet(packetsfile, columns=readcolumns, filters=filters_stored or None), precision=precision)
     elif packetsfile.suffixes == ['.out', '.feather']:
-        dfpackets = pd.read_feather(packetsfile)
-    elif packetsfile.suffixes in [['.out'], ['.out', '.gz'], ['.out', '.xz']]:
-        dfpackets = readfile_text(packetsfile)
-        # dfpackets.to_parquet(at.stripallsuffixes(packetsfile).with_suffix('.out.parquet'),
-        #                      compression='brotli', compression_level=99)
+        if readcolumns is not None:
+            filecolumns = get_columnar_file_column_names(packetsfile)
+            readcolumns = [col for col in readcolumns if col in filecolumns]
+        dfpackets = apply_filters(
+            apply_packet_dtypes(pd.read_feather(packetsfile, columns=readcolumns), precision=precision), filters_stored)
+    elif packetsfile.suffixes == ['.out', '.npy']:
+        dfpackets = readfile_npy(packetsfile, columns=readcolumns, filters=filters_stored, precision=precision)
+    elif packetsfile.suffixes in textsuffixes:
+        dfpackets = readfile_text(packetsfile, modelpath=get_modelpath_of_packetsfile(packetsfile),
+                                  usecols=readcolumns, precision=precision)
+        dfpackets = apply_filters(dfpackets, filters_stored)
     else:
         print('ERROR')
         sys.exit(1)
-    filesize = Path(packetsfile).stat().st_size / 1024 / 1024
-    print(f'Reading {packetsfile} ({filesize:.1f} MiB)', end='')
+
+    dfpackets = finalise_packets_frame(dfpackets, columns, filters, filters_derived)
 
     print(f' ({len(dfpackets):.1e} packets', end='')
+    if filters:
+        print(f' matching {filters}', end='')
+    print(')')
 
-    if escape_type is not None and escape_type != '' and escape_type != 'ALL':
-        assert type is None or type == 'TYPE_ESCAPE'
-        dfpackets.query(f'type_id == {type_ids["TYPE_ESCAPE"]} and escape_type_id == {type_ids[escape_type]}',
-                        inplace=True)
-        print(f', {len(dfpackets)} escaped as {escape_type})')
-    elif type is not None and type != 'ALL' and type != '':
-        dfpackets.query(f'type_id == {type_ids[type]}', inplace=True)
-        print(f', {len(dfpackets)} with type {type})')
+    return dfpackets
+
+
+def iter_chunks(packetsfile, chunksize=None, type=None, escape_type=None, columns=None, filters=None,
+                precision='full'):
+    """Yield DataFrames of at most chunksize packets from a packets file.
+
+    The type, escape_type, columns, filters, and precision arguments have the same meaning as for readfile().
+    Peak memory usage is set by chunksize rather than the file size. If chunksize is None, the whole file is read
+    as a single chunk. The chunks are not disk cached, since every different set of columns and filters would be
+    saved as another copy of the packets.
+    """
+    packetsfile = Path(packetsfile)
+
+    if chunksize is None:
+        yield readfile_uncached(packetsfile, type=type, escape_type=escape_type, columns=columns, filters=filters,
+                                precision=precision)
+        return
+
+    filters, filters_stored, filters_derived = split_filters(type, escape_type, filters)
+
+    readcolumns = get_columns_to_read(columns, filters)
+
+    filesize = Path(packetsfile).stat().st_size / 1024 / 1024
+    print(f'Reading {packetsfile} ({filesize:.1f} MiB) in chunks of {chunksize:.1e} packets')
+
+    if packetsfile.suffixes in [['.out', '.parquet'], ['.out', '.feather']]:
+        import pyarrow.dataset
+
+        dataset = pyarrow.dataset.dataset(
+            packetsfile, format='parquet' if packetsfile.suffixes[-1] == '.parquet' else 'feather')
+        if readcolumns is not None:
+            readcolumns = [col for col in readcolumns if col in dataset.schema.names]
+
+        for batch in dataset.to_batches(columns=readcolumns, filter=get_arrow_filter_expression(filters_stored),
+                                        batch_size=chunksize):
+            yield finalise_packets_frame(
+                apply_packet_dtypes(batch.to_pandas(), precision=precision), columns, filters, filters_derived)
+
+    elif packetsfile.suffixes == ['.out', '.npy']:
+        npackets = len(np.load(packetsfile, mmap_mode='r'))
+        for rowstart in range(0, npackets, chunksize):
+            yield finalise_packets_frame(
+                readfile_npy(packetsfile, columns=readcolumns, filters=filters_stored, precision=precision,
+                             rowrange=(rowstart, rowstart + chunksize)), columns, filters, filters_derived)
+
+    elif packetsfile.suffixes in textsuffixes:
+        for dfchunk in iter_chunks_text(packetsfile, modelpath=get_modelpath_of_packetsfile(packetsfile),
+                                        usecols=readcolumns, chunksize=chunksize, precision=precision):
+            yield finalise_packets_frame(apply_filters(dfchunk, filters_stored), columns, filters, filters_derived)
     else:
-        print(')')
+        print('ERROR')
+        sys.exit(1)
 
-    # dfpackets['type'] = dfpackets['type_id'].map(lambda x: types.get(x, x))
-    # dfpackets['escape_type'] = dfpackets['escape_type_id'].map(lambda x: types.get(x, x))
 
-    # # neglect light travel time correction
-    # dfpackets.eval("t_arrive_d = escape_time / 86400", inplace=True)
+def get_modelpath_of_packetsfile(packetsfile):
+    """Return the model folder of a packets file, which might be in a 'packets' subfolder."""
+    packetsfile = Path(packetsfile)
+    if packetsfile.parent.name == 'packets':
+        return packetsfile.parent.parent
+    return packetsfile.parent
+
+
+def get_packet_records(dfpackets):
+    """Return a NumPy structured array with one record per packet and the column dtypes of dfpackets."""
+    records = np.empty(len(dfpackets), dtype=[(col, dfpackets[col].dtype) for col in dfpackets.columns])
+    for col in dfpackets.columns:
+        records[col] = dfpackets[col].values
+
+    return records
+
+
+def convert_text_to_columnar(packetsfiletext, outputformat='parquet', overwrite=False, sortbywhere=False):
+    """Convert a text packets file (optionally compressed) to a typed and compressed columnar file, or an
+    uncompressed NumPy binary file of fixed size records (outputformat='npy') that can be memory mapped.
+
+    The output is placed next to the input file, e.g. packets00_0000.out.xz -> packets00_0000.out.parquet
+    and will be preferred by get_packetsfilepaths() and readfile(). If sortbywhere, the packets are sorted by
+    propagation cell, so that the packets of a cell are stored together (see readfile_cells).
+    """
+    packetsfiletext = Path(packetsfiletext)
+    assert outputformat in ['parquet', 'feather', 'npy']
+    outputfile = at.stripallsuffixes(packetsfiletext).with_suffix(f'.out.{outputformat}')
+
+    if outputfile.exists() and not overwrite:
+        print(f'  {outputfile} already exists. Skipping')
+        return outputfile
+
+    dfpackets = readfile_text(packetsfiletext, modelpath=get_modelpath_of_packetsfile(packetsfiletext))
+    if sortbywhere:
+        dfpackets = dfpackets.sort_values('where', kind='stable', ignore_index=True)
+
+    # write to a temporary file first so that an interrupted conversion never leaves a truncated file
+    # that would be picked up in preference to the text file
+    outputfiletmp = outputfile.with_suffix(outputfile.suffix + '.tmp')
+    if outputformat == 'parquet':
+        # moderately sized row groups allow filters to skip parts of the file and chunked reading
+        dfpackets.to_parquet(outputfiletmp, compression='zstd', index=False, row_group_size=262144)
+    elif outputformat == 'npy':
+        with outputfiletmp.open('wb') as fnpy:
+            np.save(fnpy, get_packet_records(dfpackets))
+    else:
+        dfpackets.to_feather(outputfiletmp, compression='zstd')
+    outputfiletmp.rename(outputfile)
 
-    dfpackets.eval(
-        "t_arrive_d = (escape_time - (posx * dirx + posy * diry + posz * dirz) / 29979245800) / 86400", inplace=True)
+    if at.config['enable_diskcache']:
+        write_summary(outputfile, make_summary_groups(add_arrival_time_column(dfpackets)))
 
-    return dfpackets
+    filesizein = packetsfiletext.stat().st_size / 1024 / 1024
+    filesizeout = outputfile.stat().st_size / 1024 / 1024
+    print(f'  Saved {outputfile} ({len(dfpackets):.1e} packets, {filesizein:.1f} MiB -> {filesizeout:.1f} MiB)')
+
+    return outputfile
+
+
+# the summary index of each packets file has the min and max of these columns for each packet type
+summary_range_columns = ('escape_time', 't_arrive_d', 'nu_rf')
+
+
+def get_summary_path(packetsfile):
+    packetsfile = Path(packetsfile)
+    return Path(packetsfile.parent, '__artistoolscache__.nosync', f'{packetsfile.name}.summary.json')
+
+
+def make_summary_groups(dfpackets, groups=None):
+    """Add the packet counts, column ranges and energy sums by (type_id, escape_type_id) to groups."""
+    groups = {} if groups is None else groups
+    for (type_id, escape_type_id), dfgroup in dfpackets.groupby(['type_id', 'escape_type_id']):
+        chunkgroup = {'type_id': int(type_id), 'escape_type_id': int(escape_type_id), 'count': len(dfgroup)}
+        for col in summary_range_columns:
+            chunkgroup[f'{col}_min'] = float(dfgroup[col].min())
+            chunkgroup[f'{col}_max'] = float(dfgroup[col].max())
+        chunkgroup['e_rf_sum'] = float(dfgroup['e_rf'].sum())
+        chunkgroup['e_cmf_sum'] = float(dfgroup['e_cmf'].sum())
+
+        key = (chunkgroup['type_id'], chunkgroup['escape_type_id'])
+        if key not in groups:
+            groups[key] = chunkgroup
+        else:
+            group = groups[key]
+            for k, value in chunkgroup.items():
+                if k.endswith('_min'):
+                    group[k] = float(np.nanmin([group[k], value]))
+                elif k.endswith('_max'):
+                    group[k] = float(np.nanmax([group[k], value]))
+                elif k == 'count' or k.endswith('_sum'):
+                    group[k] += value
+
+    return groups
+
+
+def write_summary(packetsfile, groups):
+    packetsfile = Path(packetsfile)
+    summarypath = get_summary_path(packetsfile)
+    summarypath.parent.mkdir(exist_ok=True)
+
+    summary = {
+        'filesize': packetsfile.stat().st_size,
+        'mtime': packetsfile.stat().st_mtime,
+        # NaN (e.g. the ranges of columns that are missing from old files) is stored as null
+        'groups': [{k: (None if isinstance(v, float) and math.isnan(v) else v) for k, v in group.items()}
+                   for group in groups.values()],
+    }
+
+    summarypathtmp = summarypath.with_suffix('.tmp')
+    with summarypathtmp.open('w') as fsummary:
+        json.dump(summary, fsummary, indent=1)
+    os.replace(summarypathtmp, summarypath)
+
+
+def get_summary(packetsfile):
+    """Return a list of dicts with the count, column ranges, and energy sums of each packet type in a packets file.
+
+    The summary is saved next to the disk cache and regenerated if the packets file size or modification time change.
+    """
+    packetsfile = Path(packetsfile)
+    summarypath = get_summary_path(packetsfile)
+    if summarypath.is_file():
+        with summarypath.open('r') as fsummary:
+            summary = json.load(fsummary)
+        if (summary['filesize'] == packetsfile.stat().st_size and summary['mtime'] == packetsfile.stat().st_mtime):
+            return summary['groups']
+
+    print(f'Making summary index of {packetsfile}')
+    groups = {}
+    for dfpackets in iter_chunks(packetsfile, chunksize=at.config['packets_chunksize'] or 1000000,
+                                 columns=['type_id', 'escape_type_id', *summary_range_columns, 'e_rf', 'e_cmf']):
+        groups = make_summary_groups(dfpackets, groups)
+
+    write_summary(packetsfile, groups)
+
+    return get_summary(packetsfile)
+
+
+def summary_group_may_match(group, filters):
+    """Return False if none of the packets in a summary group can match the filters."""
+    for col, op, value in filters:
+        if col in ['type_id', 'escape_type_id']:
+            if not apply_filters(pd.DataFrame({col: [group[col]]}), [(col, op, value)])[col].any():
+                return False
+
+        elif col in summary_range_columns:
+            colmin, colmax = group[f'{col}_min'], group[f'{col}_max']
+            if colmin is None or colmax is None:
+                continue
+            if op in ['==', '='] and not (colmin <= value <= colmax):
+                return False
+            elif op == '<' and not (colmin < value):
+                return False
+            elif op == '<=' and not (colmin <= value):
+                return False
+            elif op == '>' and not (colmax > value):
+                return False
+            elif op == '>=' and not (colmax >= value):
+                return False
+            elif op == 'in' and not any(colmin <= v <= colmax for v in value):
+                return False
+
+    return True
+
+
+def file_may_match(packetsfile, type=None, escape_type=None, filters=None):
+    """Use the summary index to check whether a packets file could contain any packets matching the filters."""
+    filters = [*get_type_filters(type, escape_type), *at.makelist(filters)]
+
+    return any(summary_group_may_match(group, filters) for group in get_summary(packetsfile))
+
+
+def filter_packetsfiles(packetsfiles, type=None, escape_type=None, filters=None):
+    """Return the packets files that could contain packets matching the filters (same arguments as readfile).
+
+    Files are only skipped if the disk cache is enabled, since the summary index is saved there. Normalisation
+    should still use the total number of packets files.
+    """
+    if not at.config['enable_diskcache'] or not packetsfiles:
+        return list(packetsfiles)
+
+    # make any missing summaries in parallel
+    at.get_executor().map(get_summary, packetsfiles)
+
+    packetsfiles_matching = [
+        f for f in packetsfiles if file_may_match(f, type=type, escape_type=escape_type, filters=filters)]
+
+    if len(packetsfiles_matching) < len(packetsfiles):
+        print(f'Skipping {len(packetsfiles) - len(packetsfiles_matching)} of {len(packetsfiles)} packets files '
+              'that have no matching packets')
+
+    return packetsfiles_matching
+
+
+def get_where_index_path(packetsfile):
+    packetsfile = Path(packetsfile)
+    return Path(packetsfile.parent, '__artistoolscache__.nosync', f'{packetsfile.name}.whereindex.npz')
+
+
+def make_where_index(packetsfile):
+    """Return the propagation cells (where) of the packets in a file, with the row numbers of the packets in each
+    cell in compressed sparse row form: the rows of cells[i] are rowindices[offsets[i]:offsets[i + 1]]."""
+    where = np.concatenate([
+        dfpackets['where'].values for dfpackets in iter_chunks(
+            packetsfile, chunksize=at.config['packets_chunksize'] or 1000000, columns=['where'])])
+
+    rowindices = np.argsort(where, kind='stable')
+    cells, counts = np.unique(where[rowindices], return_counts=True)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    return {'cells': cells, 'offsets': offsets, 'rowindices': rowindices}
+
+
+def get_where_index(packetsfile):
+    """Return the propagation cell index of a packets file (see make_where_index).
+
+    With the disk cache enabled, the index is saved next to the disk cache and regenerated if the packets file size
+    or modification time change.
+    """
+    packetsfile = Path(packetsfile)
+    if not at.config['enable_diskcache']:
+        return make_where_index(packetsfile)
+
+    indexpath = get_where_index_path(packetsfile)
+    if indexpath.is_file():
+        with np.load(indexpath) as indexdata:
+            if (indexdata['filesize'] == packetsfile.stat().st_size and
+                    indexdata['mtime'] == packetsfile.stat().st_mtime):
+                return {key: indexdata[key] for key in ['cells', 'offsets', 'rowindices']}
+
+    print(f'Making propagation cell index of {packetsfile}')
+    whereindex = make_where_index(packetsfile)
+
+    indexpath.parent.mkdir(exist_ok=True)
+    indexpathtmp = indexpath.with_suffix('.tmp.npz')
+    np.savez(indexpathtmp, filesize=packetsfile.stat().st_size, mtime=packetsfile.stat().st_mtime, **whereindex)
+    os.replace(indexpathtmp, indexpath)
+
+    return whereindex
+
+
+def get_cell_row_indices(packetsfile, cells):
+    """Return the sorted row numbers of the packets in a file that are in any of the propagation cells."""
+    whereindex = get_where_index(packetsfile)
+    cellindices = np.flatnonzero(np.isin(whereindex['cells'], list(cells)))
+    offsets = whereindex['offsets']
+    rowindices = [whereindex['rowindices'][offsets[i]:offsets[i + 1]] for i in cellindices]
+
+    return np.sort(np.concatenate(rowindices)) if rowindices else np.array([], dtype=int)
+
+
+def file_has_cells(packetsfile, cells):
+    """Use the propagation cell index to check whether a packets file has any packets in the cells."""
+    return np.isin(get_where_index(packetsfile)['cells'], list(cells)).any()
+
+
+def readfile_cells(packetsfile, cells, type=None, escape_type=None, columns=None, filters=None):
+    """Read only the packets in a list of propagation cells (where) from a packets file.
+
+    For NumPy binary files, only the rows of these packets (according to the cell index) are read from the memory
+    map. Other formats are read with a filter on 'where', which Parquet files can push down to skip row groups (most
+    effectively for files written with sortbywhere=True).
+    """
+    packetsfile = Path(packetsfile)
+    if packetsfile.suffixes != ['.out', '.npy']:
+        # not disk cached, since each set of cells would be saved as a new cache file
+        return readfile_uncached(packetsfile, type=type, escape_type=escape_type, columns=columns,
+                                 filters=[('where', 'in', tuple(cells)), *at.makelist(filters)])
+
+    filters, filters_stored, filters_derived = split_filters(type, escape_type, filters)
+    readcolumns = get_columns_to_read(columns, filters)
+
+    packets = np.load(packetsfile, mmap_mode='r')
+    if readcolumns is None:
+        readcolumns = packets.dtype.names
+    rowindices = get_cell_row_indices(packetsfile, cells)
+    dfpackets = pd.DataFrame({col: packets[col][rowindices] for col in readcolumns if col in packets.dtype.names})
+
+    return finalise_packets_frame(
+        apply_filters(apply_packet_dtypes(dfpackets), filters_stored), columns, filters, filters_derived)
 
 
 @lru_cache(maxsize=16)
@@ -268,7 +1079,9 @@ def get_packetsfilepaths(modelpath, maxpacketfiles=None):
     def preferred_alternative(f, files):
         f_nosuffixes = at.stripallsuffixes(f)
 
-        suffix_priority = [['.out', '.gz'], ['.out', '.xz'], ['.out', '.feather'], ['.out', '.parquet']]
+        suffix_priority = [
+            ['.out', '.zst'], ['.out', '.gz'], ['.out', '.xz'], ['.out', '.feather'], ['.out', '.parquet'],
+            ['.out', '.npy']]
         if f.suffixes in suffix_priority:
             startindex = suffix_priority.index(f.suffixes) + 1
         else:
@@ -292,115 +1105,155 @@ def get_packetsfilepaths(modelpath, maxpacketfiles=None):
     return packetsfiles
 
 
-def get_escaping_packet_angle_bin(modelpath, dfpackets):
-    MABINS = 100
+def get_angle_bins(dirx, diry, dirz, syn_dir, nabins=100):
+    """Return the viewing angle bin numbers of packet direction vectors, with the numbering used by ARTIS exspec.
 
-    syn_dir = at.get_syn_dir(modelpath)
+    There are sqrt(nabins) bins in each of cos(theta) and phi, where theta is measured from syn_dir, and the
+    angle bin number is costheta_index * sqrt(nabins) + phi_index (as in the *_res.out files).
+    """
+    nphibins = int(round(math.sqrt(nabins)))
+    assert nphibins ** 2 == nabins
 
-    angle_number = np.zeros(len(dfpackets))
-    i = 0
-    for pkt_index, _ in dfpackets.iterrows():
-        pkt_dir = [dfpackets['dirx'][pkt_index], dfpackets['diry'][pkt_index], dfpackets['dirz'][pkt_index]]
-        costheta = at.dot(pkt_dir, syn_dir)
-        thetabin = ((costheta + 1.0) * np.sqrt(MABINS) / 2.0)
-        vec1 = vec2 = vec3 = [0, 0, 0]
-        xhat = [1, 0, 0]
-        vec1 = at.cross_prod(pkt_dir, syn_dir, vec1)
-        vec2 = at.cross_prod(xhat, syn_dir, vec2)
-        cosphi = at.dot(vec1, vec2) / at.vec_len(vec1) / at.vec_len(vec2)
+    pkt_dir = np.column_stack([dirx, diry, dirz]).astype(float)
+    syn_dir = np.asarray(syn_dir, dtype=float)
+    xhat = np.array([1., 0., 0.])
 
-        vec3 = at.cross_prod(vec2, syn_dir, vec3)
-        testphi = at.dot(vec1, vec3)
+    costheta = pkt_dir @ syn_dir
+    costhetabin = np.floor((costheta + 1.0) * nphibins / 2.0).astype(int)
+
+    vec1 = np.cross(pkt_dir, syn_dir)
+    vec2 = np.cross(xhat, syn_dir)
+    vec3 = np.cross(vec2, syn_dir)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cosphi = (vec1 @ vec2) / np.linalg.norm(vec1, axis=1) / np.linalg.norm(vec2)
+
+    # phi is undefined for directions parallel to syn_dir, so these get cosphi = 1
+    cosphi = np.clip(np.nan_to_num(cosphi, nan=1.), -1., 1.)
+
+    testphi = vec1 @ vec3
+    phi = np.where(testphi > 0, np.arccos(cosphi), np.arccos(cosphi) + np.pi)
+    phibin = np.floor(phi / 2. / np.pi * nphibins).astype(int)
+
+    # cos(theta) = 1 and phi = 2 pi are included in the last bins
+    costhetabin = np.clip(costhetabin, 0, nphibins - 1)
+    phibin = np.clip(phibin, 0, nphibins - 1)
+
+    return costhetabin * nphibins + phibin
+
+
+def get_escaping_packet_angle_bin(modelpath, dfpackets, nabins=100):
+    """Add an angle_bin column with the viewing angle bin of each escaping packet."""
+    syn_dir = at.get_syn_dir(Path(modelpath))
+
+    dfpackets['angle_bin'] = get_angle_bins(
+        dfpackets['dirx'].values, dfpackets['diry'].values, dfpackets['dirz'].values, syn_dir, nabins=nabins)
 
-        if testphi > 0:
-            phibin = (math.acos(cosphi) / 2. / np.pi * np.sqrt(MABINS))
-        else:
-            phibin = ((math.acos(cosphi) + np.pi) / 2. / np.pi * np.sqrt(MABINS))
-        na = (thetabin * np.sqrt(MABINS)) + phibin  # think na is angle number???
-        if na >= 100:
-            print(f'error bin number too high {na}')
-        angle_number[i] = int(na)
-        i += 1
-
-    dfpackets['angle_bin'] = angle_number
     return dfpackets
 
 
-def make_3d_histogram_from_packets(modelpath, timestep):
+def get_3d_histogram_onefile(packetsfile, timebinedges, gridbinedges, weight_by_energy=False):
+    """Return the flat indices and values of the non-zero bins of the (timestep, x, y, z) emission velocity
+    histogram of the escaped r-packets in one packets file."""
+    hist = np.zeros((len(timebinedges) - 1, *[len(edges) - 1 for edges in gridbinedges]))
+
+    for dfpackets in iter_chunks(packetsfile, chunksize=at.config['packets_chunksize'], type='TYPE_ESCAPE',
+                                 escape_type='TYPE_RPKT',
+                                 columns=['escape_time', 'em_posx', 'em_posy', 'em_posz', 'em_time', 'e_rf']):
+        em_time = dfpackets['em_time'].values
+        emission_velocity3d = np.column_stack([
+            dfpackets['em_posx'].values / em_time / CLIGHT,
+            dfpackets['em_posy'].values / em_time / CLIGHT,
+            dfpackets['em_posz'].values / em_time / CLIGHT])
+
+        # drop packets without a defined emission velocity
+        hasemvel = np.isfinite(emission_velocity3d).all(axis=1)
+
+        samples = np.column_stack([dfpackets['escape_time'].values[hasemvel] / DAY, emission_velocity3d[hasemvel]])
+        weights = dfpackets['e_rf'].values[hasemvel] if weight_by_energy else None
+
+        chunkhist, _ = np.histogramdd(samples, [timebinedges, *gridbinedges], weights=weights)
+        hist += chunkhist
+
+    hist = hist.ravel()
+    flatindices = np.flatnonzero(hist)
+
+    return flatindices, hist[flatindices]
+
+
+def make_3d_histogram_cube(modelpath, weight_by_energy=False, outputpath=None):
+    """Make a histogram of the emission velocities of escaped r-packets for every timestep in a single pass.
+
+    The packets files are histogrammed in parallel and added into a (timestep, x, y, z) cube on the model grid,
+    which is saved as a .npy file and returned as a memory map, so that timesteps can be sliced without
+    reading the whole cube. If weight_by_energy, the cube contains the emitted luminosity instead of packet counts.
+    """
     modeldata, _, vmax_cms = at.inputmodel.get_modeldata(modelpath)
 
     timeminarray = at.get_timestep_times_float(modelpath=modelpath, loc='start')
     timedeltaarray = at.get_timestep_times_float(modelpath=modelpath, loc='delta')
     timemaxarray = at.get_timestep_times_float(modelpath=modelpath, loc='end')
+    timebinedges = np.append(timeminarray, timemaxarray[-1])
 
-    # timestep = 63 # 82 73 #63 #54 46 #27
-    print([(ts, time) for ts, time in enumerate(timeminarray)])
+    grid_3d, _, _, _ = make_3d_grid(modeldata, vmax_cms)
+    # https://stackoverflow.com/questions/49861468/binning-random-data-to-regular-3d-grid-with-unequal-axis-lengths
+    gridbinedges = [np.append(ax, np.inf) for ax in grid_3d]
 
     packetsfiles = at.packets.get_packetsfilepaths(modelpath)
 
-    emission_position3d = [[], [], []]
-    e_rf = []
+    if outputpath is None:
+        outputpath = Path(modelpath, f"packets_emission3dhist{'_energy' if weight_by_energy else ''}.npy")
 
-    for npacketfile in range(0, len(packetsfiles)):
-        # for npacketfile in range(0, 1):
-        dfpackets = at.packets.readfile(packetsfiles[npacketfile])
-        at.packets.add_derived_columns(dfpackets, modelpath, ['emission_velocity'])
-        dfpackets = dfpackets.dropna(subset=['emission_velocity'])  # drop rows where emission_vel is NaN
+    print(f'Making emission velocity histogram for {len(timeminarray)} timesteps from {len(packetsfiles)} '
+          f'packets files, saving to {outputpath}')
 
-        # print(dfpackets[['emission_velocity', 'em_velx', 'em_vely', 'em_velz']])
-        # select only type escape and type r-pkt (don't include gamma-rays)
-        dfpackets.query(f'type_id == {type_ids["TYPE_ESCAPE"]} and escape_type_id == {type_ids["TYPE_RPKT"]}',
-                        inplace=True)
-        dfpackets.query('@timeminarray[@timestep] < escape_time/@DAY < @timemaxarray[@timestep]', inplace=True)
+    # write to a temporary file, so that an interrupted run does not leave an incomplete cube at outputpath
+    outputpathtmp = Path(outputpath).with_suffix('.tmp.npy')
+    hist = np.lib.format.open_memmap(
+        outputpathtmp, mode='w+', dtype=float, shape=(len(timeminarray), *[len(ax) for ax in grid_3d]))
+    hist[:] = 0.
+    histflat = hist.reshape(-1)
 
-        emission_position3d[0].extend([em_velx / CLIGHT for em_velx in dfpackets['em_velx']])
-        emission_position3d[1].extend([em_vely / CLIGHT for em_vely in dfpackets['em_vely']])
-        emission_position3d[2].extend([em_velz / CLIGHT for em_velz in dfpackets['em_velz']])
+    processfile = partial(get_3d_histogram_onefile, timebinedges=timebinedges, gridbinedges=gridbinedges,
+                          weight_by_energy=weight_by_energy)
 
-        e_rf.extend([e_rf for e_rf in dfpackets['e_rf']])
+    for flatindices, values in at.get_executor().map(processfile, packetsfiles):
+        histflat[flatindices] += values
 
-    emission_position3d = np.array(emission_position3d)
-    weight_by_energy = False
     if weight_by_energy:
-        e_rf = np.array(e_rf)
-        weights = e_rf
-    else:
-        weights = None
+        # Divide binned energies by number of processes and by length of timestep
+        for timestep, timedelta in enumerate(timedeltaarray):
+            hist[timestep] /= len(packetsfiles) * timedelta
 
-    print(emission_position3d.shape)
-    print(emission_position3d[0].shape)
+    hist.flush()
+    del hist, histflat
+    os.replace(outputpathtmp, outputpath)
 
-    # print(emission_position3d)
-    grid_3d, _, _, _ = make_3d_grid(modeldata, vmax_cms)
-    print(grid_3d)
-    # https://stackoverflow.com/questions/49861468/binning-random-data-to-regular-3d-grid-with-unequal-axis-lengths
-    hist, _ = np.histogramdd(emission_position3d.T, [np.append(ax, np.inf) for ax in grid_3d], weights=weights)
-    # print(hist.shape)
-    if weight_by_energy:
-        # Divide binned energies by number of processes and by length of timestep
-        hist = hist / len(packetsfiles) / timedeltaarray[timestep]  # histogram weighted by energy
-    # - need to divide by number of processes
-    # and length of timestep
+    return np.load(outputpath, mmap_mode='r')
 
-    # # print histogram coordinates
-    # coords = np.nonzero(hist)
-    # for i, j, k in zip(*coords):
-    #     print(f'({grid_3d[0][i]}, {grid_3d[1][j]}, {grid_3d[2][k]}): {hist[i][j][k]}')
 
-    return hist
+def get_3d_histogram_cube(modelpath, weight_by_energy=False):
+    """Return the (timestep, x, y, z) emission velocity histogram (see make_3d_histogram_cube), reading the saved
+    cube if it is newer than the packets files."""
+    cubepath = Path(modelpath, f"packets_emission3dhist{'_energy' if weight_by_energy else ''}.npy")
+    if cubepath.is_file():
+        packetsfiles = at.packets.get_packetsfilepaths(modelpath)
+        if all(cubepath.stat().st_mtime > Path(f).stat().st_mtime for f in packetsfiles):
+            print(f'Reading {cubepath}')
+            return np.load(cubepath, mmap_mode='r')
+
+    return make_3d_histogram_cube(modelpath, weight_by_energy=weight_by_energy, outputpath=cubepath)
+
+
+def make_3d_histogram_from_packets(modelpath, timestep, weight_by_energy=False):
+    return np.array(get_3d_histogram_cube(modelpath, weight_by_energy=weight_by_energy)[timestep])
 
 
 def make_3d_grid(modeldata, vmax_cms):
     # modeldata, _, vmax_cms = at.inputmodel.get_modeldata(modelpath)
     grid = round(len(modeldata['inputcellid']) ** (1. / 3.))
-    xgrid = np.zeros(grid)
     vmax = vmax_cms / CLIGHT
-    i = 0
-    for z in range(0, grid):
-        for y in range(0, grid):
-            for x in range(0, grid):
-                xgrid[x] = -vmax + 2 * x * vmax / grid
-                i += 1
+    xgrid = -vmax + 2 * np.arange(grid) * vmax / grid
 
     x, y, z = np.meshgrid(xgrid, xgrid, xgrid)
     grid_3d = np.array([xgrid, xgrid, xgrid])
@@ -409,9 +1262,46 @@ def make_3d_grid(modeldata, vmax_cms):
     return grid_3d, x, y, z
 
 
-def get_mean_packet_emission_velocity_per_ts(modelpath, packet_type='TYPE_ESCAPE', escape_type='TYPE_RPKT',
-                                             maxpacketfiles=None, escape_angles=None):
+def get_emission_velocity_moments_onefile(packetsfile, timearrayplusend, packet_type='TYPE_ESCAPE',
+                                          escape_type='TYPE_RPKT', syn_dir=None, nabins=None):
+    """Return the packet count, emission velocity sum, and emission velocity squared sum in each
+    (angle bin, time bin) for one packets file. Without nabins, there is a single angle bin."""
+    columns = ['t_arrive_d', 'em_posx', 'em_posy', 'em_posz', 'em_time']
+    if nabins is not None:
+        columns += ['dirx', 'diry', 'dirz']
+
+    ntimebins = len(timearrayplusend) - 1
+    shape = (1 if nabins is None else nabins, ntimebins)
+    counts, sums, sumsquares = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    for dfpackets in iter_chunks(packetsfile, chunksize=at.config['packets_chunksize'], type=packet_type,
+                                 escape_type=escape_type, columns=columns):
+        emission_velocity = np.sqrt(
+            dfpackets['em_posx'].values ** 2 + dfpackets['em_posy'].values ** 2 +
+            dfpackets['em_posz'].values ** 2) / dfpackets['em_time'].values
+
+        timebins = at.packets.accumulate.get_bin_indices(dfpackets['t_arrive_d'].values, timearrayplusend)
+        if nabins is None:
+            anglebins = np.zeros(len(dfpackets), dtype=int)
+        else:
+            anglebins = get_angle_bins(dfpackets['dirx'].values, dfpackets['diry'].values, dfpackets['dirz'].values,
+                                       syn_dir, nabins=nabins)
+
+        # packets without an emission velocity are skipped, as in the mean of a pandas groupby
+        selected = (timebins >= 0) & np.isfinite(emission_velocity)
+        flatindices = anglebins[selected] * ntimebins + timebins[selected]
+        emission_velocity = emission_velocity[selected]
+
+        counts += np.bincount(flatindices, minlength=counts.size).reshape(shape)
+        sums += np.bincount(flatindices, weights=emission_velocity, minlength=sums.size).reshape(shape)
+        sumsquares += np.bincount(flatindices, weights=emission_velocity ** 2, minlength=sums.size).reshape(shape)
 
+    return counts, sums, sumsquares
+
+
+def get_emission_velocity_moments(modelpath, packet_type='TYPE_ESCAPE', escape_type='TYPE_RPKT', maxpacketfiles=None,
+                                  nabins=None):
+    """Return the time bin edges, and the packet counts, emission velocity sums, and emission velocity squared sums
+    in each (angle bin, time bin). The packets files are read once, in parallel, for all of the angle bins."""
     packetsfiles = at.packets.get_packetsfilepaths(modelpath, maxpacketfiles=maxpacketfiles)
     nprocs_read = len(packetsfiles)
     assert nprocs_read > 0
@@ -420,28 +1310,58 @@ def get_mean_packet_emission_velocity_per_ts(modelpath, packet_type='TYPE_ESCAPE
     arr_timedelta = at.get_timestep_times_float(modelpath=modelpath, loc='delta')
     timearrayplusend = np.concatenate([timearray, [timearray[-1] + arr_timedelta[-1]]])
 
-    dfpackets_escape_velocity_and_arrive_time = pd.DataFrame
-    emission_data = pd.DataFrame({'t_arrive_d': timearray,
-                                  'mean_emission_velocity': np.zeros_like(timearray, dtype=float)})
-
-    for i, packetsfile in enumerate(packetsfiles):
-        dfpackets = at.packets.readfile(packetsfile, type=packet_type, escape_type=escape_type)
-        at.packets.add_derived_columns(dfpackets, modelpath, ['emission_velocity'])
-        if escape_angles is not None:
-            dfpackets = at.packets.get_escaping_packet_angle_bin(modelpath, dfpackets)
-            dfpackets.query('angle_bin == @escape_angles', inplace=True)
-
-        if i == 0:  # make new df
-            dfpackets_escape_velocity_and_arrive_time = dfpackets[['t_arrive_d', 'emission_velocity']]
-        else:  # append to df
-            dfpackets_escape_velocity_and_arrive_time = dfpackets_escape_velocity_and_arrive_time.append(
-                dfpackets[['t_arrive_d', 'emission_velocity']], ignore_index=True)
-
-    print(dfpackets_escape_velocity_and_arrive_time)
-    binned = pd.cut(dfpackets_escape_velocity_and_arrive_time['t_arrive_d'], timearrayplusend,
-                    labels=False, include_lowest=True)
-    for binindex, emission_velocity in dfpackets_escape_velocity_and_arrive_time.groupby(binned)[
-            'emission_velocity'].mean().iteritems():
-        emission_data['mean_emission_velocity'][binindex] += emission_velocity  # / 2.99792458e10
+    syn_dir = at.get_syn_dir(Path(modelpath)) if nabins is not None else None
+
+    processfile = partial(get_emission_velocity_moments_onefile, timearrayplusend=timearrayplusend,
+                          packet_type=packet_type, escape_type=escape_type, syn_dir=syn_dir, nabins=nabins)
+
+    shape = (1 if nabins is None else nabins, len(timearray))
+    counts, sums, sumsquares = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    for filecounts, filesums, filesumsquares in at.get_executor().map(processfile, packetsfiles):
+        counts += filecounts
+        sums += filesums
+        sumsquares += filesumsquares
+
+    return timearrayplusend, counts, sums, sumsquares
+
+
+def get_mean_packet_emission_velocity_per_ts(modelpath, packet_type='TYPE_ESCAPE', escape_type='TYPE_RPKT',
+                                             maxpacketfiles=None, escape_angles=None):
+    """Return the mean emission velocity of the packets arriving in each time bin, optionally only for the packets
+    in the escape_angles viewing angle bin(s)."""
+    timearrayplusend, counts, sums, sumsquares = get_emission_velocity_moments(
+        modelpath, packet_type=packet_type, escape_type=escape_type, maxpacketfiles=maxpacketfiles,
+        nabins=None if escape_angles is None else 100)
+
+    if escape_angles is not None:
+        counts = counts[np.atleast_1d(escape_angles)]
+        sums = sums[np.atleast_1d(escape_angles)]
+
+    counts = counts.sum(axis=0)
+    sums = sums.sum(axis=0)
+
+    # time bins without any packets have zero mean velocity
+    emission_data = pd.DataFrame({'t_arrive_d': timearrayplusend[:-1],
+                                  'mean_emission_velocity': np.divide(sums, counts, out=np.zeros_like(sums),
+                                                                      where=counts > 0)})
 
     return emission_data
+
+
+def get_mean_packet_emission_velocity_per_angle(modelpath, packet_type='TYPE_ESCAPE', escape_type='TYPE_RPKT',
+                                                maxpacketfiles=None, nabins=100):
+    """Return a DataFrame with the packet count, and mean and standard deviation of the emission velocity of the
+    packets arriving in each (viewing angle bin, time bin)."""
+    timearrayplusend, counts, sums, sumsquares = get_emission_velocity_moments(
+        modelpath, packet_type=packet_type, escape_type=escape_type, maxpacketfiles=maxpacketfiles, nabins=nabins)
+
+    mean = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    variance = np.divide(sumsquares, counts, out=np.zeros_like(sums), where=counts > 0) - mean ** 2
+
+    return pd.DataFrame({
+        'angle_bin': np.repeat(np.arange(nabins), len(timearrayplusend) - 1),
+        't_arrive_d': np.tile(timearrayplusend[:-1], nabins),
+        'packetcount': counts.ravel().astype(int),
+        'mean_emission_velocity': mean.ravel(),
+        'std_emission_velocity': np.sqrt(np.clip(variance, 0., None)).ravel(),
+    })
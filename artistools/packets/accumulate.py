@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""Read each packets file once and fill several binned products (spectra, light curves, etc) in the same pass."""
+
+import hashlib
+import os
+from collections import namedtuple
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+
+import artistools as at
+
+CLIGHT_ANGSTROM_S = 2.99792458e18
+
+# columns that can be binned but are calculated from the packets file columns
+derived_bin_columns = {
+    'lambda_angstroms': ('nu_rf',),
+    'absorption_lambda_angstroms': ('absorption_freq',),
+    'angle_bin': ('dirx', 'diry', 'dirz'),
+}
+
+packetaccumulator = namedtuple('packetaccumulator', 'type escape_type filters weightcolumn bins groupbycolumn')
+
+
+def make_accumulator(bins=(), weightcolumn='e_rf', groupbycolumn=None, type='TYPE_ESCAPE', escape_type='TYPE_RPKT',
+                     filters=None):
+    """Define a histogram of the packets that match type, escape_type, and filters (as for at.packets.readfile).
+
+    bins is a list of (column, binedges) pairs, where column is a packets column or one of derived_bin_columns.
+    Like pd.cut(right=True, include_lowest=True), each bin includes its upper edge and the lowest bin also includes
+    its lower edge. For 'angle_bin', give the number of viewing angle bins (MABINS) instead of the bin edges.
+
+    The histogram is the sum of weightcolumn (or the packet count if weightcolumn is None) in each bin. If
+    groupbycolumn is specified, the result is a dict of histograms keyed by the values of this column.
+    """
+    bins = tuple((col, edges if isinstance(edges, int) else np.asarray(edges, dtype=float)) for col, edges in bins)
+
+    return packetaccumulator(type=type, escape_type=escape_type, filters=tuple(at.makelist(filters)),
+                             weightcolumn=weightcolumn, bins=bins, groupbycolumn=groupbycolumn)
+
+
+def get_accumulator_shape(accumulator):
+    return tuple(edges if isinstance(edges, int) else len(edges) - 1 for _, edges in accumulator.bins)
+
+
+def get_accumulator_filters(accumulator):
+    return [*at.packets.get_type_filters(accumulator.type, accumulator.escape_type), *accumulator.filters]
+
+
+def get_accumulator_columns(accumulator):
+    """Return the packets columns needed to fill a histogram."""
+    columns = [f[0] for f in get_accumulator_filters(accumulator)]
+    for col, _ in accumulator.bins:
+        columns.extend(derived_bin_columns.get(col, (col,)))
+    if accumulator.weightcolumn is not None:
+        columns.append(accumulator.weightcolumn)
+    if accumulator.groupbycolumn is not None:
+        columns.append(accumulator.groupbycolumn)
+
+    return columns
+
+
+def get_bin_indices(values, binedges):
+    """Return the bin index of each value (bins include the upper edge), or -1 if outside all bins."""
+    binindices = np.digitize(values, binedges, right=True) - 1
+    binindices[values == binedges[0]] = 0
+    binindices[(binindices < 0) | (binindices >= len(binedges) - 1)] = -1
+
+    return binindices
+
+
+def get_empty_result(accumulator):
+    if accumulator.groupbycolumn is not None:
+        return {}
+
+    return np.zeros(get_accumulator_shape(accumulator))
+
+
+def add_results(result1, result2):
+    """Add two histograms or dicts of histograms."""
+    if isinstance(result1, dict):
+        result = dict(result1)
+        for key, histogram in result2.items():
+            result[key] = result[key] + histogram if key in result else histogram
+        return result
+
+    return result1 + result2
+
+
+def accumulate_chunk(accumulator, dfpackets, syn_dir=None, filters_applied=()):
+    """Return the histogram of a DataFrame of packets."""
+    dfpackets = at.packets.apply_filters(
+        dfpackets, [f for f in get_accumulator_filters(accumulator) if f not in filters_applied])
+
+    shape = get_accumulator_shape(accumulator)
+    flatindices = np.zeros(len(dfpackets), dtype=int)
+    inbins = np.ones(len(dfpackets), dtype=bool)
+    for (col, edges), nbins in zip(accumulator.bins, shape):
+        if col == 'angle_bin':
+            binindices = at.packets.get_angle_bins(
+                dfpackets['dirx'].values, dfpackets['diry'].values, dfpackets['dirz'].values, syn_dir, nabins=edges)
+        elif col in ['lambda_angstroms', 'absorption_lambda_angstroms']:
+            binindices = get_bin_indices(CLIGHT_ANGSTROM_S / dfpackets[derived_bin_columns[col][0]].values, edges)
+        else:
+            binindices = get_bin_indices(dfpackets[col].values, edges)
+
+        inbins &= (binindices >= 0)
+        flatindices = flatindices * nbins + binindices
+
+    flatindices = flatindices[inbins]
+    weights = dfpackets[accumulator.weightcolumn].values[inbins] if accumulator.weightcolumn is not None else None
+    histsize = int(np.prod(shape))
+
+    if accumulator.groupbycolumn is None:
+        return np.bincount(flatindices, weights=weights, minlength=histsize).astype(float).reshape(shape)
+
+    groupvalues, groupindices = np.unique(dfpackets[accumulator.groupbycolumn].values[inbins], return_inverse=True)
+    histograms = np.bincount(
+        groupindices * histsize + flatindices, weights=weights,
+        minlength=len(groupvalues) * histsize).astype(float).reshape((len(groupvalues), *shape))
+
+    return {groupvalue.item(): histograms[i] for i, groupvalue in enumerate(groupvalues)}
+
+
+def get_accumulator_hash(accumulator, syn_dir=None, packetfraction=None):
+    """Return a hash of the accumulator definition (and viewing direction and packet fraction if used), which keys
+    its cached results."""
+    bins = [(col, edges if isinstance(edges, int) else edges.tolist()) for col, edges in accumulator.bins]
+    usesangles = any(col == 'angle_bin' for col, _ in accumulator.bins)
+    definition = (accumulator.type, accumulator.escape_type, accumulator.filters, accumulator.weightcolumn,
+                  bins, accumulator.groupbycolumn, list(syn_dir) if usesangles else None)
+    if packetfraction is not None and packetfraction < 1.:
+        definition += (packetfraction,)
+
+    return hashlib.sha1(repr(definition).encode('utf-8')).hexdigest()[:16]
+
+
+def get_binnedcache_path(packetsfile, accumulator, syn_dir=None, packetfraction=None):
+    packetsfile = Path(packetsfile)
+    accumulatorhash = get_accumulator_hash(accumulator, syn_dir=syn_dir, packetfraction=packetfraction)
+    return Path(packetsfile.parent, '__artistoolscache__.nosync', f'{packetsfile.name}.binned_{accumulatorhash}.npz')
+
+
+def read_binnedcache(packetsfile, accumulator, syn_dir=None, packetfraction=None):
+    """Return the cached histogram of a packets file, or None if it is missing or the packets file has changed."""
+    packetsfile = Path(packetsfile)
+    cachepath = get_binnedcache_path(packetsfile, accumulator, syn_dir=syn_dir, packetfraction=packetfraction)
+    if not cachepath.is_file():
+        return None
+
+    with np.load(cachepath) as cachedata:
+        if (cachedata['filesize'] != packetsfile.stat().st_size or
+                cachedata['mtime'] != packetsfile.stat().st_mtime):
+            return None
+
+        if accumulator.groupbycolumn is not None:
+            return {groupvalue.item(): histogram
+                    for groupvalue, histogram in zip(cachedata['groupvalues'], cachedata['histograms'])}
+
+        return cachedata['histogram']
+
+
+def write_binnedcache(packetsfile, accumulator, result, syn_dir=None, packetfraction=None):
+    packetsfile = Path(packetsfile)
+    cachepath = get_binnedcache_path(packetsfile, accumulator, syn_dir=syn_dir, packetfraction=packetfraction)
+    cachepath.parent.mkdir(exist_ok=True)
+
+    if accumulator.groupbycolumn is not None:
+        histogramdata = {
+            'groupvalues': np.array(list(result.keys())),
+            'histograms': np.array(list(result.values())).reshape((len(result), *get_accumulator_shape(accumulator)))}
+    else:
+        histogramdata = {'histogram': result}
+
+    # write to a temporary file first so that parallel workers never read a partial file
+    cachepathtmp = cachepath.with_suffix('.tmp.npz')
+    np.savez_compressed(cachepathtmp, filesize=packetsfile.stat().st_size, mtime=packetsfile.stat().st_mtime,
+                        **histogramdata)
+    os.replace(cachepathtmp, cachepath)
+
+
+def accumulate_packets_file(packetsfile, accumulators, syn_dir=None, packetfraction=None, cache=False):
+    """Read a packets file once and return a dict of the histograms of each of the named accumulators.
+
+    If packetfraction is given, only this deterministic random fraction of the packets is used (see
+    at.packets.subsample_packets) and the weighted histograms are divided by packetfraction.
+
+    If cache is True and the disk cache is enabled, the histogram of each accumulator is saved for the packets file,
+    and the file is only read again for accumulators that have a different definition (filters, binning, etc) or if
+    the file changes. This is only worthwhile for accumulators that will be reused, such as those binned by timestep.
+    """
+    usecache = cache and at.config['enable_diskcache']
+    results = {}
+    if usecache:
+        for name, accumulator in accumulators.items():
+            cachedresult = read_binnedcache(packetsfile, accumulator, syn_dir=syn_dir, packetfraction=packetfraction)
+            if cachedresult is not None:
+                results[name] = cachedresult
+
+    accumulators_toread = {name: acc for name, acc in accumulators.items() if name not in results}
+    if not accumulators_toread:
+        return results
+
+    accfilters = [get_accumulator_filters(acc) for acc in accumulators_toread.values()]
+
+    # filters that all of the accumulators share can be pushed down to the reader
+    commonfilters = [f for f in accfilters[0] if all(f in filters for filters in accfilters[1:])]
+
+    columns = ['number'] if packetfraction is not None and packetfraction < 1. else []
+    for accumulator in accumulators_toread.values():
+        columns.extend(col for col in get_accumulator_columns(accumulator) if col not in columns)
+
+    results.update({name: get_empty_result(acc) for name, acc in accumulators_toread.items()})
+    for dfpackets in at.packets.iter_chunks(packetsfile, chunksize=at.config['packets_chunksize'],
+                                            columns=columns, filters=commonfilters):
+        dfpackets = at.packets.subsample_packets(dfpackets, packetsfile, packetfraction)
+        for name, accumulator in accumulators_toread.items():
+            results[name] = add_results(
+                results[name], accumulate_chunk(accumulator, dfpackets, syn_dir=syn_dir, filters_applied=commonfilters))
+
+    if packetfraction is not None and packetfraction < 1.:
+        for name, accumulator in accumulators_toread.items():
+            if accumulator.weightcolumn is not None:
+                results[name] = scale_result(results[name], 1. / packetfraction)
+
+    if usecache:
+        for name, accumulator in accumulators_toread.items():
+            write_binnedcache(packetsfile, accumulator, results[name], syn_dir=syn_dir, packetfraction=packetfraction)
+
+    return results
+
+
+def scale_result(result, factor):
+    """Multiply a histogram or dict of histograms by a factor."""
+    if isinstance(result, dict):
+        return {key: histogram * factor for key, histogram in result.items()}
+
+    return result * factor
+
+
+def get_result_total(result):
+    if isinstance(result, dict):
+        return sum(histogram.sum() for histogram in result.values())
+
+    return result.sum()
+
+
+def accumulate_packets(modelpath, accumulators, maxpacketfiles=None, packetfraction=None, cache=False):
+    """Fill a dict of named accumulators (see make_accumulator) in a single pass through the packets files.
+
+    The files are processed in parallel and the histograms summed. Returns the dict of histograms
+    and the total number of packets files (for normalisation, which includes any skipped files).
+
+    packetfraction < 1 uses a deterministic random subset of the packets in every file for quick previews, with
+    weights rescaled so that the results are unbiased, and prints the expected Monte Carlo noise.
+
+    cache=True saves the histograms of each packets file in the disk cache (see accumulate_packets_file).
+    """
+    packetsfiles = at.packets.get_packetsfilepaths(modelpath, maxpacketfiles)
+    nprocs_read = len(packetsfiles)
+
+    needsangles = any(col == 'angle_bin' for acc in accumulators.values() for col, _ in acc.bins)
+    syn_dir = at.get_syn_dir(Path(modelpath)) if needsangles else None
+
+    # files are only read if they could contain packets for at least one of the accumulators
+    packetsfiles_needed = set()
+    for accumulator in accumulators.values():
+        packetsfiles_needed.update(at.packets.filter_packetsfiles(
+            packetsfiles, type=accumulator.type, escape_type=accumulator.escape_type, filters=accumulator.filters))
+    packetsfiles_matching = [f for f in packetsfiles if f in packetsfiles_needed]
+
+    subsampling = packetfraction is not None and packetfraction < 1.
+    accumulators_read = dict(accumulators)
+    if subsampling:
+        # count the packets used by each weighted histogram to estimate the Monte Carlo noise
+        for name, accumulator in accumulators.items():
+            if accumulator.weightcolumn is not None:
+                accumulators_read[f'{name}_subsamplecount'] = accumulator._replace(weightcolumn=None)
+
+    processfile = partial(accumulate_packets_file, accumulators=accumulators_read, syn_dir=syn_dir,
+                          packetfraction=packetfraction, cache=cache)
+    fileresults = at.get_executor().map(processfile, packetsfiles_matching)
+
+    results = {name: get_empty_result(acc) for name, acc in accumulators_read.items()}
+    for fileresult in fileresults:
+        for name in accumulators_read:
+            results[name] = add_results(results[name], fileresult[name])
+
+    if subsampling:
+        for name in accumulators:
+            if f'{name}_subsamplecount' in results:
+                at.packets.print_packetfraction_noise(
+                    packetfraction, get_result_total(results.pop(f'{name}_subsamplecount')), label=name)
+
+    return results, nprocs_read
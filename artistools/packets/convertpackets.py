@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import argparse
+import multiprocessing
+from functools import partial
+from pathlib import Path
+
+import artistools as at
+import artistools.packets
+
+
+def get_textpacketsfilepaths(modelpath):
+    """Return the text (optionally gz, xz, or zst compressed) packets files of a model."""
+    packetsfiles = sorted(
+        list(Path(modelpath).glob('packets00_*.out*')) +
+        list(Path(modelpath, 'packets').glob('packets00_*.out*')))
+
+    return [f for f in packetsfiles if f.suffixes in at.packets.textsuffixes]
+
+
+def addargs(parser):
+    parser.add_argument('-modelpath', default='.', type=Path,
+                        help='Path to ARTIS folder with packets files')
+
+    parser.add_argument('-format', default='parquet', choices=['parquet', 'feather', 'npy'],
+                        help='File format to write (npy is an uncompressed memory-mappable binary format)')
+
+    parser.add_argument('-maxpacketfiles', type=int, default=None,
+                        help='Limit the number of packet files converted')
+
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Convert packets files even if the columnar file already exists')
+
+    parser.add_argument('--sortbywhere', action='store_true',
+                        help='Sort the packets by propagation cell, for faster reading of the packets in a cell')
+
+
+def main(args=None, argsraw=None, **kwargs):
+    """Convert ARTIS text packets files into compressed columnar files that readfile() will prefer."""
+    if args is None:
+        parser = argparse.ArgumentParser(
+            formatter_class=at.CustomArgHelpFormatter,
+            description=('Convert packets00_*.out[.gz/.xz/.zst] files to compressed Parquet or Arrow Feather files, '
+                         'or NumPy binary files.'))
+
+        addargs(parser)
+        parser.set_defaults(**kwargs)
+        args = parser.parse_args(argsraw)
+
+    packetsfiles = get_textpacketsfilepaths(args.modelpath)
+    if args.maxpacketfiles is not None and args.maxpacketfiles > 0:
+        packetsfiles = packetsfiles[:args.maxpacketfiles]
+
+    print(f'Converting {len(packetsfiles)} packets files to {args.format}')
+
+    processfile = partial(at.packets.convert_text_to_columnar, outputformat=args.format, overwrite=args.overwrite,
+                          sortbywhere=args.sortbywhere)
+    at.get_executor().map(processfile, packetsfiles)
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""Lazy queries over all of the packets files of a model, executed per file in parallel with partial aggregation.
+
+For example, the escaped r-packet energy by emission type in a time range:
+
+    at.packets.scan(modelpath, type='TYPE_ESCAPE', escape_type='TYPE_RPKT').filter(
+        ('t_arrive_d', '>=', 100), ('t_arrive_d', '<', 120)).groupby('emissiontype').agg(
+        e_rf=('e_rf', 'sum'), count=('e_rf', 'count')).collect()
+"""
+
+import re
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import artistools as at
+
+# aggregations that can be combined from per-file (or per-chunk) partial aggregations
+agg_funcs = ('sum', 'count', 'min', 'max', 'mean')
+
+# the aggregation that combines partial results of each aggregation
+agg_combine_funcs = {'sum': 'sum', 'count': 'sum', 'min': 'min', 'max': 'max'}
+
+
+def get_expression_columns(expression, knowncolumns):
+    """Return the known column names that appear in a DataFrame.eval() expression."""
+    return [name for name in dict.fromkeys(re.findall(r'[A-Za-z_]\w*', expression)) if name in knowncolumns]
+
+
+class PacketsScan:
+    """A lazy query over the packets files of a model (see scan()).
+
+    Each operation returns a new PacketsScan, and nothing is read until collect(). Filters on packets file
+    columns are passed to the reader (skipping files, row groups, and rows that cannot match) and every other
+    step is applied to each chunk of packets (see at.config['packets_chunksize']), so only the aggregated
+    results need to fit in memory.
+    """
+
+    def __init__(self, modelpath, packetsfiles, type=None, escape_type=None, steps=(), aggregation=None):
+        self.modelpath = Path(modelpath)
+        self.packetsfiles = tuple(packetsfiles)
+        self.type = type
+        self.escape_type = escape_type
+        self.steps = tuple(steps)
+        self.aggregation = aggregation
+
+    def _replace(self, **kwargs):
+        attrs = dict(modelpath=self.modelpath, packetsfiles=self.packetsfiles, type=self.type,
+                     escape_type=self.escape_type, steps=self.steps, aggregation=self.aggregation)
+        attrs.update(kwargs)
+        return PacketsScan(**attrs)
+
+    def _check_not_aggregated(self):
+        if self.aggregation is not None:
+            raise ValueError('No further operations can follow groupby().agg() or histogram()')
+
+    def filter(self, *filters):
+        """Keep the packets matching all of the (column, op, value) filters, as for at.packets.readfile()."""
+        self._check_not_aggregated()
+        return self._replace(steps=(*self.steps, ('filter', tuple(filters))))
+
+    def with_columns(self, **expressions):
+        """Add or replace columns, given as DataFrame.eval() expression strings, e.g. lambda_rf='2.998e18 / nu_rf'.
+
+        Functions are not accepted, since the steps are sent to the worker processes, which cannot unpickle lambdas
+        or closures.
+        """
+        self._check_not_aggregated()
+        for name, expression in expressions.items():
+            if not isinstance(expression, str):
+                raise TypeError(f'The expression for column {name} must be a DataFrame.eval() string, '
+                                f'not {type(expression).__name__}')
+        return self._replace(steps=(*self.steps, ('with_columns', tuple(expressions.items()))))
+
+    def select(self, *columns):
+        """Keep only these columns."""
+        self._check_not_aggregated()
+        return self._replace(steps=(*self.steps, ('select', tuple(columns))))
+
+    def groupby(self, *by):
+        self._check_not_aggregated()
+        return PacketsGroupBy(self, list(by))
+
+    def histogram(self, bins, weightcolumn='e_rf', groupbycolumn=None):
+        """Histogram the packets as for at.packets.make_accumulator() (bins is a list of (column, binedges) pairs).
+        collect() returns the summed histogram array, or a dict of them keyed by groupbycolumn values."""
+        self._check_not_aggregated()
+        accumulator = at.packets.make_accumulator(
+            bins=bins, weightcolumn=weightcolumn, groupbycolumn=groupbycolumn, type=None, escape_type=None)
+        return self._replace(aggregation=('histogram', accumulator))
+
+    def get_pushdown_filters(self):
+        """Return the filters that apply to packets file columns before any with_columns step."""
+        pushdown = []
+        for steptype, step in self.steps:
+            if steptype == 'with_columns':
+                break
+            if steptype == 'filter':
+                pushdown.extend(step)
+
+        return pushdown
+
+    def get_columns_to_read(self):
+        """Return the packets file columns needed by the query, or None for all columns."""
+        if self.aggregation is None:
+            needed = None
+        elif self.aggregation[0] == 'histogram':
+            needed = at.packets.accumulate.get_accumulator_columns(self.aggregation[1])
+        else:
+            _, by, namedaggs = self.aggregation
+            needed = [*by, *[col for col, _ in namedaggs.values()]]
+
+        # work backwards through the steps to find the columns that they use
+        knowncolumns = set(at.packets.columns_full) | set(at.packets.derived_column_dependencies)
+        for steptype, step in self.steps:
+            if steptype == 'with_columns':
+                knowncolumns.update(name for name, _ in step)
+
+        if needed is not None:
+            needed = list(dict.fromkeys(needed))
+        for steptype, step in reversed(self.steps):
+            if steptype == 'select' and needed is None:
+                needed = list(step)
+            elif needed is None:
+                continue
+            elif steptype == 'filter':
+                needed.extend(f[0] for f in step if f[0] not in needed)
+            elif steptype == 'with_columns':
+                for name, expression in step:
+                    if name in needed:
+                        needed.remove(name)
+                        needed.extend(c for c in get_expression_columns(expression, knowncolumns) if c not in needed)
+
+        return needed
+
+    def apply_steps(self, dfpackets, skipfilters=()):
+        """Apply the filter, with_columns, and select steps to a DataFrame of packets."""
+        for steptype, step in self.steps:
+            if steptype == 'filter':
+                filters = [f for f in step if f not in skipfilters]
+                if filters:
+                    dfpackets = dfpackets[at.packets.get_filter_mask(dfpackets, filters)]
+            elif steptype == 'with_columns':
+                dfpackets = dfpackets.copy()
+                for name, expression in step:
+                    dfpackets[name] = dfpackets.eval(expression)
+            elif steptype == 'select':
+                dfpackets = dfpackets[list(step)]
+
+        return dfpackets
+
+    def collect_file(self, packetsfile, syn_dir=None):
+        """Return the (partially aggregated) result of the query for one packets file."""
+        pushdown = self.get_pushdown_filters()
+        partials = []
+        for dfpackets in at.packets.iter_chunks(
+                packetsfile, chunksize=at.config['packets_chunksize'], type=self.type, escape_type=self.escape_type,
+                columns=self.get_columns_to_read(), filters=pushdown):
+            dfpackets = self.apply_steps(dfpackets, skipfilters=pushdown)
+
+            if self.aggregation is None:
+                partials.append(dfpackets)
+            elif self.aggregation[0] == 'histogram':
+                partials.append(at.packets.accumulate.accumulate_chunk(self.aggregation[1], dfpackets, syn_dir=syn_dir))
+            else:
+                partials.append(get_partial_agg(dfpackets, *self.aggregation[1:]))
+
+        return combine_partials(self.aggregation, partials)
+
+    def collect(self):
+        """Execute the query on each packets file in parallel and combine the results.
+
+        Returns a DataFrame of packets, a DataFrame of the groupby aggregations, or the histogram(s).
+        """
+        packetsfiles = at.packets.filter_packetsfiles(
+            list(self.packetsfiles), type=self.type, escape_type=self.escape_type,
+            filters=self.get_pushdown_filters())
+
+        syn_dir = None
+        if self.aggregation is not None and self.aggregation[0] == 'histogram':
+            if any(col == 'angle_bin' for col, _ in self.aggregation[1].bins):
+                syn_dir = at.get_syn_dir(self.modelpath)
+
+        fileresults = at.get_executor().map(partial(self.collect_file, syn_dir=syn_dir), packetsfiles)
+
+        result = combine_partials(self.aggregation, fileresults)
+
+        if self.aggregation is not None and self.aggregation[0] == 'groupby':
+            result = finalise_agg(result, *self.aggregation[1:])
+
+        return result
+
+
+class PacketsGroupBy:
+    def __init__(self, packetsscan, by):
+        self.packetsscan = packetsscan
+        self.by = by
+
+    def agg(self, **namedaggs):
+        """Aggregate with named (column, func) pairs, where func is one of agg_funcs."""
+        for name, (_, func) in namedaggs.items():
+            if func not in agg_funcs:
+                raise ValueError(f'Unsupported aggregation {func} for {name}. Use one of {agg_funcs}')
+
+        return self.packetsscan._replace(aggregation=('groupby', self.by, namedaggs))
+
+
+def get_partial_agg_columns(namedaggs):
+    """Return the named (column, func) aggregations of each chunk, where a mean is a sum and a count."""
+    partialaggs = {}
+    for name, (column, func) in namedaggs.items():
+        if func == 'mean':
+            partialaggs[f'{name}_sum'] = (column, 'sum')
+            partialaggs[f'{name}_count'] = (column, 'count')
+        else:
+            partialaggs[name] = (column, func)
+
+    return partialaggs
+
+
+def groupby_agg(df, by, namedaggs):
+    """Return the named (column, func) aggregations of the groups of df, sorted by the groupby columns.
+
+    With at.config['dataframe_backend'] set to 'pyarrow' or 'polars', the aggregation is multithreaded. Rows with
+    missing (NaN) groupby values form their own group with every backend.
+    """
+    backend = at.get_dataframe_backend()
+    if backend == 'pyarrow' and len(df) > 0:
+        import pyarrow as pa
+
+        colfuncs = list(dict.fromkeys(namedaggs.values()))
+        table = pa.Table.from_pandas(df[list(dict.fromkeys([*by, *[col for col, _ in colfuncs]]))],
+                                     preserve_index=False)
+        aggtable = table.group_by(by).aggregate(colfuncs)
+        dfagg = pd.DataFrame({
+            **{b: aggtable.column(b).to_numpy() for b in by},
+            **{name: aggtable.column(f'{col}_{func}').to_numpy() for name, (col, func) in namedaggs.items()}})
+
+    elif backend == 'polars' and len(df) > 0:
+        import polars as pl
+
+        aggexprs = [getattr(pl.col(col), func)().alias(name) for name, (col, func) in namedaggs.items()]
+        dfagg = pl.from_pandas(df, nan_to_null=True).group_by(by).agg(aggexprs).to_pandas()
+
+    else:
+        return df.groupby(by, dropna=False).agg(**namedaggs).reset_index()
+
+    return dfagg[[*by, *namedaggs.keys()]].sort_values(by, ignore_index=True)
+
+
+def get_partial_agg(dfpackets, by, namedaggs):
+    """Aggregate a chunk of packets so that the results of chunks can be combined."""
+    return groupby_agg(dfpackets, by, get_partial_agg_columns(namedaggs))
+
+
+def combine_partials(aggregation, partials):
+    """Combine the results of packets files or chunks of a file."""
+    partials = list(partials)
+    if aggregation is None:
+        return pd.concat(partials, ignore_index=True) if partials else pd.DataFrame()
+
+    if aggregation[0] == 'histogram':
+        result = at.packets.accumulate.get_empty_result(aggregation[1])
+        for partialresult in partials:
+            result = at.packets.accumulate.add_results(result, partialresult)
+        return result
+
+    _, by, namedaggs = aggregation
+    if not partials:
+        return pd.DataFrame(columns=[*by, *get_partial_agg_columns(namedaggs)])
+
+    dfpartials = pd.concat(partials, ignore_index=True)
+    combineaggs = {col: (col, agg_combine_funcs['sum' if col not in namedaggs else namedaggs[col][1]])
+                   for col in dfpartials.columns if col not in by}
+
+    return groupby_agg(dfpartials, by, combineaggs)
+
+
+def finalise_agg(dfagg, by, namedaggs):
+    """Calculate the means from the combined sums and counts."""
+    for name, (_, func) in namedaggs.items():
+        if func == 'mean':
+            dfagg[name] = np.divide(dfagg[f'{name}_sum'], dfagg[f'{name}_count'])
+
+    return dfagg[[*by, *namedaggs.keys()]]
+
+
+def scan(modelpath, type=None, escape_type=None, maxpacketfiles=None):
+    """Return a lazy query (see PacketsScan) over the packets files of a model. The type and escape_type select
+    packets as for at.packets.readfile(). The number of files (for normalisation) is len(query.packetsfiles)."""
+    packetsfiles = at.packets.get_packetsfilepaths(modelpath, maxpacketfiles=maxpacketfiles)
+
+    return PacketsScan(modelpath, packetsfiles, type=type, escape_type=escape_type)
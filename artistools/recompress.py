@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Recompress ARTIS output files into multi-block xz files that can be decompressed in parallel, or into Zstandard
+files, which are fast to decompress in a single thread."""
+
+import argparse
+import importlib.util
+import lzma
+import multiprocessing
+import os
+import shutil
+import subprocess
+from functools import partial
+from pathlib import Path
+
+import artistools as at
+
+# the large ARTIS output files that are worth recompressing
+default_patterns = ['packets00_*.out*', 'packets/packets00_*.out*', 'vpackets_*.out*', 'estimators_*.out*',
+                    'nlte_*.out*', 'nonthermalspec_*.out*', 'radfield_*.out*']
+
+
+def is_text_output(filepath):
+    """Check that a file is an (optionally compressed) text .out file, and not e.g. a columnar packets file like
+    packets00_0000.out.parquet or a temporary file."""
+    return Path(filepath).suffixes[-1:] in (['.out'], *[[suffix] for suffix in at.misc.compression_suffixes])
+
+
+def get_recompressed_path(filepath, outputformat):
+    filepath = Path(filepath)
+    if filepath.suffix in at.misc.compression_suffixes:
+        filepath = filepath.with_suffix('')
+
+    return Path(str(filepath) + f'.{outputformat}')
+
+
+def get_block_compressor(outputformat, level=None):
+    """Return a function that compresses a block of data into a complete xz stream or zstd frame."""
+    if outputformat == 'zst':
+        import zstandard
+
+        # the frames are concatenated without a seek table, so the file can only be decompressed sequentially
+        cctx = zstandard.ZstdCompressor(level=3 if level is None else level, write_content_size=True)
+        return cctx.compress
+
+    return partial(lzma.compress, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64, preset=6 if level is None else level)
+
+
+def recompress_file(filepath, outputformat='xz', blocksize_mib=16, level=None, keep=False):
+    """Recompress a file (optionally already compressed) into a sequence of independently compressed blocks."""
+    filepath = Path(filepath)
+    outputpath = get_recompressed_path(filepath, outputformat)
+    outputpathtmp = Path(str(outputpath) + '.tmp')
+
+    blocksize = int(blocksize_mib * 1024 * 1024)
+
+    print(f'Recompressing {filepath} to {outputpath}')
+    with (open(filepath, 'rb') if filepath.suffix not in at.misc.compression_suffixes else
+          at.zopen(filepath, 'rb', seekable=False)) as fin, outputpathtmp.open('wb') as fout:
+        if outputformat == 'xz' and shutil.which('xz'):
+            # threaded xz records the size of each block in its header, which parallel decompression needs
+            command = ['xz', '--compress', '--stdout', f'-{6 if level is None else level}', '--threads=0',
+                       f'--block-size={blocksize}']
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=fout)
+            shutil.copyfileobj(fin, process.stdin, blocksize)
+            process.stdin.close()
+            if process.wait() != 0:
+                raise OSError(f"{' '.join(command)} failed for {filepath}")
+        else:
+            # otherwise, write a sequence of complete xz streams or zstd frames
+            compressblock = get_block_compressor(outputformat, level=level)
+            while True:
+                block = fin.read(blocksize)
+                if not block:
+                    break
+                fout.write(compressblock(block))
+
+    os.replace(outputpathtmp, outputpath)
+
+    if not keep and outputpath != filepath:
+        filepath.unlink()
+
+
+def addargs(parser):
+    parser.add_argument('-modelpath', default='.', type=Path,
+                        help='Path to ARTIS folder')
+
+    parser.add_argument('files', nargs='*', type=Path,
+                        help='Files to recompress (default: the large output files in modelpath)')
+
+    parser.add_argument('-format', default='xz', choices=['xz', 'zst'],
+                        help='Output compression format (zst needs the zstandard package)')
+
+    parser.add_argument('-blocksize', type=float, default=16,
+                        help='Uncompressed size of each independently compressed block in MiB')
+
+    parser.add_argument('-level', type=int, default=None,
+                        help='Compression level (default: 6 for xz, 3 for zst)')
+
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the original files')
+
+
+def main(args=None, argsraw=None, **kwargs):
+    """Recompress ARTIS outputs into multi-block xz files for parallel decompression, or into zstd files."""
+    if args is None:
+        parser = argparse.ArgumentParser(
+            formatter_class=at.CustomArgHelpFormatter,
+            description=('Recompress ARTIS output files (packets, estimators, nlte, etc) into blocks that '
+                         'multithreaded xz can decompress in parallel, or into Zstandard files (which are decompressed '
+                         'sequentially, but quickly).'))
+
+        addargs(parser)
+        parser.set_defaults(**kwargs)
+        args = parser.parse_args(argsraw)
+
+    if args.format == 'zst' and importlib.util.find_spec('zstandard') is None:
+        raise ImportError('Recompressing to zst needs the optional zstandard package (pip install zstandard)')
+
+    files = args.files
+    if not files:
+        files = sorted(set(f for pattern in default_patterns for f in Path(args.modelpath).glob(pattern)
+                           if is_text_output(f)))
+
+    files = [f for f in files if f.is_file()]
+
+    print(f'Recompressing {len(files)} files to {args.format}')
+
+    processfile = partial(recompress_file, outputformat=args.format, blocksize_mib=args.blocksize, level=args.level,
+                          keep=args.keep)
+    at.get_executor().map(processfile, files)
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
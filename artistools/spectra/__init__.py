@@ -5,20 +5,28 @@ from artistools.spectra.spectra import (
     average_angle_bins,
     get_exspec_bins,
     get_flux_contributions,
+    get_internal_spectra_from_packets,
     get_line_flux,
     get_reference_spectrum,
     get_res_spectrum,
     get_specpol_data,
     get_spectrum,
     get_spectrum_at_time,
+    get_spectrum_cube,
+    get_spectrum_from_accumulated,
     get_spectrum_from_packets,
-    get_spectrum_from_packets_worker,
+    get_spectrum_packets_accumulators,
+    get_spectrum_timebinned_accumulators,
+    get_timeaveraged_flux,
     get_vspecpol_spectrum,
+    get_vspecpol_total,
     make_averaged_vspecfiles,
     make_virtual_spectra_summed_file,
     print_floers_line_ratio,
     print_integrated_flux,
     read_specpol_res,
+    read_specpol_res_arrays,
+    read_vspecpol_total_arrays,
     sort_and_reduce_flux_contribution_list,
     stackspectra,
     timeshift_fluxscale_co56law,
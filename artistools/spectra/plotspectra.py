@@ -216,7 +216,8 @@ def plot_artis_spectrum(
             spectrum = get_spectrum_from_packets(
                 modelpath, args.timemin, args.timemax, lambda_min=args.xmin, lambda_max=args.xmax,
                 use_comovingframe=args.use_comovingframe, maxpacketfiles=args.maxpacketfiles,
-                delta_lambda=args.deltalambda, useinternalpackets=args.internalpackets, getpacketcount=plotpacketcount)
+                delta_lambda=args.deltalambda, useinternalpackets=args.internalpackets, getpacketcount=plotpacketcount,
+                packetfraction=args.packetfraction)
             if args.outputfile is None:
                 statpath = Path()
             else:
@@ -420,7 +421,8 @@ def make_emissionabsorption_plot(modelpath, axis, filterfunc, args=None, scale_t
             getemission=args.showemission, getabsorption=args.showabsorption,
             maxpacketfiles=args.maxpacketfiles, filterfunc=filterfunc,
             groupby=args.groupby, delta_lambda=args.deltalambda, use_lastemissiontype=args.use_lastemissiontype,
-            useinternalpackets=args.internalpackets, emissionvelocitycut=args.emissionvelocitycut)
+            useinternalpackets=args.internalpackets, emissionvelocitycut=args.emissionvelocitycut,
+            packetfraction=args.packetfraction)
     else:
         arraylambda_angstroms = const.c.to('angstrom/s').value / arraynu
         assert(args.groupby in [None, 'ion'])
@@ -808,6 +810,9 @@ def addargs(parser):
     parser.add_argument('-maxpacketfiles', type=int, default=None,
                         help='Limit the number of packet files read')
 
+    parser.add_argument('-packetfraction', type=float, default=None,
+                        help='Use a random fraction of the packets in every file for a quick preview (e.g. 0.01)')
+
     parser.add_argument('--emissionabsorption', action='store_true',
                         help='Implies --showemission and --showabsorption')
 
@@ -946,6 +951,10 @@ def addargs(parser):
     parser.add_argument('--averagevspecpolfiles', action='store_true',
                         help='Average the vspecpol-total files for multiple simulations')
 
+    parser.add_argument('--novspecpoltext', action='store_true',
+                        help='With --makevspecpol or --averagevspecpolfiles, only write the binary .npy file instead '
+                             'of also writing a text file for each observer')
+
     parser.add_argument('-plotvspecpol', type=int, nargs='+',
                         help='Plot viewing angles from vspecpol virtual packets. '
                              'Expects int for angle = spec number in vspecpol files')
@@ -1022,11 +1031,11 @@ def main(args=None, argsraw=None, **kwargs):
         args.frompackets = True
 
     if args.makevspecpol:
-        make_virtual_spectra_summed_file(args.specpath[0])
+        make_virtual_spectra_summed_file(args.specpath[0], writetext=not args.novspecpoltext)
         return
 
     if args.averagevspecpolfiles:
-        make_averaged_vspecfiles(args)
+        make_averaged_vspecfiles(args.specpath, writetext=not args.novspecpoltext)
         return
 
     if '/' in args.stokesparam:
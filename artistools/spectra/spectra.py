@@ -1,10 +1,8 @@
 #!/usr/bin/env python3
 """Artistools - spectra related functions."""
 import math
-import multiprocessing
 from collections import namedtuple
-from functools import lru_cache
-from functools import partial
+from functools import lru_cache, partial
 from pathlib import Path
 import os
 
@@ -14,7 +12,6 @@ import numpy as np
 import pandas as pd
 from astropy import constants as const
 from astropy import units as u
-import re
 
 import artistools as at
 import artistools.radfield
@@ -23,6 +20,8 @@ import artistools.packets
 fluxcontributiontuple = namedtuple(
     'fluxcontribution', 'fluxcontrib linelabel array_flambda_emission array_flambda_absorption color')
 
+spectrumcubetuple = namedtuple('spectrumcube', 'nu tdelta cube cumcube')
+
 
 def timeshift_fluxscale_co56law(scaletoreftime, spectime):
     if scaletoreftime is not None:
@@ -69,19 +68,22 @@ def stackspectra(spectra_and_factors):
     return stackedspectrum
 
 
-@lru_cache(maxsize=16)
-def get_specdata(modelpath, stokesparam=None):
-    polarisationdata = False
+def get_specfilename(modelpath):
+    """Return the path of the emergent spectrum file (specpol.out or spec.out) of a model."""
     if Path(modelpath, 'specpol.out').is_file():
-        specfilename = Path(modelpath) / "specpol.out"
-        polarisationdata = True
+        return Path(modelpath) / "specpol.out"
     elif Path(modelpath, 'specpol.out.xz').is_file():
-        specfilename = Path(modelpath) / "specpol.out.xz"
-        polarisationdata = True
+        return Path(modelpath) / "specpol.out.xz"
     elif Path(modelpath).is_dir():
-        specfilename = at.firstexisting(['spec.out.xz', 'spec.out.gz', 'spec.out'], path=modelpath)
-    else:
-        specfilename = modelpath
+        return at.firstexisting(['spec.out.xz', 'spec.out.gz', 'spec.out'], path=modelpath)
+
+    return Path(modelpath)
+
+
+@lru_cache(maxsize=16)
+def get_specdata(modelpath, stokesparam=None):
+    specfilename = get_specfilename(modelpath)
+    polarisationdata = Path(modelpath).is_dir() and specfilename.name.startswith('specpol.out')
 
     if polarisationdata:
         # angle = args.plotviewingangle[0]
@@ -99,6 +101,81 @@ def get_specdata(modelpath, stokesparam=None):
     return specdata
 
 
+def get_spectrum_cube_paths(specfilename, stokesparam='I'):
+    """Return the cache paths of the metadata, flux cube, and cumulative flux cube of a spectrum file."""
+    specfilename = Path(specfilename)
+    cachefolder = Path(specfilename.parent, '__artistoolscache__.nosync')
+    return (Path(cachefolder, f'{specfilename.name}.{stokesparam}.cube.npz'),
+            Path(cachefolder, f'{specfilename.name}.{stokesparam}.cube.npy'),
+            Path(cachefolder, f'{specfilename.name}.{stokesparam}.cumcube.npy'))
+
+
+def make_spectrum_cube(modelpath, stokesparam='I', res=False):
+    """Return nu and an (angle, timestep, nu) array of f_nu from spec.out, specpol.out, or specpol_res.out."""
+    if res:
+        nu, _, stokes_params = read_specpol_res_arrays(modelpath)
+        return nu, stokes_params[stokesparam].transpose(0, 2, 1)
+
+    specdata = get_specdata(modelpath, stokesparam=None if stokesparam == 'I' else stokesparam)
+    nu = specdata['nu'].to_numpy(dtype=float)
+    cube = specdata.iloc[:, 1:].to_numpy(dtype=float).T[np.newaxis]
+
+    return nu, cube
+
+
+@lru_cache(maxsize=16)
+def get_spectrum_cube(modelpath, stokesparam='I', res=False):
+    """Return the emergent spectra of a model (from specpol_res.out if res is True) as a spectrumcube of nu, the
+    timestep widths tdelta, the (angle, timestep, nu) array of f_nu, and its time-weighted cumulative sum along the
+    timesteps cumcube[:, i] = sum(cube[:, :i] * tdelta[:i]), which has ntimesteps + 1 rows.
+
+    With the disk cache enabled, the arrays are saved to be memory mapped, and regenerated if the spectrum file or
+    the timestep widths change. Use get_timeaveraged_flux() to average any range of timesteps.
+    """
+    specfilename = get_specpol_res_filename(modelpath) if res else get_specfilename(modelpath)
+    arr_tdelta = np.array(at.get_timestep_times_float(modelpath, loc='delta'), dtype=float)
+    metapath, cubepath, cumcubepath = get_spectrum_cube_paths(specfilename, stokesparam)
+
+    if at.config['enable_diskcache'] and metapath.is_file():
+        with np.load(metapath) as metadata:
+            if (metadata['filesize'] == specfilename.stat().st_size and
+                    metadata['mtime'] == specfilename.stat().st_mtime and
+                    np.array_equal(metadata['tdelta'], arr_tdelta[:len(metadata['tdelta'])])):
+                return spectrumcubetuple(
+                    nu=metadata['nu'], tdelta=metadata['tdelta'],
+                    cube=np.load(cubepath, mmap_mode='r'), cumcube=np.load(cumcubepath, mmap_mode='r'))
+
+    nu, cube = make_spectrum_cube(modelpath, stokesparam=stokesparam, res=res)
+    tdelta = arr_tdelta[:cube.shape[1]]
+    cumcube = np.zeros((cube.shape[0], cube.shape[1] + 1, cube.shape[2]))
+    np.cumsum(cube * tdelta[np.newaxis, :, np.newaxis], axis=1, out=cumcube[:, 1:])
+
+    if at.config['enable_diskcache']:
+        print(f'Saving spectrum cube of {specfilename}')
+        metapath.parent.mkdir(exist_ok=True)
+        # the metadata is written last so that it is only valid once both arrays have been saved
+        for path, arr in [(cubepath, cube), (cumcubepath, cumcube)]:
+            pathtmp = path.with_suffix('.tmp.npy')
+            np.save(pathtmp, arr)
+            os.replace(pathtmp, path)
+        metapathtmp = metapath.with_suffix('.tmp.npz')
+        np.savez(metapathtmp, filesize=specfilename.stat().st_size, mtime=specfilename.stat().st_mtime,
+                 nu=nu, tdelta=tdelta)
+        os.replace(metapathtmp, metapath)
+
+    return spectrumcubetuple(nu=nu, tdelta=tdelta, cube=cube, cumcube=cumcube)
+
+
+def get_timeaveraged_flux(spectrumcube, timestepmin, timestepmax, angle=0):
+    """Return the time-weighted average f_nu over timesteps timestepmin to timestepmax (inclusive), as for
+    stackspectra(), from the difference of the cumulative sums in a spectrumcube."""
+    if timestepmin == timestepmax:
+        return np.array(spectrumcube.cube[angle, timestepmin])
+
+    return ((spectrumcube.cumcube[angle, timestepmax + 1] - spectrumcube.cumcube[angle, timestepmin]) /
+            spectrumcube.tdelta[timestepmin:timestepmax + 1].sum())
+
+
 def get_spectrum(
         modelpath, timestepmin: int, timestepmax=-1, fnufilterfunc=None,
         modelnumber=None):
@@ -106,15 +183,10 @@ def get_spectrum(
     if timestepmax < 0:
         timestepmax = timestepmin
 
-    specdata = get_specdata(modelpath)
+    spectrumcube = get_spectrum_cube(modelpath)
 
-    nu = specdata.loc[:, 'nu'].values
-    arr_tdelta = at.get_timestep_times_float(modelpath, loc='delta')
-
-    f_nu = stackspectra([
-        (specdata[specdata.columns[timestep + 1]],
-         arr_tdelta[timestep])
-        for timestep in range(timestepmin, timestepmax + 1)])
+    nu = spectrumcube.nu
+    f_nu = get_timeaveraged_flux(spectrumcube, timestepmin, timestepmax)
 
     # best to use the filter on this list because it
     # has regular sampling
@@ -144,7 +216,8 @@ def get_spectrum_at_time(modelpath, timestep, time, args, angle=None, res_specda
         if args.plotvspecpol and os.path.isfile(modelpath/'vpkt.txt'):
             spectrum = get_vspecpol_spectrum(modelpath, time, angle, args)
         elif os.path.isfile(modelpath/'specpol_res.out'):
-            spectrum = get_res_spectrum(modelpath, timestep, timestep, angle=angle, res_specdata=res_specdata)
+            spectrum = get_res_spectrum(modelpath, timestep, timestep, angle=angle, res_specdata=res_specdata,
+                                        args=args)
         else:
             spectrum = get_spectrum(modelpath, timestep, timestep, modelnumber=modelnumber)
     else:
@@ -153,89 +226,90 @@ def get_spectrum_at_time(modelpath, timestep, time, args, angle=None, res_specda
     return spectrum
 
 
-def get_spectrum_from_packets_worker(querystr, qlocals, array_lambda, array_lambdabinedges, packetsfile,
-                                     use_comovingframe=False, getpacketcount=False, betafactor=None):
-    dfpackets = at.packets.readfile(packetsfile, type='TYPE_ESCAPE', escape_type='TYPE_RPKT').query(
-        querystr, inplace=False, local_dict=qlocals)
+def get_packets_spectrum_bins(lambda_min, lambda_max, delta_lambda=None):
+    """Return the wavelength bin edges, bin centres, and bin widths for a spectrum from packets."""
+    if delta_lambda:
+        array_lambdabinedges = np.arange(lambda_min, lambda_max + delta_lambda, delta_lambda)
+        array_lambda = 0.5 * (array_lambdabinedges[:-1] + array_lambdabinedges[1:])  # bin centres
+        return array_lambdabinedges, array_lambda, delta_lambda
+
+    return get_exspec_bins()
+
 
-    print(f"  {packetsfile}: {len(dfpackets)} escaped r-packets matching frequency and arrival time ranges ")
+def get_spectrum_packets_accumulators(
+        timelowdays, timehighdays, lambda_min, lambda_max, delta_lambda=None, use_comovingframe=False,
+        betafactor=None, getpacketcount=False):
+    """Return the packets accumulators for a spectrum, which can be filled along with other products in one pass
+    with at.packets.accumulate_packets(). The results are converted with get_spectrum_from_accumulated()."""
+    c_ang_s = const.c.to('angstrom/s').value
+    nu_min = c_ang_s / lambda_max
+    nu_max = c_ang_s / lambda_min
 
-    dfpackets.eval('lambda_rf = @c_ang_s / nu_rf', inplace=True, local_dict=qlocals)
-    wl_bins = pd.cut(
-        x=dfpackets['lambda_rf'], bins=array_lambdabinedges, right=True,
-        labels=range(len(array_lambda)), include_lowest=True)
+    array_lambdabinedges, _, _ = get_packets_spectrum_bins(lambda_min, lambda_max, delta_lambda)
 
-    if use_comovingframe:
-        array_energysum_onefile = dfpackets.e_cmf.groupby(wl_bins).sum().values / betafactor
-    else:
-        array_energysum_onefile = dfpackets.e_rf.groupby(wl_bins).sum().values
+    timelow = timelowdays * u.day.to('s')
+    timehigh = timehighdays * u.day.to('s')
 
-    if getpacketcount:
-        array_pktcount_onefile = dfpackets.lambda_rf.groupby(wl_bins).count().values
+    # these filters are pushed down to the packets file reader, so that only matching packets are loaded
+    filters = [('nu_rf', '>=', nu_min), ('nu_rf', '<', nu_max), ('trueemissiontype', '>=', 0)]
+    if not use_comovingframe:
+        filters += [('t_arrive_d', '>', timelowdays), ('t_arrive_d', '<', timehighdays)]
     else:
-        array_pktcount_onefile = None
+        filters += [('escape_time', '>', timelow / betafactor), ('escape_time', '<', timehigh / betafactor)]
 
-    return array_energysum_onefile, array_pktcount_onefile
+    accumulators = {'spectrum_energysum': at.packets.make_accumulator(
+        bins=[('lambda_angstroms', array_lambdabinedges)], weightcolumn='e_cmf' if use_comovingframe else 'e_rf',
+        filters=filters)}
 
+    if getpacketcount:
+        accumulators['spectrum_packetcount'] = accumulators['spectrum_energysum']._replace(weightcolumn=None)
 
-def get_spectrum_from_packets(
-        modelpath, timelowdays, timehighdays, lambda_min, lambda_max,
-        delta_lambda=None, use_comovingframe=None, maxpacketfiles=None, useinternalpackets=False,
-        getpacketcount=False):
-    """Get a spectrum dataframe using the packets files as input."""
-    assert(not useinternalpackets)
-    packetsfiles = at.packets.get_packetsfilepaths(modelpath, maxpacketfiles)
+    return accumulators
 
-    if use_comovingframe:
-        modeldata, _, _ = at.inputmodel.get_modeldata(Path(packetsfiles[0]).parent)
-        vmax = modeldata.iloc[-1].velocity_outer * u.km / u.s
-        betafactor = math.sqrt(1 - (vmax / const.c).decompose().value ** 2)
-    else:
-        betafactor = None
 
-    c_cgs = const.c.to('cm/s').value
+def get_spectrum_timebinned_accumulators(
+        modelpath, lambda_min, lambda_max, delta_lambda=None, use_comovingframe=False, betafactor=None,
+        getpacketcount=False):
+    """Return packets accumulators for spectra binned by arrival timestep, which are cached for each packets file so
+    that a spectrum for any range of timesteps can be made without reading the packets again."""
     c_ang_s = const.c.to('angstrom/s').value
     nu_min = c_ang_s / lambda_max
     nu_max = c_ang_s / lambda_min
 
-    if delta_lambda:
-        array_lambdabinedges = np.arange(lambda_min, lambda_max + delta_lambda, delta_lambda)
-        array_lambda = 0.5 * (array_lambdabinedges[:-1] + array_lambdabinedges[1:])  # bin centres
-    else:
-        array_lambdabinedges, array_lambda, delta_lambda = get_exspec_bins()
-
-    array_energysum = np.zeros_like(array_lambda, dtype=float)  # total packet energy sum of each bin
-    if getpacketcount:
-        array_pktcount = np.zeros_like(array_lambda, dtype=int)  # number of packets in each bin
+    array_lambdabinedges, _, _ = get_packets_spectrum_bins(lambda_min, lambda_max, delta_lambda)
 
-    timelow = timelowdays * u.day.to('s')
-    timehigh = timehighdays * u.day.to('s')
+    tstarts = at.get_timestep_times_float(modelpath, loc='start')
+    tends = at.get_timestep_times_float(modelpath, loc='end')
+    timearrayplusend = np.concatenate([tstarts, [tends[-1]]])
 
-    nprocs_read = len(packetsfiles)
-    querystr = '@nu_min <= nu_rf < @nu_max and trueemissiontype >= 0 and '
     if not use_comovingframe:
-        querystr += '@timelow < (escape_time - (posx * dirx + posy * diry + posz * dirz) / @c_cgs) < @timehigh'
+        timebins = ('t_arrive_d', timearrayplusend)
     else:
-        querystr += '@timelow < (escape_time * @betafactor) < @timehigh'
+        timebins = ('escape_time', timearrayplusend * u.day.to('s') / betafactor)
 
-    processfile = partial(
-        get_spectrum_from_packets_worker, querystr,
-        dict(nu_min=nu_min, nu_max=nu_max, timelow=timelow, timehigh=timehigh,
-             betafactor=betafactor, c_cgs=c_cgs, c_ang_s=c_ang_s),
-        array_lambda, array_lambdabinedges, use_comovingframe=use_comovingframe, getpacketcount=getpacketcount,
-        betafactor=betafactor)
-    if at.config['num_processes'] > 1:
-        with multiprocessing.Pool(processes=at.config['num_processes']) as pool:
-            results = pool.map(processfile, packetsfiles)
-            pool.close()
-            pool.join()
-            pool.terminate()
-    else:
-        results = [processfile(p) for p in packetsfiles]
+    filters = [('nu_rf', '>=', nu_min), ('nu_rf', '<', nu_max), ('trueemissiontype', '>=', 0)]
+    accumulators = {'spectrum_energysum': at.packets.make_accumulator(
+        bins=[timebins, ('lambda_angstroms', array_lambdabinedges)],
+        weightcolumn='e_cmf' if use_comovingframe else 'e_rf', filters=filters)}
 
-    array_energysum = np.ufunc.reduce(np.add, [r[0] for r in results])
     if getpacketcount:
-        array_pktcount += np.ufunc.reduce(np.add, [r[1] for r in results])
+        accumulators['spectrum_packetcount'] = accumulators['spectrum_energysum']._replace(weightcolumn=None)
+
+    return accumulators, timearrayplusend
+
+
+def get_spectrum_from_accumulated(
+        results, nprocs_read, timelowdays, timehighdays, lambda_min, lambda_max, delta_lambda=None,
+        use_comovingframe=False, betafactor=None):
+    """Convert the histograms of get_spectrum_packets_accumulators() (with the same arguments) into a spectrum
+    DataFrame."""
+    _, array_lambda, delta_lambda = get_packets_spectrum_bins(lambda_min, lambda_max, delta_lambda)
+
+    timelow = timelowdays * u.day.to('s')
+    timehigh = timehighdays * u.day.to('s')
+
+    # total packet energy sum of each bin
+    array_energysum = results['spectrum_energysum'] / betafactor if use_comovingframe else results['spectrum_energysum']
 
     array_flambda = (array_energysum / delta_lambda / (timehigh - timelow) /
                      4 / math.pi / (u.megaparsec.to('cm') ** 2) / nprocs_read)
@@ -246,51 +320,103 @@ def get_spectrum_from_packets(
         'energy_sum': array_energysum,
     }
 
-    if getpacketcount:
-        dfdict['packetcount'] = array_pktcount
+    if 'spectrum_packetcount' in results:
+        dfdict['packetcount'] = results['spectrum_packetcount'].astype(int)  # number of packets in each bin
 
     return pd.DataFrame(dfdict)
 
 
-@at.diskcache(savezipped=True)
-def read_specpol_res(modelpath):
-    """Return specpol_res data for a given angle"""
-    if Path(modelpath, 'specpol_res.out').is_file():
-        specfilename = Path(modelpath) / "specpol_res.out"
+def get_spectrum_from_packets(
+        modelpath, timelowdays, timehighdays, lambda_min, lambda_max,
+        delta_lambda=None, use_comovingframe=None, maxpacketfiles=None, useinternalpackets=False,
+        getpacketcount=False, packetfraction=None):
+    """Get a spectrum dataframe using the packets files as input.
+
+    packetfraction < 1 uses a random subset of the packets in every file for a quick preview (see
+    at.packets.accumulate_packets).
+
+    With the disk cache enabled, a time range that starts and ends at timestep edges is summed from histograms
+    binned by timestep, which are cached and reused for any such range. Other time ranges fall back to binning the
+    packets for that range only, which is not cached."""
+    assert(not useinternalpackets)
+
+    if use_comovingframe:
+        packetsfiles = at.packets.get_packetsfilepaths(modelpath, maxpacketfiles)
+        modeldata, _, _ = at.inputmodel.get_modeldata(Path(packetsfiles[0]).parent)
+        vmax = modeldata.iloc[-1].velocity_outer * u.km / u.s
+        betafactor = math.sqrt(1 - (vmax / const.c).decompose().value ** 2)
     else:
-        specfilename = modelpath
-
-    print(f"Reading {specfilename} (in read_specpol_res)")
-    specdata = pd.read_csv(specfilename, delim_whitespace=True, header=None, dtype=str)
-
-    res_specdata = at.gather_res_data(specdata)
-
-    # index_to_split = specdata.index[specdata.iloc[:, 1] == specdata.iloc[0, 1]]
-    # # print(len(index_to_split))
-    # res_specdata = []
-    # for i, index_value in enumerate(index_to_split):
-    #     if index_value != index_to_split[-1]:
-    #         chunk = specdata.iloc[index_to_split[i]:index_to_split[i + 1], :]
-    #     else:
-    #         chunk = specdata.iloc[index_to_split[i]:, :]
-    #     res_specdata.append(chunk)
-    # print(res_specdata[0])
-
-    columns = res_specdata[0].iloc[0]
-    # print(columns)
-    for i, res_spec in enumerate(res_specdata):
-        res_specdata[i] = res_specdata[i].rename(columns=columns).drop(res_specdata[i].index[0])
-        # These lines remove the Q and U values from the dataframe (I think)
-        numberofIvalues = len(res_specdata[i].columns.drop_duplicates())
-        res_specdata[i] = res_specdata[i].iloc[:, : numberofIvalues]
-        res_specdata[i] = res_specdata[i].astype(float)
-        res_specdata[i] = res_specdata[i].to_numpy()
-
-    for i, res_spec in enumerate(res_specdata):
-        res_specdata[i] = pd.DataFrame(data=res_specdata[i], columns=columns[:numberofIvalues])
-        res_specdata[i] = res_specdata[i].rename(columns={'0': 'nu'})
+        betafactor = None
+
+    if at.config['enable_diskcache']:
+        # the cached histograms binned by timestep can make a spectrum for any range of whole timesteps
+        accumulators, timearrayplusend = get_spectrum_timebinned_accumulators(
+            modelpath, lambda_min, lambda_max, delta_lambda=delta_lambda, use_comovingframe=use_comovingframe,
+            betafactor=betafactor, getpacketcount=getpacketcount)
+        timeedgeslow = np.flatnonzero(np.isclose(timearrayplusend, timelowdays, rtol=1e-8))
+        timeedgeshigh = np.flatnonzero(np.isclose(timearrayplusend, timehighdays, rtol=1e-8))
+
+        if len(timeedgeslow) > 0 and len(timeedgeshigh) > 0:
+            results, nprocs_read = at.packets.accumulate_packets(
+                modelpath, accumulators, maxpacketfiles=maxpacketfiles, packetfraction=packetfraction, cache=True)
+            results = {name: histogram[timeedgeslow[0]:timeedgeshigh[0]].sum(axis=0)
+                       for name, histogram in results.items()}
+
+            return get_spectrum_from_accumulated(
+                results, nprocs_read, timelowdays, timehighdays, lambda_min, lambda_max,
+                delta_lambda=delta_lambda, use_comovingframe=use_comovingframe, betafactor=betafactor)
+
+        print(f'Spectrum time range {timelowdays} to {timehighdays} d does not start and end at timestep edges, '
+              'so the packets are binned for this time range only (without the disk cache)')
+
+    accumulators = get_spectrum_packets_accumulators(
+        timelowdays, timehighdays, lambda_min, lambda_max, delta_lambda=delta_lambda,
+        use_comovingframe=use_comovingframe, betafactor=betafactor, getpacketcount=getpacketcount)
+
+    results, nprocs_read = at.packets.accumulate_packets(
+        modelpath, accumulators, maxpacketfiles=maxpacketfiles, packetfraction=packetfraction)
+
+    return get_spectrum_from_accumulated(
+        results, nprocs_read, timelowdays, timehighdays, lambda_min, lambda_max, delta_lambda=delta_lambda,
+        use_comovingframe=use_comovingframe, betafactor=betafactor)
 
-    return res_specdata
+
+def get_specpol_res_filename(modelpath):
+    if Path(modelpath).is_dir():
+        return at.firstexisting(['specpol_res.out', 'specpol_res.out.xz', 'specpol_res.out.gz'], path=modelpath)
+
+    return Path(modelpath)
+
+
+def split_stokes_res_data(resdata):
+    """Return nu, the timestep times, and a dict of the Stokes I, Q, and U (angle, nu, time) arrays from the
+    (angle, row, column) array of a polarisation res file (see at.read_res_data), where each angle has a header row
+    of the times for I, Q, and U followed by a row for each frequency."""
+    ntimes = (resdata.shape[2] - 1) // 3
+    nu = resdata[0, 1:, 0]
+    timearray = resdata[0, 0, 1:ntimes + 1]
+    stokes_params = {
+        stokesparam: resdata[:, 1:, 1 + i * ntimes:1 + (i + 1) * ntimes] for i, stokesparam in enumerate('IQU')}
+
+    return nu, timearray, stokes_params
+
+
+def read_specpol_res_arrays(modelpath):
+    """Return nu, the timestep times, and a dict of the Stokes I, Q, and U (angle, nu, time) arrays in
+    specpol_res.out."""
+    return split_stokes_res_data(at.read_res_data(get_specpol_res_filename(modelpath)))
+
+
+def read_specpol_res(modelpath):
+    """Return a list of DataFrames with the Stokes I spectrum at each viewing angle in specpol_res.out"""
+    specfilename = get_specpol_res_filename(modelpath)
+    nu, timearray, stokes_params = read_specpol_res_arrays(specfilename)
+
+    # the time columns are named by the strings in the header row of the file
+    with at.zopen(specfilename, 'rt') as fspec:
+        columns = ['nu', *fspec.readline().split()[1:len(timearray) + 1]]
+
+    return [pd.DataFrame(np.column_stack([nu, arr_f_nu]), columns=columns) for arr_f_nu in stokes_params['I']]
 
 
 def average_angle_bins(res_specdata, angle, args):
@@ -324,19 +450,25 @@ def get_res_spectrum(
         angle = args.plotviewingangle[0]
 
     if res_specdata is None:
-        print("Reading specpol_res.out")
-        res_specdata = read_specpol_res(modelpath)
-        if args and 'average_every_tenth_viewing_angle' in args:
-            at.spectra.average_angle_bins(res_specdata, angle, args)
-
-    nu = res_specdata[angle].loc[:, 'nu'].values
-    arr_tmid = at.get_timestep_times_float(modelpath, loc='mid')
-    arr_tdelta = at.get_timestep_times_float(modelpath, loc='delta')
+        spectrumcube = get_spectrum_cube(modelpath, res=True)
+        nu = spectrumcube.nu
+
+        # with averaging, every tenth bin is the average of the ten bins starting from it (see average_angle_bins)
+        angles = [angle]
+        if args and 'average_every_tenth_viewing_angle' in args and args.average_every_tenth_viewing_angle:
+            if angle % 10 == 0:
+                print(f"Bin number {angle} is the average of 10 angle bins")
+                angles = range(angle, angle + 10)
+
+        f_nu = np.mean([get_timeaveraged_flux(spectrumcube, timestepmin, timestepmax, angle=a) for a in angles],
+                       axis=0)
+    else:
+        nu = res_specdata[angle].loc[:, 'nu'].values
+        arr_tdelta = at.get_timestep_times_float(modelpath, loc='delta')
 
-    # for angle in args.plotviewingangle:
-    f_nu = stackspectra([(res_specdata[angle][res_specdata[angle].columns[timestep + 1]],
-                          arr_tdelta[timestep])
-                         for timestep in range(timestepmin, timestepmax + 1)])
+        f_nu = stackspectra([(res_specdata[angle][res_specdata[angle].columns[timestep + 1]],
+                              arr_tdelta[timestep])
+                             for timestep in range(timestepmin, timestepmax + 1)])
 
     # best to use the filter on this list because it
     # has regular sampling
@@ -352,93 +484,150 @@ def get_res_spectrum(
     return dfspectrum
 
 
-def make_virtual_spectra_summed_file(modelpath):
+def get_vspecpol_cube_path(modelpath):
+    return Path(modelpath, 'vspecpol_total.npy')
+
+
+def read_vspecpol_file(vspecpolpath, nvirtual_spectra=None):
+    """Return the virtual packet spectra of the first nvirtual_spectra observers in a text vspecpol_{rank}-0.out
+    file or a binary vspecpol_total.npy file, as an (observer, row, column) array in the format of at.read_res_data.
+    """
+    print(f"Reading {vspecpolpath}")
+    if Path(vspecpolpath).suffix == '.npy':
+        return np.load(vspecpolpath)[:nvirtual_spectra]
+
+    return at.parse_res_data(vspecpolpath)[:nvirtual_spectra]
+
+
+def sum_vspecpol_arrays(vspecpolarrays):
+    """Add up virtual packet spectra arrays, keeping the header row and nu column of the first one."""
+    vspecpolsum = None
+    for vspecpoldata in vspecpolarrays:
+        if vspecpolsum is None:
+            vspecpolsum = vspecpoldata
+        else:
+            vspecpolsum[:, 1:, 1:] += vspecpoldata[:, 1:, 1:]
+
+    return vspecpolsum
+
+
+def sum_vspecpol_files(vspecpolpaths, nvirtual_spectra=None):
+    return sum_vspecpol_arrays(
+        read_vspecpol_file(vspecpolpath, nvirtual_spectra=nvirtual_spectra) for vspecpolpath in vspecpolpaths)
+
+
+def reduce_vspecpol_files(vspecpolpaths, nvirtual_spectra=None):
+    """Sum the virtual packet spectra in vspecpol files in parallel. Each process sums a group of files, and the
+    sums of the groups are then added together, so that only one array per group is sent between processes."""
+    vspecpolpaths = list(vspecpolpaths)
+    ngroups = min(len(vspecpolpaths), 4 * at.get_executor().processes)
+    pathgroups = [vspecpolpaths[i * len(vspecpolpaths) // ngroups:(i + 1) * len(vspecpolpaths) // ngroups]
+                  for i in range(ngroups)]
+
+    groupsums = at.get_executor().map(partial(sum_vspecpol_files, nvirtual_spectra=nvirtual_spectra), pathgroups)
+
+    return sum_vspecpol_arrays(groupsums)
+
+
+def save_vspecpol_cube(vspecpoldata, outputpath, textprefix=None):
+    """Save summed virtual packet spectra as a binary cube, and optionally to a text file for each observer named
+    {textprefix}-{index}.out in the format of the vspecpol files."""
+    outputpath = Path(outputpath)
+    outputpathtmp = outputpath.with_suffix('.tmp.npy')
+    np.save(outputpathtmp, vspecpoldata)
+    os.replace(outputpathtmp, outputpath)
+    print(f'Saved {outputpath}')
+
+    if textprefix is not None:
+        for spec_index, vspecpol in enumerate(vspecpoldata):
+            outfile = outputpath.parent / f'{textprefix}-{spec_index}.out'
+            np.savetxt(outfile, vspecpol, fmt='%g')
+            print(f'Saved {outfile}')
+
+
+def make_virtual_spectra_summed_file(modelpath, writetext=True):
+    """Sum the virtual packet spectra of all ranks into vspecpol_total.npy (see get_vspecpol_total()), and unless
+    writetext is False, also into a text vspecpol_total-{index}.out file for each observer."""
+    modelpath = Path(modelpath)
     nprocs = at.get_nprocs(modelpath)
     print("nprocs", nprocs)
-    vspecpol_data_old = []  # virtual packet spectra for each observer (all directions and opacity choices)
     vpktconfig = at.get_vpkt_config(modelpath)
     nvirtual_spectra = vpktconfig['nobsdirections'] * vpktconfig['nspectraperobs']
     print(f"nobsdirections {vpktconfig['nobsdirections']} nspectraperobs {vpktconfig['nspectraperobs']} (total observers: {nvirtual_spectra})")
+
+    vspecpolpaths = []
     for mpirank in range(nprocs):
         vspecpolfilename = f'vspecpol_{mpirank}-0.out'
-        print(f"Reading rank {mpirank} filename {vspecpolfilename}")
         vspecpolpath = Path(modelpath, vspecpolfilename)
         if not vspecpolpath.is_file():
             vspecpolpath = Path(modelpath, vspecpolfilename + '.gz')
             if not vspecpolpath.is_file():
                 print(f'Warning: Could not find {vspecpolpath.relative_to(modelpath.parent)}')
                 continue
+        vspecpolpaths.append(vspecpolpath)
 
-        vspecpolfile = pd.read_csv(vspecpolpath, delim_whitespace=True, header=None)
-        # Where times of timesteps are written out a new virtual spectrum starts
-        # Find where the time in row 0, column 1 repeats in any column 1
-        index_of_new_spectrum = vspecpolfile.index[vspecpolfile.iloc[:, 1] == vspecpolfile.iloc[0, 1]]
-        vspecpol_data = []  # list of all predefined vspectra
-        for i, index_spectrum_starts in enumerate(index_of_new_spectrum[:nvirtual_spectra]):
-            # todo: this is different to at.gather_res_data() -- could be made to be same format to not repeat code
-            if index_spectrum_starts != index_of_new_spectrum[-1]:
-                chunk = vspecpolfile.iloc[index_spectrum_starts:index_of_new_spectrum[i+1], :]
-            else:
-                chunk = vspecpolfile.iloc[index_spectrum_starts:, :]
-            vspecpol_data.append(chunk)
+    if not vspecpolpaths:
+        raise FileNotFoundError(f'No vspecpol_[rank]-0.out files found in {modelpath}')
+
+    vspecpoltotal = reduce_vspecpol_files(vspecpolpaths, nvirtual_spectra=nvirtual_spectra)
 
-        if len(vspecpol_data_old) > 0:
-            for i, _ in enumerate(vspecpol_data):
-                dftmp = vspecpol_data[i].copy()  # copy of vspectrum number i in a file
-                # add copy to the same spectrum number from previous file
-                # (don't need to copy row 1 = time or column 1 = freq)
-                dftmp.iloc[1:, 1:] += vspecpol_data_old[i].iloc[1:, 1:]
-                # spectrum i then equals the sum of all previous files spectrum number i
-                vspecpol_data[i] = dftmp
-        # update array containing sum of previous files
-        vspecpol_data_old = vspecpol_data
+    save_vspecpol_cube(vspecpoltotal, get_vspecpol_cube_path(modelpath),
+                       textprefix='vspecpol_total' if writetext else None)
 
-    for spec_index, vspecpol in enumerate(vspecpol_data):
-        outfile = modelpath / f'vspecpol_total-{spec_index}.out'
-        print(f'Saved {outfile}')
-        vspecpol.to_csv(outfile, sep=' ', index=False, header=False)
 
+def make_averaged_vspecfiles(modelpaths, writetext=True):
+    """Average the summed virtual packet spectra of multiple runs of a simulation into vspecpol_averaged.npy in the
+    first model folder, and unless writetext is False, also into text vspecpol_averaged-{index}.out files.
 
-def make_averaged_vspecfiles(args):
-    filenames = []
-    for vspecfile in os.listdir(args.modelpath[0]):
-        if vspecfile.startswith('vspecpol_total-'):
-            filenames.append(vspecfile)
+    modelpaths can also be an argparse namespace with a modelpath list, as in earlier versions."""
+    if hasattr(modelpaths, 'modelpath'):
+        modelpaths = modelpaths.modelpath
 
-    def sorted_by_number(l):
+    vspecpoltotalpaths = []
+    for modelpath in modelpaths:
+        if not get_vspecpol_cube_path(modelpath).is_file():
+            make_virtual_spectra_summed_file(modelpath, writetext=writetext)
+        vspecpoltotalpaths.append(get_vspecpol_cube_path(modelpath))
 
-        def convert(text):
-            return int(text) if text.isdigit() else text
+    vspecpolaverage = reduce_vspecpol_files(vspecpoltotalpaths)
+    vspecpolaverage[:, 1:, 1:] /= len(vspecpoltotalpaths)
 
-        def alphanum_key(key):
-            return [convert(c) for c in re.split('([0-9]+)', key)]
+    save_vspecpol_cube(vspecpolaverage, Path(modelpaths[0], 'vspecpol_averaged.npy'),
+                       textprefix='vspecpol_averaged' if writetext else None)
 
-        return sorted(l, key=alphanum_key)
 
-    filenames = sorted_by_number(filenames)
+def get_vspecpol_total(modelpath):
+    """Return the (observer, row, column) array of virtual packet spectra summed over all ranks (see
+    make_virtual_spectra_summed_file), which is generated if it does not exist."""
+    cubepath = get_vspecpol_cube_path(modelpath)
+    if not cubepath.is_file():
+        print(f"{cubepath} does not exist. Generating all-rank summed vspec files..")
+        make_virtual_spectra_summed_file(modelpath=modelpath)
 
-    for spec_index, filename in enumerate(filenames):  # vspecpol-total files
-        vspecdata = []
-        for modelpath in args.modelpath:
-            vspecdata.append(pd.read_csv(modelpath / filename, delim_whitespace=True, header=None))
-        for i in range(1, len(vspecdata)):
-            vspecdata[0].iloc[1:, 1:] += vspecdata[i].iloc[1:, 1:]
+    return np.load(cubepath, mmap_mode='r')
 
-        vspecdata[0].iloc[1:, 1:] = vspecdata[0].iloc[1:, 1:]/len(vspecdata)
-        vspecdata[0].to_csv(args.modelpath[0] / f'vspecpol_averaged-{spec_index}.out',
-                            sep=' ', index=False, header=False)
+
+def read_vspecpol_total_arrays(modelpath):
+    """Return nu, the times, and a dict of the Stokes I, Q, and U (observer, nu, time) arrays of the virtual packet
+    spectra summed over all ranks."""
+    return split_stokes_res_data(get_vspecpol_total(modelpath))
 
 
 def get_specpol_data(angle=None, modelpath=None, specdata=None):
-    if specdata is None:
+    if specdata is None and angle is not None and (
+            get_vspecpol_cube_path(modelpath).is_file() or not Path(modelpath, f'vspecpol_total-{angle}.out').exists()):
+        # alternatively use vspecpol_averaged.npy ?
+        vspecpol = get_vspecpol_total(modelpath)[angle]
+        # the column names of the I, Q, and U times are as pandas would read them from a vspecpol_total file
+        timenames = [str(float(time)) for time in vspecpol[0, 1:(vspecpol.shape[1] - 1) // 3 + 1]]
+        columns = ['nu', *timenames, *[f'{name}.1' for name in timenames], *[f'{name}.2' for name in timenames]]
+        specdata = pd.DataFrame(np.array(vspecpol[1:]), columns=columns)
+
+    elif specdata is None:
         if angle is None:
             specfilename = at.firstexisting(['specpol.out', 'specpol.out.xz', 'specpol.out.gz'], path=modelpath)
         else:
-            # alternatively use f'vspecpol_averaged-{angle}.out' ?
             specfilename = Path(modelpath, f'vspecpol_total-{angle}.out')
-            if not specfilename.exists():
-                print(f"{specfilename} does not exist. Generating all-rank summed vspec files..")
-                make_virtual_spectra_summed_file(modelpath=modelpath)
 
         print(f"Reading {specfilename}")
         specdata = pd.read_csv(specfilename, delim_whitespace=True)
@@ -635,75 +824,175 @@ def get_flux_contributions(
     return contribution_list, array_flambda_emission_total
 
 
+@lru_cache(maxsize=4)
+def get_internal_spectra_from_packets(modelpath, lambda_min, lambda_max, delta_lambda=None, maxpacketfiles=None):
+    """Return the wavelength bin centres and a dict of the internal radiation field J_lambda of non-escaped r-packets
+    for every model grid cell, which are binned by propagation cell in a single pass through the packets files."""
+    c_ang_s = const.c.to('angstrom/s').value
+    array_lambdabinedges, array_lambda, delta_lambda = get_packets_spectrum_bins(lambda_min, lambda_max, delta_lambda)
+
+    accumulators = {'internal_energysum': at.packets.make_accumulator(
+        bins=[('lambda_angstroms', array_lambdabinedges)], type='TYPE_RPKT', escape_type=None,
+        filters=[('nu_rf', '>=', c_ang_s / lambda_max), ('nu_rf', '<', c_ang_s / lambda_min)], groupbycolumn='where')}
+
+    results, nprocs_read = at.packets.accumulate_packets(modelpath, accumulators, maxpacketfiles=maxpacketfiles)
+
+    assoc_cells, mgi_of_propcells = at.get_grid_mapping(modelpath=modelpath)
+
+    # if we're using packets*.out files, these packets are from the last timestep
+    t_seconds = at.get_timestep_times_float(modelpath, loc='start')[-1] * u.day.to('s')
+    propcellvolume = (at.get_wid_init_at_tmin(modelpath) * t_seconds / (
+        at.get_inputparams(modelpath)['tmin'] * u.day.to('s'))) ** 3
+
+    dict_energysum = {}
+    for propcellid, energysum in results['internal_energysum'].items():
+        mgi = mgi_of_propcells[propcellid]
+        dict_energysum[mgi] = dict_energysum[mgi] + energysum if mgi in dict_energysum else energysum
+
+    c_cgs = const.c.to('cm/s').value
+    dict_jlambda = {
+        mgi: energysum * c_cgs / 4 / math.pi / delta_lambda / (propcellvolume * len(assoc_cells[mgi])) / nprocs_read
+        for mgi, energysum in sorted(dict_energysum.items())}
+
+    return array_lambda, dict_jlambda
+
+
+def get_used_process_groups(labels, groupids):
+    """Return the labels of the process groups that have packets and the index of each packet's group among them."""
+    groupused = np.bincount(groupids, minlength=len(labels)) > 0
+    compactgroupids = np.cumsum(groupused) - 1
+
+    return [label for label, used in zip(labels, groupused) if used], compactgroupids[groupids]
+
+
+def get_flux_contributions_from_packets_onefile(
+        packetsfile, modelpath, lambda_min, lambda_max, array_lambdabinedges, delta_lambda, timelow, timehigh,
+        getemission=True, getabsorption=True, groupby='ion', emtypecolumn='trueemissiontype', cells=None,
+        use_comovingframe=False, betafactor=None, useinternalpackets=False, emissionvelocitycut=None,
+        packetfraction=None):
+    """Return the energy sums in wavelength bins of the packets in one file: the total emission, a dict of
+    (emission, absorption) arrays for each process label, and the number of packets used."""
+    c_cgs = const.c.to('cm/s').value
+    c_ang_s = const.c.to('angstrom/s').value
+    nu_min = c_ang_s / lambda_max
+    nu_max = c_ang_s / lambda_min
+    nbins = len(array_lambdabinedges) - 1
+
+    # lookup tables from the emission and absorption type codes to the process groups
+    emprocessgroups = at.get_process_groups(modelpath, groupby=groupby) if getemission else None
+    absprocessgroups = at.get_process_groups(modelpath, groupby=groupby, absorption=True) if getabsorption else None
+
+    def get_lambda_bin_indices(nu):
+        if np.isscalar(delta_lambda):
+            return np.floor((c_ang_s / nu - lambda_min) / delta_lambda).astype(int)
+        return np.digitize(c_ang_s / nu, bins=array_lambdabinedges, right=True) - 1
+
+    columns = ['nu_rf', 'e_cmf' if use_comovingframe else 'e_rf']
+    if getemission:
+        columns.append(emtypecolumn)
+    if getabsorption:
+        columns.extend(['absorption_type', 'absorption_freq'])
+    if not useinternalpackets:
+        columns.extend(['escape_time', 'posx', 'posy', 'posz', 'dirx', 'diry', 'dirz'])
+        if emissionvelocitycut:
+            columns.extend(['em_posx', 'em_posy', 'em_posz', 'em_time'])
+    if packetfraction is not None and packetfraction < 1.:
+        columns.append('number')
+
+    nufilters = [('nu_rf', '>=', nu_min), ('nu_rf', '<', nu_max)]
+    if useinternalpackets and cells is not None:
+        # the propagation cell index of each file is used to read only the packets in these cells
+        if not at.packets.file_has_cells(packetsfile, cells):
+            return np.zeros(nbins), {}, 0
+        dfpacketschunks = [at.packets.readfile_cells(
+            packetsfile, cells, type='TYPE_RPKT', columns=columns, filters=nufilters)]
+    elif useinternalpackets:
+        dfpacketschunks = at.packets.iter_chunks(
+            packetsfile, chunksize=at.config['packets_chunksize'], type='TYPE_RPKT', columns=columns,
+            filters=nufilters)
+    else:
+        dfpacketschunks = at.packets.iter_chunks(
+            packetsfile, chunksize=at.config['packets_chunksize'], type='TYPE_ESCAPE', escape_type='TYPE_RPKT',
+            columns=columns, filters=nufilters)
+
+    energysum_spectrum_emission_total = np.zeros(nbins)
+    energysum_spectra = {}
+    npackets_used = 0
+    for dfpackets in dfpacketschunks:
+        dfpackets = at.packets.subsample_packets(dfpackets, packetsfile, packetfraction)
+        if useinternalpackets:
+            # if modelgridindex is not None:
+            #     dfpackets.eval(f'velocity = sqrt(posx ** 2 + posy ** 2 + posz ** 2) / @t_seconds', inplace=True)
+            #     dfpackets.query(f'@v_inner <= velocity <= @v_outer',
+            #                     inplace=True)
+            print(f"  {len(dfpackets)} internal r-packets matching frequency range")
+        else:
+            dfpackets.query(
+                '@timelow < (escape_time - (posx * dirx + posy * diry + posz * dirz) / @c_cgs) < @timehigh'
+                if not use_comovingframe else '@timelow < escape_time * @betafactor < @timehigh',
+                inplace=True)
+            print(f"  {len(dfpackets)} escaped r-packets matching frequency and arrival time ranges")
+
+            if emissionvelocitycut:
+                dfpackets = at.packets.add_derived_columns(
+                    dfpackets, modelpath, ['emission_velocity'])
+
+                dfpackets.query('(emission_velocity / 1e5) > @emissionvelocitycut', inplace=True)
+
+        npackets_used += len(dfpackets)
+
+        pkt_en = (dfpackets['e_cmf'].values / betafactor if use_comovingframe else dfpackets['e_rf'].values)
+        xindex = get_lambda_bin_indices(dfpackets['nu_rf'].values)
+        inrange = (xindex >= 0) & (xindex < nbins)
+
+        energysum_spectrum_emission_total += np.bincount(xindex[inrange], weights=pkt_en[inrange], minlength=nbins)
+
+        # the process type codes are mapped to group ids, and the energy sums of all groups are binned at once
+        binnedsums = []
+        if getemission:
+            emlabels, emgroupids = get_used_process_groups(
+                *at.get_process_group_ids(dfpackets[emtypecolumn].values[inrange], emprocessgroups))
+            binnedsums.append((0, emlabels, emgroupids, xindex[inrange], pkt_en[inrange]))
+
+        if getabsorption:
+            abstypes = dfpackets['absorption_type'].values
+            xindexabsorbed = get_lambda_bin_indices(dfpackets['absorption_freq'].values)  # bin by absorption wavelength
+            # xindexabsorbed = xindex  # bin by final escaped wavelength
+            absorbed = (abstypes > 0) & (xindexabsorbed >= 0) & (xindexabsorbed < nbins)
+            abslabels, absgroupids = get_used_process_groups(
+                *at.get_process_group_ids(abstypes[absorbed], absprocessgroups))
+            binnedsums.append((1, abslabels, absgroupids, xindexabsorbed[absorbed], pkt_en[absorbed]))
+
+        for emorabs, labels, groupids, binindices, weights in binnedsums:
+            groupspectra = np.bincount(groupids * nbins + binindices, weights=weights,
+                                       minlength=len(labels) * nbins).reshape(len(labels), nbins)
+
+            for label, spectrum in zip(labels, groupspectra):
+                if label not in energysum_spectra:
+                    energysum_spectra[label] = (np.zeros(nbins), np.zeros(nbins))
+                energysum_spectra[label][emorabs][:] += spectrum
+
+    return energysum_spectrum_emission_total, energysum_spectra, npackets_used
+
+
 @lru_cache(maxsize=4)
 def get_flux_contributions_from_packets(
         modelpath, timelowerdays, timeupperdays, lambda_min, lambda_max, delta_lambda=None,
         getemission=True, getabsorption=True, maxpacketfiles=None, filterfunc=None, groupby='ion', modelgridindex=None,
-        use_comovingframe=False, use_lastemissiontype=False, useinternalpackets=False, emissionvelocitycut=None):
+        use_comovingframe=False, use_lastemissiontype=False, useinternalpackets=False, emissionvelocitycut=None,
+        packetfraction=None):
+    """Return the emission and absorption spectra of each process group (ion, line, etc), the total emission
+    spectrum, and the wavelength bin centres. The packets files are processed in parallel."""
 
     assert groupby in [None, 'ion', 'line', 'upperterm', 'terms']
 
-    if groupby in ['terms', 'upperterm']:
-        adata = at.atomic.get_levels(modelpath)
-
-    def get_emprocesslabel(emtype):
-        if emtype >= 0:
-            line = linelist[emtype]
-            if groupby == 'line':
-                # if line.atomic_number != 26 or line.ionstage != 2:
-                #     return 'non-Fe II ions'
-                return (f'{at.get_ionstring(line.atomic_number, line.ionstage)} '
-                        f'λ{line.lambda_angstroms:.0f} '
-                        f'({line.upperlevelindex}-{line.lowerlevelindex})')
-            elif groupby == 'terms':
-                upper_config = adata.query(
-                    'Z == @line.atomic_number and ion_stage == @line.ionstage', inplace=False
-                    ).iloc[0].levels.iloc[line.upperlevelindex].levelname
-                upper_term_noj = upper_config.split('_')[-1].split('[')[0]
-                lower_config = adata.query(
-                    'Z == @line.atomic_number and ion_stage == @line.ionstage', inplace=False
-                    ).iloc[0].levels.iloc[line.lowerlevelindex].levelname
-                lower_term_noj = lower_config.split('_')[-1].split('[')[0]
-                return f'{at.get_ionstring(line.atomic_number, line.ionstage)} {upper_term_noj}->{lower_term_noj}'
-            elif groupby == 'upperterm':
-                upper_config = adata.query(
-                    'Z == @line.atomic_number and ion_stage == @line.ionstage', inplace=False
-                    ).iloc[0].levels.iloc[line.upperlevelindex].levelname
-                upper_term_noj = upper_config.split('_')[-1].split('[')[0]
-                return f'{at.get_ionstring(line.atomic_number, line.ionstage)} {upper_term_noj}'
-            return f'{at.get_ionstring(line.atomic_number, line.ionstage)} bound-bound'
-        elif emtype == -9999999:
-            return 'free-free'
-
-        bflist = at.get_bflist(modelpath)
-        bfindex = -emtype - 1
-        if bfindex in bflist:
-            (atomic_number, ionstage, level) = bflist[bfindex][:3]
-            if groupby == 'line':
-                return f'{at.get_ionstring(atomic_number, ionstage)} bound-free {level}'
-            return f'{at.get_ionstring(atomic_number, ionstage)} bound-free'
-        return f'? bound-free (bfindex={bfindex})'
-
-    def get_absprocesslabel(abstype):
-        if abstype >= 0:
-            line = linelist[abstype]
-            if groupby == 'line':
-                return (f'{at.get_ionstring(line.atomic_number, line.ionstage)} '
-                        f'λ{line.lambda_angstroms:.0f} '
-                        f'({line.upperlevelindex}-{line.lowerlevelindex})')
-            return f'{at.get_ionstring(line.atomic_number, line.ionstage)} bound-bound'
-        if abstype == -1:
-            return 'free-free'
-        if abstype == -2:
-            return 'bound-free'
-        return '? other absorp.'
-
     if delta_lambda:
         array_lambdabinedges = np.arange(lambda_min, lambda_max + delta_lambda, delta_lambda)
         array_lambda = 0.5 * (array_lambdabinedges[:-1] + array_lambdabinedges[1:])  # bin centres
     else:
         array_lambdabinedges, array_lambda, delta_lambda = get_exspec_bins()
 
+    betafactor = None
     if use_comovingframe:
         modeldata, _, _ = at.inputmodel.get_modeldata(modelpath)
         vmax = modeldata.iloc[-1].velocity_outer * u.km / u.s
@@ -712,8 +1001,6 @@ def get_flux_contributions_from_packets(
     import artistools.packets
     packetsfiles = at.packets.get_packetsfilepaths(modelpath, maxpacketfiles)
 
-    linelist = at.get_linelist(modelpath=modelpath, returntype='dict')
-
     energysum_spectrum_emission_total = np.zeros_like(array_lambda, dtype=float)
     array_energysum_spectra = {}
 
@@ -731,100 +1018,55 @@ def get_flux_contributions_from_packets(
     else:
         emtypecolumn = 'emissiontype' if use_lastemissiontype else 'trueemissiontype'
 
-    for index, packetsfile in enumerate(packetsfiles):
-        if useinternalpackets:
-            # if we're using packets*.out files, these packets are from the last timestep
-            t_seconds = at.get_timestep_times_float(modelpath, loc='start')[-1] * u.day.to('s')
-
-            if modelgridindex is not None:
-                v_inner = at.inputmodel.get_modeldata(modelpath)[0]['velocity_inner'].iloc[modelgridindex] * 1e5
-                v_outer = at.inputmodel.get_modeldata(modelpath)[0]['velocity_outer'].iloc[modelgridindex] * 1e5
-            else:
-                v_inner = 0.
-                v_outer = at.inputmodel.get_modeldata(modelpath)[0]['velocity_outer'].iloc[-1] * 1e5
-
-            r_inner = t_seconds * v_inner
-            r_outer = t_seconds * v_outer
-
-            dfpackets = at.packets.readfile(packetsfile, type='TYPE_RPKT')
-            print("Using non-escaped internal r-packets")
-            dfpackets.query(f'type_id == {at.packets.type_ids["TYPE_RPKT"]} and @nu_min <= nu_rf < @nu_max',
-                            inplace=True)
-            if modelgridindex is not None:
-                assoc_cells, mgi_of_propcells = at.get_grid_mapping(modelpath=modelpath)
-                # dfpackets.eval(f'velocity = sqrt(posx ** 2 + posy ** 2 + posz ** 2) / @t_seconds', inplace=True)
-                # dfpackets.query(f'@v_inner <= velocity <= @v_outer',
-                #                 inplace=True)
-                dfpackets.query('where in @assoc_cells[@modelgridindex]', inplace=True)
-            print(f"  {len(dfpackets)} internal r-packets matching frequency range")
-        else:
-            dfpackets = at.packets.readfile(packetsfile, type='TYPE_ESCAPE', escape_type='TYPE_RPKT')
-            dfpackets.query(
-                '@nu_min <= nu_rf < @nu_max and ' +
-                ('@timelow < (escape_time - (posx * dirx + posy * diry + posz * dirz) / @c_cgs) < @timehigh'
-                 if not use_comovingframe else
-                 '@timelow < escape_time * @betafactor < @timehigh'),
-                inplace=True)
-            print(f"  {len(dfpackets)} escaped r-packets matching frequency and arrival time ranges")
-
-            if emissionvelocitycut:
-                dfpackets = at.packets.add_derived_columns(
-                    dfpackets, modelpath, ['emission_velocity'])
+    cells = None
+    if useinternalpackets:
+        print("Using non-escaped internal r-packets")
+        packetsfiles_matching = packetsfiles
 
-                dfpackets.query('(emission_velocity / 1e5) > @emissionvelocitycut', inplace=True)
+        # if we're using packets*.out files, these packets are from the last timestep
+        t_seconds = at.get_timestep_times_float(modelpath, loc='start')[-1] * u.day.to('s')
 
-        if np.isscalar(delta_lambda):
-            dfpackets.eval('xindex = floor((@c_ang_s / nu_rf - @lambda_min) / @delta_lambda)', inplace=True)
-            if getabsorption:
-                dfpackets.eval('xindexabsorbed = floor((@c_ang_s / absorption_freq - @lambda_min) / @delta_lambda)',
-                               inplace=True)
+        if modelgridindex is not None:
+            v_inner = at.inputmodel.get_modeldata(modelpath)[0]['velocity_inner'].iloc[modelgridindex] * 1e5
+            v_outer = at.inputmodel.get_modeldata(modelpath)[0]['velocity_outer'].iloc[modelgridindex] * 1e5
+            assoc_cells, mgi_of_propcells = at.get_grid_mapping(modelpath=modelpath)
+            cells = assoc_cells[modelgridindex]
         else:
-            dfpackets['xindex'] = np.digitize(c_ang_s / dfpackets.nu_rf, bins=array_lambdabinedges, right=True) - 1
-            if getabsorption:
-                dfpackets['xindexabsorbed'] = np.digitize(
-                    c_ang_s / dfpackets.absorption_freq, bins=array_lambdabinedges, right=True) - 1
+            v_inner = 0.
+            v_outer = at.inputmodel.get_modeldata(modelpath)[0]['velocity_outer'].iloc[-1] * 1e5
 
-        for _, packet in dfpackets.iterrows():
-            lambda_rf = c_ang_s / packet.nu_rf
-            xindex = int(packet.xindex)
-            assert xindex >= 0
-
-            pkt_en = packet.e_cmf / betafactor if use_comovingframe else packet.e_rf
-
-            energysum_spectrum_emission_total[xindex] += pkt_en
-
-            if getemission:
-                # if emtype >= 0 and linelist[emtype].upperlevelindex <= 80:
-                #     continue
-                # emprocesskey = get_emprocesslabel(packet.emissiontype)
-                emprocesskey = get_emprocesslabel(packet[emtypecolumn])
-                # print('packet lambda_cmf: {c_ang_s / packet.nu_cmf}.1f}, lambda_rf {lambda_rf:.1f}, {emprocesskey}')
-
-                if emprocesskey not in array_energysum_spectra:
-                    array_energysum_spectra[emprocesskey] = (
-                        np.zeros_like(array_lambda, dtype=float), np.zeros_like(array_lambda, dtype=float))
-
-                array_energysum_spectra[emprocesskey][0][xindex] += pkt_en
-
-            if getabsorption:
-                abstype = packet.absorption_type
-                if abstype > 0:
-                    absprocesskey = get_absprocesslabel(abstype)
-
-                    xindexabsorbed = int(packet.xindexabsorbed)  # bin by absorption wavelength
-                    # xindexabsorbed = xindex  # bin by final escaped wavelength
-
-                    if absprocesskey not in array_energysum_spectra:
-                        array_energysum_spectra[absprocesskey] = (
-                            np.zeros_like(array_lambda, dtype=float), np.zeros_like(array_lambda, dtype=float))
+        r_inner = t_seconds * v_inner
+        r_outer = t_seconds * v_outer
+    else:
+        # files with no escaped packets in the frequency and time ranges (according to their summary) are skipped
+        packetsfiles_matching = at.packets.filter_packetsfiles(
+            packetsfiles, type='TYPE_ESCAPE', escape_type='TYPE_RPKT',
+            filters=[('nu_rf', '>=', nu_min), ('nu_rf', '<', nu_max)] + (
+                [('t_arrive_d', '>', timelowerdays), ('t_arrive_d', '<', timeupperdays)] if not use_comovingframe else
+                [('escape_time', '>', timelow / betafactor), ('escape_time', '<', timehigh / betafactor)]))
 
-                    array_energysum_spectra[absprocesskey][1][xindexabsorbed] += pkt_en
+    processfile = partial(
+        get_flux_contributions_from_packets_onefile, modelpath=modelpath, lambda_min=lambda_min,
+        lambda_max=lambda_max, array_lambdabinedges=array_lambdabinedges, delta_lambda=delta_lambda,
+        timelow=timelow, timehigh=timehigh, getemission=getemission, getabsorption=getabsorption, groupby=groupby,
+        emtypecolumn=emtypecolumn, cells=cells, use_comovingframe=use_comovingframe, betafactor=betafactor,
+        useinternalpackets=useinternalpackets, emissionvelocitycut=emissionvelocitycut, packetfraction=packetfraction)
+
+    npackets_used = 0
+    for filetotal, filespectra, filenpackets in at.get_executor().map(processfile, packetsfiles_matching):
+        energysum_spectrum_emission_total += filetotal
+        npackets_used += filenpackets
+        for label, (energysum_emission, energysum_absorption) in filespectra.items():
+            if label not in array_energysum_spectra:
+                array_energysum_spectra[label] = (
+                    np.zeros_like(array_lambda, dtype=float), np.zeros_like(array_lambda, dtype=float))
+            array_energysum_spectra[label][0][:] += energysum_emission
+            array_energysum_spectra[label][1][:] += energysum_absorption
 
     if useinternalpackets:
         volume = 4 / 3. * math.pi * (r_outer ** 3 - r_inner ** 3)
         if modelgridindex:
             volume_shells = volume
-            assoc_cells, mgi_of_propcells = at.get_grid_mapping(modelpath=modelpath)
             volume = (at.get_wid_init_at_tmin(modelpath) * t_seconds / (
                 at.get_inputparams(modelpath)['tmin'] * u.day.to('s'))) ** 3 * len(assoc_cells[modelgridindex])
             print('volume', volume, 'shell volume', volume_shells, '-------------------------------------------------')
@@ -833,6 +1075,11 @@ def get_flux_contributions_from_packets(
         normfactor = (1. / delta_lambda / (timehigh - timelow) / 4 / math.pi
                       / (u.megaparsec.to('cm') ** 2) / nprocs_read)
 
+    if packetfraction is not None and packetfraction < 1.:
+        # the subsampled packets stand in for all of the packets
+        normfactor /= packetfraction
+        at.packets.print_packetfraction_noise(packetfraction, npackets_used, label='flux contributions')
+
     array_flambda_emission_total = energysum_spectrum_emission_total * normfactor
 
     contribution_list = []
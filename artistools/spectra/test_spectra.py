@@ -98,3 +98,83 @@ def test_spectra_timeseries_subplots():
     timedayslist = [295, 300]
     at.spectra.main(argsraw=[], specpath=modelpath, outputfile=outputpath,
                     timedayslist=timedayslist, multispecplot=True)
+
+
+def test_spectra_get_spectrum_cube():
+    cubemodelpath = Path(outputpath, 'specmodel')
+    cubemodelpath.mkdir(parents=True, exist_ok=True)
+    arr_tstart = np.array([100., 110., 125., 145.])
+    arr_tdelta = np.diff(arr_tstart, append=170.)
+    with open(Path(cubemodelpath, 'timesteps.out'), 'w') as ftimesteps:
+        ftimesteps.write('#timestep tstart_days tmid_days twidth_days\n')
+        for timestep, (tstart, tdelta) in enumerate(zip(arr_tstart, arr_tdelta)):
+            ftimesteps.write(f'{timestep} {tstart} {tstart + tdelta / 2} {tdelta}\n')
+
+    arr_nu = np.array([3e15, 2e15, 1e15])
+    fluxes = np.arange(1., 13.).reshape(len(arr_nu), len(arr_tstart))
+    with open(Path(cubemodelpath, 'spec.out'), 'w') as fspec:
+        fspec.write('0 ' + ' '.join(str(tstart + tdelta / 2) for tstart, tdelta in zip(arr_tstart, arr_tdelta)) + '\n')
+        for nu, fluxrow in zip(arr_nu, fluxes):
+            fspec.write(f'{nu} ' + ' '.join(str(f_nu) for f_nu in fluxrow) + '\n')
+
+    spectrumcube = at.spectra.get_spectrum_cube(cubemodelpath)
+    assert spectrumcube.cube.shape == (1, len(arr_tstart), len(arr_nu))
+    assert spectrumcube.cumcube.shape == (1, len(arr_tstart) + 1, len(arr_nu))
+
+    for timestepmin, timestepmax in [(0, 0), (1, 3), (0, 3)]:
+        dfspectrum = at.spectra.get_spectrum(cubemodelpath, timestepmin, timestepmax)
+        f_nu_stacked = at.spectra.stackspectra([
+            (fluxes[:, timestep], arr_tdelta[timestep]) for timestep in range(timestepmin, timestepmax + 1)])
+        assert np.allclose(dfspectrum['f_nu'].values, f_nu_stacked, rtol=1e-12)
+
+
+def test_spectra_reduce_vspecpol_files():
+    vspecmodelpath = Path(outputpath, 'vspecmodel')
+    vspecmodelpath.mkdir(parents=True, exist_ok=True)
+    # two observers with Stokes I, Q, and U at two times and two frequencies
+    vspecpolpaths = []
+    for rank in range(3):
+        vspecpolpath = Path(vspecmodelpath, f'vspecpol_{rank}-0.out')
+        with open(vspecpolpath, 'w') as fvspecpol:
+            for observer in range(2):
+                fvspecpol.write('0 ' + ' '.join(['10.5 11.5'] * 3) + '\n')
+                for nu in [2e15, 1e15]:
+                    fvspecpol.write(f'{nu} ' + ' '.join([str(rank + observer)] * 6) + '\n')
+        vspecpolpaths.append(vspecpolpath)
+
+    vspecpoltotal = at.spectra.spectra.reduce_vspecpol_files(vspecpolpaths)
+    assert vspecpoltotal.shape == (2, 3, 7)
+    assert np.array_equal(vspecpoltotal[:, 0, 1:3], [[10.5, 11.5], [10.5, 11.5]])
+    assert np.array_equal(vspecpoltotal[:, 1:, 0], [[2e15, 1e15], [2e15, 1e15]])
+    assert np.all(vspecpoltotal[0, 1:, 1:] == 3.) and np.all(vspecpoltotal[1, 1:, 1:] == 6.)
+
+
+def test_spectra_get_internal_spectra_from_packets():
+    internalmodelpath = Path(outputpath, 'internalmodel')
+    internalmodelpath.mkdir(parents=True, exist_ok=True)
+    Path(internalmodelpath, 'input.txt').write_text(
+        '1234\n10\n0 9\n200 400\n1e-4 1.0\n80\n1.0 1.0\n1\n')
+    Path(internalmodelpath, 'model.txt').write_text(
+        '2\n1.0\n1 5000 -14.0 1.0 0.5 0.0 0.0 0.0\n2 10000 -14.0 1.0 0.5 0.0 0.0 0.0\n')
+    # propagation cells 0 and 1 are in model cell 0, and propagation cell 2 is in model cell 1
+    Path(internalmodelpath, 'grid.out').write_text('0 0\n1 0\n2 1\n')
+
+    c_ang_s = const.c.to('angstrom/s').value
+    dfpackets = pd.DataFrame({
+        'type_id': np.array([11, 11, 11, 32, 11], dtype='int8'),
+        'escape_type_id': np.array([0, 0, 0, 11, 0], dtype='int8'),
+        'where': np.array([0, 1, 2, 2, 2], dtype='int32'),
+        'e_rf': [2., 2., 1., 8., 8.],
+        'nu_rf': c_ang_s / np.array([5050., 5050., 7050., 7050., 20000.])})
+    np.save(Path(internalmodelpath, 'packets00_0000.out.npy'), at.packets.get_packet_records(dfpackets))
+
+    array_lambda, dict_jlambda = at.spectra.get_internal_spectra_from_packets(
+        internalmodelpath, 4000., 8000., delta_lambda=100.)
+
+    # the escaped packet and the packet outside the wavelength range are excluded
+    assert sorted(dict_jlambda.keys()) == [0, 1]
+    assert np.flatnonzero(dict_jlambda[0]).tolist() == [np.searchsorted(array_lambda, 5050.)]
+    assert np.flatnonzero(dict_jlambda[1]).tolist() == [np.searchsorted(array_lambda, 7050.)]
+
+    # model cell 0 has four times the energy of model cell 1 in twice the volume
+    assert math.isclose(dict_jlambda[0].sum(), 2 * dict_jlambda[1].sum(), rel_tol=1e-10)
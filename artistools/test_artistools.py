@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import argparse
 import hashlib
 import math
 import numpy as np
@@ -82,6 +83,180 @@ def test_lightcurve_frompackets():
                        outputfile=os.path.join(outputpath, 'lightcurve_from_packets.pdf'))
 
 
+def test_packets_angle_bins():
+    syn_dir = [0, 0, 1]
+    # directions near the pole, the equator (at phi = 0.1 and pi + 0.1), and the opposite pole
+    dirx = np.array([0., math.cos(0.1), -math.cos(0.1), 0.])
+    diry = np.array([0., math.sin(0.1), -math.sin(0.1), 0.])
+    dirz = np.array([1., 0., 0., -1.])
+    angle_bins = at.packets.get_angle_bins(dirx, diry, dirz, syn_dir, nabins=100)
+    assert angle_bins[0] // 10 == 9
+    assert angle_bins[3] // 10 == 0
+    assert angle_bins[1] // 10 == angle_bins[2] // 10 == 5
+    assert angle_bins[1] % 10 != angle_bins[2] % 10
+    assert all(0 <= angle_bins) and all(angle_bins < 100)
+
+    assert all(at.packets.get_angle_bins(dirx, diry, dirz, syn_dir, nabins=36) < 36)
+
+
+def test_packets_accumulate_chunk():
+    dfpackets = pd.DataFrame({
+        'type_id': [32, 32, 32, 32, 11], 'escape_type_id': [11, 11, 11, 10, 0],
+        't_arrive_d': [1., 2., 2.5, 1.5, 1.5], 'e_rf': [1., 2., 4., 8., 16.], 'emissiontype': [3, 3, 5, 3, 3]})
+    timebinedges = [1., 2., 3.]
+
+    lumaccumulator = at.packets.make_accumulator(bins=[('t_arrive_d', timebinedges)])
+    assert np.array_equal(at.packets.accumulate.accumulate_chunk(lumaccumulator, dfpackets), [3., 4.])
+
+    emtypeaccumulator = at.packets.make_accumulator(
+        bins=[('t_arrive_d', timebinedges)], weightcolumn=None, groupbycolumn='emissiontype')
+    emtypecounts = at.packets.accumulate.accumulate_chunk(emtypeaccumulator, dfpackets)
+    assert np.array_equal(emtypecounts[3], [2, 0])
+    assert np.array_equal(emtypecounts[5], [0, 1])
+
+
+def test_packets_binnedcache():
+    packetsfile = Path(outputpath, 'packets00_0000.out')
+    packetsfile.parent.mkdir(parents=True, exist_ok=True)
+    packetsfile.write_text('0\n')
+
+    emtypeaccumulator = at.packets.make_accumulator(
+        bins=[('t_arrive_d', [1., 2., 3.])], weightcolumn=None, groupbycolumn='emissiontype')
+    emtypecounts = {3: np.array([2., 0.]), 5: np.array([0., 1.])}
+    at.packets.accumulate.write_binnedcache(packetsfile, emtypeaccumulator, emtypecounts)
+
+    cachedcounts = at.packets.accumulate.read_binnedcache(packetsfile, emtypeaccumulator)
+    assert cachedcounts.keys() == emtypecounts.keys()
+    assert all(np.array_equal(cachedcounts[k], emtypecounts[k]) for k in emtypecounts)
+
+    # a different binning is not found in the cache
+    assert at.packets.accumulate.read_binnedcache(
+        packetsfile, emtypeaccumulator._replace(weightcolumn='e_rf')) is None
+
+
+def test_packets_npy_roundtrip():
+    dfpackets = pd.DataFrame({
+        'type_id': np.array([32, 32, 11], dtype='int8'), 'escape_type_id': np.array([11, 10, 0], dtype='int8'),
+        'e_rf': [1., 2., 4.], 'nu_rf': [1e15, 2e15, 3e15]})
+    packetsfile = Path(outputpath, 'packets00_0000.out.npy')
+    packetsfile.parent.mkdir(parents=True, exist_ok=True)
+    np.save(packetsfile, at.packets.get_packet_records(dfpackets))
+
+    pd.testing.assert_frame_equal(at.packets.readfile_npy(packetsfile), dfpackets)
+
+    dfescaped = at.packets.readfile_npy(packetsfile, columns=['e_rf'], filters=[('type_id', '==', 32)])
+    assert list(dfescaped.columns) == ['e_rf']
+    assert np.array_equal(dfescaped['e_rf'].values, [1., 2.])
+
+
+def test_packets_scan():
+    scanmodelpath = Path(outputpath, 'scanmodel')
+    scanmodelpath.mkdir(parents=True, exist_ok=True)
+    for rank in range(2):
+        dfpackets = pd.DataFrame({
+            'type_id': np.array([32, 32, 32, 11], dtype='int8'),
+            'escape_type_id': np.array([11, 11, 10, 0], dtype='int8'),
+            'emissiontype': np.array([1, 2, 1, 1], dtype='int32'),
+            'e_rf': [1., 2., 4., 8.], 'nu_rf': [1e15, 2e15, 3e15, 4e15]})
+        np.save(Path(scanmodelpath, f'packets00_{rank:04d}.out.npy'), at.packets.get_packet_records(dfpackets))
+
+    packetsscan = at.packets.scan(scanmodelpath, type='TYPE_ESCAPE', escape_type='TYPE_RPKT')
+    assert len(packetsscan.packetsfiles) == 2
+
+    dfagg = packetsscan.with_columns(e_double='2 * e_rf').groupby('emissiontype').agg(
+        e_double=('e_double', 'sum'), count=('e_rf', 'count'), nu_mean=('nu_rf', 'mean')).collect()
+    assert list(dfagg['emissiontype']) == [1, 2]
+    assert np.allclose(dfagg['e_double'], [4., 8.])
+    assert list(dfagg['count']) == [2, 2]
+    assert np.allclose(dfagg['nu_mean'], [1e15, 2e15])
+
+    histogram = packetsscan.filter(('nu_rf', '>', 1.5e15)).histogram(bins=[('nu_rf', [0., 2.5e15, 5e15])]).collect()
+    assert np.allclose(histogram, [4., 0.])
+
+
+def test_packets_scan_processpool(monkeypatch):
+    monkeypatch.setitem(at.config, 'num_processes', 2)
+    scanmodelpath = Path(outputpath, 'scanmodelpool')
+    scanmodelpath.mkdir(parents=True, exist_ok=True)
+    for rank in range(3):
+        dfpackets = pd.DataFrame({
+            'type_id': np.array([32, 32], dtype='int8'), 'escape_type_id': np.array([11, 11], dtype='int8'),
+            'emissiontype': np.array([1, 2], dtype='int32'), 'e_rf': [1., 2.], 'nu_rf': [1e15, 2e15]})
+        np.save(Path(scanmodelpath, f'packets00_{rank:04d}.out.npy'), at.packets.get_packet_records(dfpackets))
+
+    packetsscan = at.packets.scan(scanmodelpath, type='TYPE_ESCAPE', escape_type='TYPE_RPKT')
+    with pytest.raises(TypeError):
+        packetsscan.with_columns(e_double=lambda df: 2 * df['e_rf'])
+
+    try:
+        assert at.get_executor().processes == 2
+        dfagg = packetsscan.with_columns(e_double='2 * e_rf').groupby('emissiontype').agg(
+            e_double=('e_double', 'sum')).collect()
+    finally:
+        at.shutdown_executor()
+
+    assert list(dfagg['emissiontype']) == [1, 2]
+    assert np.allclose(dfagg['e_double'], [6., 12.])
+
+
+def test_packets_groupby_agg_backends(monkeypatch):
+    df = pd.DataFrame({'emissiontype': [1., np.nan, 2., np.nan, 1.], 'e_rf': [1., 2., 4., 8., 16.]})
+    namedaggs = {'e_rf': ('e_rf', 'sum'), 'count': ('e_rf', 'count')}
+
+    dfaggs = {}
+    for backend in ['pandas', 'pyarrow']:
+        monkeypatch.setitem(at.config, 'dataframe_backend', backend)
+        dfaggs[backend] = at.packets.query.groupby_agg(df, ['emissiontype'], namedaggs)
+
+    # packets without a groupby value are kept as a group
+    assert np.allclose(dfaggs['pandas']['e_rf'], [17., 4., 10.])
+    assert list(dfaggs['pandas']['count']) == [2, 1, 2]
+    pd.testing.assert_frame_equal(dfaggs['pandas'], dfaggs['pyarrow'], check_dtype=False)
+
+
+def test_recompress_skips_columnar_packets():
+    from artistools import recompress
+
+    recompressmodelpath = Path(outputpath, 'recompressmodel')
+    recompressmodelpath.mkdir(parents=True, exist_ok=True)
+    Path(recompressmodelpath, 'packets00_0000.out').write_text('0\n')
+    Path(recompressmodelpath, 'packets00_0000.out.parquet').write_bytes(b'PAR1')
+
+    recompress.main(argsraw=['-modelpath', str(recompressmodelpath)])
+
+    assert Path(recompressmodelpath, 'packets00_0000.out.xz').is_file()
+    assert Path(recompressmodelpath, 'packets00_0000.out.parquet').read_bytes() == b'PAR1'
+    assert not Path(recompressmodelpath, 'packets00_0000.out.parquet.xz').exists()
+
+
+def test_read_res_data():
+    # two viewing angles with three timesteps each
+    resfile = Path(outputpath, 'light_curve_res.out')
+    resfile.parent.mkdir(parents=True, exist_ok=True)
+    resfile.write_text('1.0 2.0 3.0\n1.5 4.0 5.0\n2.0 6.0 7.0\n1.0 8.0 9.0\n1.5 10.0 11.0\n2.0 12.0 13.0\n')
+
+    resdata = at.read_res_data(resfile, index_of_repeated_value=0)
+    assert resdata.shape == (2, 3, 3)
+    assert np.array_equal(resdata[1, :, 1], [8., 10., 12.])
+
+    lcdata = at.lightcurve.readfile(resfile, args=argparse.Namespace(gamma=False, plotviewingangle=[0]))
+    assert len(lcdata) == 2
+    assert np.array_equal(lcdata[0]['lum_cmf'], [3., 5., 7.])
+
+
+def test_read_res_data_buffer(monkeypatch):
+    # file-like objects cannot be cached, so they are parsed directly even with the disk cache enabled
+    monkeypatch.setitem(at.config, 'enable_diskcache', True)
+    resfile = Path(outputpath, 'light_curve_res_buffer.out')
+    resfile.parent.mkdir(parents=True, exist_ok=True)
+    resfile.write_text('1.0 2.0 3.0\n1.5 4.0 5.0\n1.0 8.0 9.0\n1.5 10.0 11.0\n')
+
+    with resfile.open('rt') as fres:
+        lcdata = at.lightcurve.readfile(fres, args=argparse.Namespace(gamma=False, plotviewingangle=[0]))
+    assert len(lcdata) == 2
+    assert np.array_equal(lcdata[1]['lum'], [8., 10.])
+
+
 def test_band_lightcurve_plot():
     at.lightcurve.main(argsraw=[], modelpath=modelpath, filter=['B'], outputfile=outputpath)
 